@@ -0,0 +1,150 @@
+import os
+import glob
+import json
+import hashlib
+import inspect
+import tempfile
+
+import tifffile as tiff
+
+# Change this when segmentation/tracking/ring code changes such that
+# previously cached masks are no longer valid
+CACHE_VERSION = 2
+
+def file_content_hash(file_path, chunk_size=2**24):
+    '''
+    Hash of the content of a file (read in chunks, such that large files
+    don't need to fit in memory).
+    '''
+
+    file_hash = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+def function_parameters(function, parameters):
+    '''
+    Combine the given parameters with the default parameters of the
+    function, such that the key also changes when a default changes.
+    '''
+
+    all_parameters = {name: param.default for name, param in inspect.signature(function).parameters.items()
+                        if param.default is not inspect.Parameter.empty}
+    all_parameters.update(parameters)
+
+    return all_parameters
+
+def cache_key(file_hash, series, nuclear_channel, segmentation_parameters, cytoplasm_parameters, tracking_parameters):
+    '''
+    Key of a cache entry, based on the content of the input file, the series
+    (position) in the file, the nuclear channel and the parameters used for 
+    segmentation, tracking (including the method) and cytoplasm rings.
+    Parameters should be complete (see function_parameters).
+    '''
+
+    key_content = json.dumps({'version': CACHE_VERSION, 'file_hash': file_hash, 'series': series, 'nuclear_channel': nuclear_channel,
+                              'segmentation_parameters': segmentation_parameters, 'cytoplasm_parameters': cytoplasm_parameters,
+                              'tracking_parameters': tracking_parameters},
+                             sort_keys=True, default=str)
+
+    return hashlib.blake2b(key_content.encode(), digest_size=20).hexdigest()
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, f"masks_{key}.tif")
+
+def cached_mask_dtype(cache_dir, key):
+    '''The dtype of the masks of the entry for key (see load_masks), or None if there's no (readable) entry.'''
+
+    try:
+        with tiff.TiffFile(cache_path(cache_dir, key)) as tif:
+            return tif.pages[0].dtype
+    except Exception:
+        return None
+
+def load_masks(cache_dir, key, nucleus_masks_tracked, cytoplasm_masks_tracked):
+    '''
+    If an entry for key exists, read the cached masks frame by frame into
+    the given (empty) T,Y,X stacks and return True, otherwise return False.
+    The stacks should have the dtype of the entry (see cached_mask_dtype).
+    Loading an entry marks it as recently used.
+    '''
+
+    path = cache_path(cache_dir, key)
+    if not os.path.exists(path):
+        return False
+
+    try:
+        with tiff.TiffFile(path) as tif:
+            # pages are stored as T,C, with C=0 nuclei and C=1 cytoplasm
+            for frm in range(len(nucleus_masks_tracked)):
+                nucleus_masks_tracked[frm]   = tif.pages[2*frm].asarray()
+                cytoplasm_masks_tracked[frm] = tif.pages[2*frm+1].asarray()
+    except Exception as e:
+        # e.g. entry removed by another process, or incomplete
+        print(f"Warning: could not read cache entry {path} ({e}), recomputing.")
+        return False
+
+    # update the modification time, which is used for LRU eviction
+    os.utime(path)
+
+    return True
+
+def store_masks(cache_dir, key, nucleus_masks_tracked, cytoplasm_masks_tracked, max_size_gb=10):
+    '''
+    Store the tracked nucleus and cytoplasm masks as a compressed tif
+    (T,2,Y,X), and afterwards evict the least recently used entries
+    if the cache is larger than max_size_gb.
+    '''
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # write to a temporary file first, such that other processes never see a partial entry
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        with tiff.TiffWriter(temp_path, bigtiff=True) as tif:
+            # pages are written one by one (T,C order), such that the masks don't need to be in memory
+            pages = (masks[frm] for frm in range(len(nucleus_masks_tracked)) for masks in (nucleus_masks_tracked, cytoplasm_masks_tracked))
+            tif.write(pages,
+                      shape=(len(nucleus_masks_tracked), 2) + tuple(nucleus_masks_tracked.shape[1:]), dtype=nucleus_masks_tracked.dtype,
+                      compression='zlib', metadata={'axes': 'TCYX'})
+        os.replace(temp_path, cache_path(cache_dir, key))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    evict_least_recently_used(cache_dir, max_size_gb)
+
+def evict_least_recently_used(cache_dir, max_size_gb):
+    '''
+    Remove the least recently used cache entries until the total
+    size of the cache is below max_size_gb.
+    '''
+
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, 'masks_*.tif')):
+        try:
+            entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        except FileNotFoundError:
+            pass # removed by another process
+
+    total_size = sum(entry[1] for entry in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size_gb * 1e9:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+def clear_cache(cache_dir):
+    '''Remove all cache entries, returns the number of removed entries.'''
+
+    paths = glob.glob(os.path.join(cache_dir, 'masks_*.tif')) + glob.glob(os.path.join(cache_dir, '*.tmp'))
+    for path in paths:
+        os.remove(path)
+
+    return len(paths)
@@ -3,8 +3,11 @@
 # import ndimage
 from scipy import ndimage
 import numpy as np
+import pandas as pd
 
-def get_background_mask(img_int, ESTIMATED_OBJECT_RADIUS=30):
+import Functions.Tiling as TRtile
+
+def get_background_bbox(img_int, ESTIMATED_OBJECT_RADIUS=30):
     # img_int= image_stack_intensity[0];ESTIMATED_OBJECT_RADIUS=30
     '''
     Automatically determine the location of a background based on 
@@ -12,6 +15,8 @@ def get_background_mask(img_int, ESTIMATED_OBJECT_RADIUS=30):
     Both the size of the background box and the dilatino are based
     on the estimated object radius.
     This should be the objects that appear in the data.
+    Returns the box as (min_row, min_col, max_row, max_col), similarly 
+    formatted as the bbox in regionprops.
     '''
     
     background_mask_size_odd = ESTIMATED_OBJECT_RADIUS + 1 if ESTIMATED_OBJECT_RADIUS % 2 == 0 else ESTIMATED_OBJECT_RADIUS
@@ -35,10 +40,6 @@ def get_background_mask(img_int, ESTIMATED_OBJECT_RADIUS=30):
     # produce the boundaries of a box around the maximum (±ESTIMATED_OBJECT_RADIUS), similarly formatted as the bbox in regionprops
     background_bbox_coords = (max_loc[0]-background_mask_halfsize, max_loc[1]-background_mask_halfsize,
                                 max_loc[0]+background_mask_halfsize, max_loc[1]+background_mask_halfsize)
-
-    # produce a mask according to the bbox
-    background_mask = np.zeros(img_int.shape, dtype=bool)
-    background_mask[background_bbox_coords[0]:background_bbox_coords[2], background_bbox_coords[1]:background_bbox_coords[3]] = True
       
     if False:
         # Show 
@@ -49,28 +50,131 @@ def get_background_mask(img_int, ESTIMATED_OBJECT_RADIUS=30):
         # draw the bbox
         plt.plot([background_bbox_coords[1], background_bbox_coords[3], background_bbox_coords[3], background_bbox_coords[1], background_bbox_coords[1]],\
                     [background_bbox_coords[0], background_bbox_coords[0], background_bbox_coords[2], background_bbox_coords[2], background_bbox_coords[0]], color='r')             
-        # draw the mask
-        # plt.contour(background_mask, levels=[0.5], colors='lightblue')
         plt.grid(False)
         plt.show(); plt.close()
     
+    return tuple(int(coord) for coord in background_bbox_coords)
+
+def get_background_mask(img_int, ESTIMATED_OBJECT_RADIUS=30):
+    '''
+    Boolean mask of the background box determined by get_background_bbox.
+    '''
+    
+    background_bbox_coords = get_background_bbox(img_int, ESTIMATED_OBJECT_RADIUS=ESTIMATED_OBJECT_RADIUS)
+    
+    # produce a mask according to the bbox
+    background_mask = np.zeros(img_int.shape, dtype=bool)
+    background_mask[background_bbox_coords[0]:background_bbox_coords[2], background_bbox_coords[1]:background_bbox_coords[3]] = True
+    
     return background_mask
 
+def subtract_background(img_int, background_level):
+    '''
+    Subtract a background level from an image, values below the
+    background become 0. Returns a float32 image.
+    '''
+    
+    img_int_corrected = np.maximum(img_int.astype(np.float32), np.float32(background_level)) # make sure no negative values result next line
+    img_int_corrected -= np.float32(background_level)
+    
+    return img_int_corrected
+
 def correct_background(img_int, ESTIMATED_OBJECT_RADIUS=30):
+    '''
+    Background-correct a single image, using the median of its own 
+    background box (see get_background_bbox).
+    For stacks and multiple channels, determine_background_levels is faster.
+    '''
     
     # Determine which part of the image can be considered background
-    background_mask = get_background_mask(img_int, ESTIMATED_OBJECT_RADIUS=30)
+    background_mask = get_background_mask(img_int, ESTIMATED_OBJECT_RADIUS=ESTIMATED_OBJECT_RADIUS)
     
     # Determine a background value
     median_background = np.median(img_int[background_mask])
     
     # Return an image with the background subtracted
-    img_int_corrected = img_int.copy()
-    img_int_corrected[img_int_corrected<median_background] = median_background # make sure no negative values result next line
-    img_int_corrected = img_int_corrected - median_background
-        # img_int_corrected[background_mask]
+    return subtract_background(img_int, median_background)
+
+def reference_image(channel_frames):
+    '''Sum of the frames of the channels (dict {key: Y,X frame}), used to find the background box.'''
     
-    return img_int_corrected
+    return np.sum(list(channel_frames.values()), axis=0, dtype=np.float32)
+
+def find_background_bbox(img_int, ESTIMATED_OBJECT_RADIUS=30, tile_size=None, num_workers=1):
+    '''
+    get_background_bbox, or, for very large frames, its tiled version 
+    (TRtile.get_background_bbox_tiled) if tile_size is given.
+    '''
+    
+    if tile_size is not None:
+        return TRtile.get_background_bbox_tiled(img_int, ESTIMATED_OBJECT_RADIUS=ESTIMATED_OBJECT_RADIUS, tile_size=tile_size, num_workers=num_workers)
+    
+    return get_background_bbox(img_int, ESTIMATED_OBJECT_RADIUS=ESTIMATED_OBJECT_RADIUS)
+
+def static_background_bbox(channel_stacks, ESTIMATED_OBJECT_RADIUS=30, tile_size=None, num_workers=1):
+    '''
+    Background box for a static stage: determined once, on the maximum projection 
+    over time of the sum of the channels (channel_stacks is a dict {key: T,Y,X stack}).
+    Frames are read one at a time. With tile_size, the box is searched tile by tile.
+    '''
+    
+    keys = list(channel_stacks.keys())
+    num_frames = channel_stacks[keys[0]].shape[0]
+    
+    reference_projection = reference_image({thekey: channel_stacks[thekey][0] for thekey in keys})
+    for time_index in range(1, num_frames):
+        np.maximum(reference_projection, reference_image({thekey: channel_stacks[thekey][time_index] for thekey in keys}), out=reference_projection)
+    
+    return find_background_bbox(reference_projection, ESTIMATED_OBJECT_RADIUS=ESTIMATED_OBJECT_RADIUS, tile_size=tile_size, num_workers=num_workers)
+
+def background_levels_frame(channel_frames, time_index, ESTIMATED_OBJECT_RADIUS=30, background_bbox_coords=None, tile_size=None, num_workers=1):
+    '''
+    Background levels of one frame of multiple channels (dict {key: Y,X frame}),
+    the median in a box that is dark in all channels. The box is determined on
+    the sum of the channels, unless it is given (background_bbox_coords, e.g. 
+    from static_background_bbox); with tile_size, it is searched tile by tile.
+    Returns a list of rows (dicts), one per key.
+    '''
+    
+    if background_bbox_coords is None:
+        background_bbox_coords = find_background_bbox(reference_image(channel_frames), ESTIMATED_OBJECT_RADIUS=ESTIMATED_OBJECT_RADIUS, 
+                                                      tile_size=tile_size, num_workers=num_workers)
+    
+    background_levels = []
+    for thekey, frame in channel_frames.items():
+        background_box = frame[background_bbox_coords[0]:background_bbox_coords[2], background_bbox_coords[1]:background_bbox_coords[3]]
+        background_levels.append({'Frame': time_index, 'Key': thekey, 'Background': np.median(background_box),
+                                  'Box_min_row': background_bbox_coords[0], 'Box_min_col': background_bbox_coords[1],
+                                  'Box_max_row': background_bbox_coords[2], 'Box_max_col': background_bbox_coords[3]})
+    
+    return background_levels
+
+def determine_background_levels(channel_stacks, ESTIMATED_OBJECT_RADIUS=30, static_stage=False, tile_size=None, num_workers=1):
+    '''
+    Determine the background level of each frame of multiple channels at once.
+    
+    channel_stacks is a dict {key: T,Y,X stack} of the channels to correct, which 
+    all show the same field of view. The background box is determined once per 
+    frame, on the sum of the channels (i.e. a region that is dark in all channels), 
+    and then used for all channels. With static_stage=True, the box is determined 
+    only once for the whole stack, on the maximum projection over time.
+    With tile_size, the box is searched tile by tile (for very large frames).
+    
+    Returns a dataframe with per frame and key the background level (median in the
+    box), and the coordinates of the box, such that the correction can be checked.
+    '''
+    
+    keys = list(channel_stacks.keys())
+    num_frames = channel_stacks[keys[0]].shape[0]
+    
+    # for a static stage, one box for all frames
+    background_bbox_coords = static_background_bbox(channel_stacks, ESTIMATED_OBJECT_RADIUS=ESTIMATED_OBJECT_RADIUS, tile_size=tile_size, num_workers=num_workers) \
+                                if static_stage else None
     
+    background_levels = []
+    for time_index in range(num_frames):
+        background_levels += background_levels_frame({thekey: channel_stacks[thekey][time_index] for thekey in keys}, time_index, 
+                                                     ESTIMATED_OBJECT_RADIUS=ESTIMATED_OBJECT_RADIUS, background_bbox_coords=background_bbox_coords,
+                                                     tile_size=tile_size, num_workers=num_workers)
     
-    
\ No newline at end of file
+    return pd.DataFrame(background_levels)
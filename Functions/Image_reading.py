@@ -0,0 +1,298 @@
+import numpy as np
+import tifffile as tiff
+import os
+import re
+import tempfile
+import threading
+
+# Axes of the stacks used in the pipeline
+PIPELINE_AXES = 'TCYX'
+
+
+def check_dimensions_img(img):
+    '''
+    Check if there are three or four dimensions.
+    If there are three, assume these are channels, x, y, and add a
+    time dimension at the front.
+    '''
+
+    # If 4 dims everything OK
+    if len(img.shape) == 4:
+        return img
+    if len(img.shape) == 3:
+        img_expanded = np.expand_dims(img, axis=0)
+        print('Warning: image has 3 dimensions instead of expected 4, assuming time dimensions is missing, and adding it.')
+        return img_expanded
+
+    raise ValueError('Image has unexpected number of dimensions, expected 3 or 4, got {0}'.format(len(img.shape)))
+
+
+def pipeline_axes_order(axes, shape):
+    '''
+    How to convert an array with the given axes (tifffile axes string, e.g. 
+    'TZCYX' or 'CYXS') to T,C,Y,X. Returns the axes in T,C,Y,X order
+    (after dropping axes of size 1), or None if the axes are not known, 
+    e.g. for tif files without metadata (then check_dimensions_img is used).
+    RGB samples (S) are used as channels; a Z axis of size > 1 is an error.
+    '''
+
+    axes_sizes = {axis: size for axis, size in zip(axes, shape) if size > 1 or axis in 'YX'}
+    if ('C' in axes_sizes) and ('S' in axes_sizes):
+        raise ValueError(f"Image has both channels (C) and samples (S), axes {axes}")
+    axes_sizes = {('C' if axis == 'S' else axis): size for axis, size in axes_sizes.items()}
+    if 'Z' in axes_sizes:
+        raise ValueError(f"Image has a Z dimension (axes {axes}), which is not supported")
+    if not set(axes_sizes) <= set(PIPELINE_AXES):
+        return None
+
+    return ''.join(axis for axis in PIPELINE_AXES if axis in axes_sizes)
+
+def to_pipeline_axes(img, axes):
+    '''
+    View of img (with tifffile axes string axes) as a T,C,Y,X stack, without
+    copying: axes of size 1 are dropped, the others are put in T,C,Y,X order
+    and missing axes are added with size 1.
+    '''
+
+    axes_order = pipeline_axes_order(axes, img.shape)
+    if axes_order is None:
+        return check_dimensions_img(img)
+
+    # drop axes of size 1 (except Y, X)
+    keep = [idx for idx, (axis, size) in enumerate(zip(axes, img.shape)) if size > 1 or axis in 'YX']
+    img = img.reshape([img.shape[idx] for idx in keep])
+    img_axes = ''.join('C' if axes[idx] == 'S' else axes[idx] for idx in keep)
+    img = np.transpose(img, [img_axes.index(axis) for axis in axes_order])
+
+    return img.reshape([img.shape[axes_order.index(axis)] if axis in axes_order else 1 for axis in PIPELINE_AXES])
+
+def sample_name(file_path):
+    '''Sample name of a file: the file name without extension (.tif, .ome.tif).'''
+
+    file_name = os.path.splitext(os.path.basename(file_path))[0]
+
+    return file_name[:-len('.ome')] if file_name.endswith('.ome') else file_name
+
+def list_positions(file_path):
+    '''
+    The positions (series) in a tif file, e.g. a multi-position OME-TIFF.
+    Returns a list of dicts with the series index, the sample name, the 
+    axes and shape of the series. The sample name is the file name (without
+    extension, see sample_name) for files with one series, and the file name followed by the 
+    name of the series (or s<index>, if the series have no unique names) 
+    for files with multiple series.
+    '''
+
+    file_name = sample_name(file_path)
+    with tiff.TiffFile(file_path) as tif:
+        series_list = [(series.name or '', series.axes, tuple(series.shape)) for series in tif.series]
+
+    if len(series_list) == 1:
+        return [{'series': 0, 'sample': file_name, 'axes': series_list[0][1], 'shape': series_list[0][2]}]
+
+    # names are cleaned up, such that they can be used in file names
+    series_names = [re.sub(r'[^\w\-]+', '_', series_name).strip('_') for series_name, _, _ in series_list]
+    if (len(set(series_names)) < len(series_names)) or ('' in series_names):
+        series_names = [f"s{series_idx}" for series_idx in range(len(series_list))]
+
+    return [{'series': series_idx, 'sample': f"{file_name}_{series_name}", 'axes': axes, 'shape': shape}
+                for series_idx, (series_name, (_, axes, shape)) in enumerate(zip(series_names, series_list))]
+
+def read_image_stack(file_path, lazy=False, series=0):
+    '''
+    Read a T,C,Y,X stack from (a series of) a tif file. The axis order is
+    taken from the metadata if available, otherwise T,C,Y,X is assumed.
+    If lazy=False, the whole stack is loaded into memory (numpy array).
+    If lazy=True, a LazyImageStack is returned, which reads frames only
+    when they are requested.
+    '''
+
+    if lazy:
+        return LazyImageStack(file_path, series=series)
+
+    with tiff.TiffFile(file_path) as tif:
+        return to_pipeline_axes(tif.series[series].asarray(), tif.series[series].axes)
+
+
+def is_complete_tiff(file_path):
+    '''
+    Check whether a tif file is completely written, i.e. it can be opened
+    and the image data of its last frame lies within the file.
+    (Used when watching a folder in which the microscope is still writing.)
+    '''
+
+    try:
+        file_size = os.path.getsize(file_path)
+        with tiff.TiffFile(file_path) as tif:
+            # the last series is written last
+            series = tif.series[-1]
+            # contiguous data, e.g. ImageJ hyperstacks
+            if series.dataoffset is not None:
+                return series.dataoffset + series.nbytes <= file_size
+            # otherwise check the last page
+            last_page = series.pages[-1]
+            if last_page is None:
+                return False
+            return max(offset + bytecount for offset, bytecount in zip(last_page.dataoffsets, last_page.databytecounts)) <= file_size
+    except Exception:
+        return False
+
+
+class LazyImageStack:
+    '''
+    T,C,Y,X tif stack (one series of a tif file) of which frames are only 
+    read when needed, such that stacks larger than the memory can be analyzed.
+    The axis order is taken from the metadata (see to_pipeline_axes).
+
+    If the image data is stored contiguously and uncompressed, the file is
+    memory-mapped; otherwise, the pages of the tif file are read one by one.
+
+    Supports the indexing used in the pipeline:
+        stack[t, c] gives the 2D frame of timepoint t and channel c
+        stack[:, c] gives a ChannelView, which behaves like a T,Y,X stack
+    '''
+
+    def __init__(self, file_path, series=0):
+
+        self.file_path = file_path
+        self.series = series
+        self.tif = tiff.TiffFile(file_path)
+        tif_series = self.tif.series[series]
+        self.dtype = tif_series.dtype
+        self.axes = tif_series.axes
+        series_shape = tuple(tif_series.shape)
+
+        def series_axis(axis):
+            # index of a T,C,Y,X axis in the series (channels can be samples, S), preferring
+            # the axis of size > 1 if there are two (e.g. C of size 1 and S)
+            indices = sorted((idx for idx, series_axis in enumerate(self.axes) if series_axis.replace('S', 'C') == axis), 
+                             key=lambda idx: series_shape[idx] == 1)
+            return indices[0] if len(indices) > 0 else None
+
+        axes_order = pipeline_axes_order(self.axes, series_shape)
+        if axes_order is None:
+            # same convention as check_dimensions_img, but without reading the data
+            shape = series_shape
+            if len(shape) == 3:
+                print('Warning: image has 3 dimensions instead of expected 4, assuming time dimensions is missing, and adding it.')
+                shape = (1,) + shape
+            if len(shape) != 4:
+                raise ValueError('Image has unexpected number of dimensions, expected 3 or 4, got {0}'.format(len(shape)))
+            self.shape = shape
+        else:
+            self.shape = tuple(series_shape[series_axis(axis)] if axis in axes_order else 1 for axis in PIPELINE_AXES)
+
+        # Where the frames are in the series (for reading page by page): the series is
+        # its pages one after the other (C order), so a frame is found from the strides
+        # (in elements) of the series, also if the channels are samples (S) of the pages,
+        # planar (SYX) or interleaved (YXS). frame_strides are the strides of T, C, Y, X.
+        series_strides = np.cumprod((series_shape[1:] + (1,))[::-1])[::-1]
+        if axes_order is None:
+            # the T,C,Y,X stack is the series reshaped (see check_dimensions_img)
+            self.frame_strides = tuple(int(stride) for stride in np.cumprod((self.shape[1:] + (1,))[::-1])[::-1])
+        else:
+            self.frame_strides = tuple(int(series_strides[series_axis(axis)]) if series_axis(axis) is not None else 0 for axis in PIPELINE_AXES)
+        self.page_size = tif_series.keyframe.size
+
+        # try memory-mapping (a view in T,C,Y,X order), fall back to reading page by page
+        try:
+            self.memmap = tiff.memmap(file_path, series=series, mode='r')
+            self.memmap = to_pipeline_axes(self.memmap, self.axes) if axes_order is not None else self.memmap.reshape(self.shape)
+        except ValueError:
+            self.memmap = None
+
+        # reading pages is not thread-safe (e.g. with parallel segmentation)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return 4
+
+    def get_frame(self, time_index, channel):
+        '''Read the 2D frame of one timepoint and channel.'''
+
+        if self.memmap is not None:
+            return np.asarray(self.memmap[time_index, channel])
+
+        # the page with the frame, and the frame in the (flattened) page
+        offset = time_index*self.frame_strides[0] + channel*self.frame_strides[1]
+        key, offset = divmod(offset, self.page_size)
+        with self.lock:
+            page = self.tif.asarray(key=key, series=self.series).reshape(-1)
+        stride_y, stride_x = self.frame_strides[2:]
+        if offset + (self.shape[2]-1)*stride_y + (self.shape[3]-1)*stride_x >= len(page):
+            raise ValueError(f"Frames of {self.file_path} are split over pages, which is not supported for lazy reading")
+
+        return np.lib.stride_tricks.as_strided(page[offset:], shape=self.shape[2:], 
+                                               strides=(stride_y*page.itemsize, stride_x*page.itemsize)).copy()
+
+    def __getitem__(self, key):
+
+        time_index, channel = key
+        if isinstance(time_index, slice) and time_index == slice(None):
+            return ChannelView(self, channel)
+
+        return self.get_frame(time_index, channel)
+
+    def close(self):
+        self.memmap = None
+        self.tif.close()
+
+
+class ChannelView:
+    '''
+    One channel of a LazyImageStack, that behaves like a T,Y,X stack
+    of which frames are read on demand (view[t] returns a 2D frame).
+    '''
+
+    def __init__(self, stack, channel):
+
+        self.stack = stack
+        self.channel = channel
+        self.shape = (stack.shape[0],) + tuple(stack.shape[2:])
+        self.dtype = stack.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return 3
+
+    def __getitem__(self, time_index):
+
+        return self.stack.get_frame(time_index, self.channel)
+
+    def __iter__(self):
+        for time_index in range(self.shape[0]):
+            yield self[time_index]
+
+
+def allocate_stack(shape, dtype, on_disk=False):
+    '''
+    Create an empty (e.g. mask) stack to fill frame by frame.
+    If on_disk=True, the stack is a memory-mapped temporary file instead
+    of an array in memory; the file is removed automatically once the
+    stack is no longer used.
+    '''
+
+    if on_disk:
+        return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
+
+    return np.empty(shape, dtype=dtype)
+
+def promote_stack(stack, dtype):
+    '''
+    Copy of a stack (see allocate_stack) with another dtype, e.g. when the 
+    labels of a mask stack don't fit anymore; on disk if stack is on disk.
+    Copied frame by frame.
+    '''
+
+    promoted = allocate_stack(stack.shape, dtype, on_disk=isinstance(stack, np.memmap))
+    for frm in range(len(stack)):
+        promoted[frm] = stack[frm]
+
+    return promoted
@@ -1,21 +1,15 @@
-
-
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
-import tifffile as tiff
-from skimage.filters import threshold_otsu
-from skimage.morphology import remove_small_objects, remove_small_holes, binary_opening, disk, binary_dilation
-import os
-from glob import glob
 import csv
-from skimage.measure import label
 
 import pandas as pd
 
+import Functions.Segmentation as TRseg
+import Functions.Image_corrections as TRcorrect
+
 
 # Function to visualize a specific time point and channel
 def visualize_timepoint(stack, time_index, channel_index):
+    import matplotlib.pyplot as plt # only needed here
     plt.figure(figsize=(6, 6))
     plt.title(f"Time Point: {time_index}, Channel: {channel_index}")
     plt.imshow(stack[time_index, channel_index], cmap="gray")
@@ -38,39 +32,200 @@ def thedata_rowasdict(time_index, cell_lbl, nucleus_intensity, cytoplasm_intensi
         }
     
 
-# Function to measure intensities for both nucleus and cytoplasm for all time points
-def measure_intensities_for_all_timepoints(image_stack_intensity, nucleus_masks_tracked, cytoplasm_masks_tracked):
+def mean_from_sums(label_sums, label_counts):
+    '''
+    Mean intensity from sums and counts; labels without pixels get NaN
+    (like np.mean of an empty selection, but without the warning).
+    '''
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return label_sums / label_counts
+
+# Percentiles of the intensities per cell (with features=True), 50 is reported as median
+PERCENTILES = (10, 50, 90)
+
+def label_index(mask, num_labels):
+    '''
+    The labels and (flat) positions of the pixels with labels 1..num_labels 
+    in mask. Reductions of one or more images over these pixels only need to
+    go over the labeled pixels instead of the whole frame.
+    '''
+    
+    mask_flat = np.asarray(mask).ravel()
+    pixel_index = np.flatnonzero((mask_flat > 0) & (mask_flat <= num_labels))
+    
+    return mask_flat[pixel_index], pixel_index
+
+def percentiles_per_label(labels_px, values_px, num_labels, percentiles=PERCENTILES):
+    '''
+    Labeled percentiles: for each label 1..num_labels, the percentiles of the 
+    intensities of its pixels (linear interpolation, like np.percentile), 
+    and, in the last row, of all labeled pixels. Labels without pixels get NaN.
+    labels_px and values_px are the labels and intensities of the labeled 
+    pixels (see label_index).
+    Returns an array (num_labels+1, len(percentiles)).
+    
+    The labeled pixels are sorted once by label and intensity, after which 
+    the percentiles of all labels are looked up at once.
+    '''
+    
+    # sort by label, then intensity; label l occupies positions starts[l-1]..starts[l-1]+counts[l-1]-1
+    values_sorted = values_px[np.lexsort((values_px, labels_px))].astype(np.float64)
+    counts = np.bincount(labels_px, minlength=num_labels+1)[1:num_labels+1]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    
+    label_percentiles = np.full((num_labels+1, len(percentiles)), np.nan)
+    present = counts > 0
+    for percentile_idx, percentile in enumerate(percentiles):
+        position = starts[present] + (counts[present]-1) * percentile/100
+        position_low = np.floor(position).astype(np.int64)
+        position_high = np.minimum(position_low+1, starts[present]+counts[present]-1)
+        fraction = position - position_low
+        label_percentiles[:num_labels][present, percentile_idx] = \
+            values_sorted[position_low] + fraction * (values_sorted[position_high] - values_sorted[position_low])
+    if len(values_px) > 0:
+        label_percentiles[num_labels] = np.percentile(values_px, percentiles)
+    
+    return label_percentiles
+
+def with_all(label_values, label_counts):
+    '''Means per label 1..num_labels (from sums and counts, index 0 is background), followed by the overall mean.'''
     
-    # A list to store the data
-    # Each entry will be a dictionary (see function thedata_rowasdict above)
-    # {'Frame': .., 'Cell': .., 'Intensity_nucleus': .., 'Intensity_cytoplasm': ..}
-    thedata = []
+    return np.append(mean_from_sums(label_values[1:], label_counts[1:]), mean_from_sums(label_values[1:].sum(), label_counts[1:].sum()))
+
+# Function to measure intensities for both nucleus and cytoplasm in one frame, for multiple channels
+def measure_intensities_frame_channels(channel_frames, nucleus_mask, cytoplasm_mask, num_labels, features=False, cells=None, background_levels=None):
+    '''
+    Mean nuclear and cytoplasmic intensity of cell labels 1..num_labels in one 
+    frame, each followed by the mean over all nuclei/all cytoplasm rings ('all'),
+    for each channel in channel_frames ({key: 2D frame}).
+    The labeled pixels of the nucleus and cytoplasm masks are determined once 
+    (see label_index), and all channels are reduced over them (labeled 
+    reductions with bincount), such that the masks are not processed again 
+    for each channel. If background_levels ({key: level}) are given, the 
+    background is subtracted from the labeled pixels (see TRcorrect.subtract_background).
+    With features=True, also the area (pixel count) and integrated intensity of
+    the nucleus and ring, the nucleus centroid, and the median and percentiles 
+    (PERCENTILES) of the intensities.
+    Returns a dict {key: {column: array of num_labels+1 values}}; if cells 
+    (array of labels) is given, only the values of these cells, followed by 'all'.
+    '''
     
-    # Go over frames
-    for time_index in range(image_stack_intensity.shape[0]):
+    measurements = {thekey: {} for thekey in channel_frames}
+    for region, mask in [('nucleus', nucleus_mask), ('cytoplasm', cytoplasm_mask)]:
         
-        current_image = image_stack_intensity[time_index]
+        # the labeled pixels and pixel counts per label are the same for all channels
+        labels_px, pixel_index = label_index(mask, num_labels)
+        label_counts = np.bincount(labels_px, minlength=num_labels+1)[:num_labels+1]
         
-        # Calculate the mean intensities per cell                
-        for cell_lbl in range(1, np.max(nucleus_masks_tracked)+1):
+        for thekey, current_image in channel_frames.items():
             
-            # Calculate mean intensity for this cell
-            nucleus_intensity = measure_intensity(current_image, nucleus_masks_tracked[time_index]==cell_lbl)
-            cytoplasm_intensity = measure_intensity(current_image, cytoplasm_masks_tracked[time_index]==cell_lbl)        
+            values_px = np.asarray(current_image).ravel()[pixel_index]
+            if background_levels is not None:
+                values_px = TRcorrect.subtract_background(values_px, background_levels[thekey])
             
-            # Add information to list
-            thedata.append(thedata_rowasdict(time_index, cell_lbl, nucleus_intensity, cytoplasm_intensity))
+            # Sums per label, and the mean per cell (label 0 is background and is 
+            # left out) and the overall mean over all labeled pixels ('all')
+            label_sums = np.bincount(labels_px, weights=values_px, minlength=num_labels+1)[:num_labels+1]
+            measurements[thekey][f"Intensity_{region}"] = with_all(label_sums, label_counts)
+            if not features:
+                continue
             
-        # Also calculate the overall mean intensities, add to list
-        thedata.append(thedata_rowasdict(time_index, 'all', 
-                                         measure_intensity(current_image, nucleus_masks_tracked[time_index]>0), 
-                                         measure_intensity(current_image, cytoplasm_masks_tracked[time_index]>0)))
+            measurements[thekey][f"Area_{region}"] = np.append(label_counts[1:], label_counts[1:].sum())
+            measurements[thekey][f"Integrated_intensity_{region}"] = np.append(label_sums[1:], label_sums[1:].sum())
+            label_percentiles = percentiles_per_label(labels_px, values_px, num_labels)
+            for percentile_idx, percentile in enumerate(PERCENTILES):
+                column = f"Intensity_{region}_median" if percentile == 50 else f"Intensity_{region}_p{percentile}"
+                measurements[thekey][column] = label_percentiles[:, percentile_idx]
+        
+        # centroid of the nucleus
+        if features and (region == 'nucleus'):
+            rows, cols = np.divmod(pixel_index, mask.shape[1])
+            centroid_row = with_all(np.bincount(labels_px, weights=rows, minlength=num_labels+1), label_counts)
+            centroid_col = with_all(np.bincount(labels_px, weights=cols, minlength=num_labels+1), label_counts)
+            for thekey in channel_frames:
+                measurements[thekey]['Centroid_row'], measurements[thekey]['Centroid_col'] = centroid_row, centroid_col
+    
+    if cells is not None:
+        cells_index = np.append(np.asarray(cells, dtype=np.int64)-1, num_labels)
+        measurements = {thekey: {column: values[cells_index] for column, values in measurements_key.items()} 
+                            for thekey, measurements_key in measurements.items()}
+    
+    return measurements
 
-    # Convert to dataframe    
-    df_intensities = pd.DataFrame(thedata)
+# Function to measure intensities for both nucleus and cytoplasm in one frame
+def measure_intensities_frame(current_image, nucleus_mask, cytoplasm_mask, num_labels, features=False, cells=None):
+    '''
+    Measurements of one channel in one frame (see measure_intensities_frame_channels).
+    Returns a dict {column: array of num_labels+1 values}, or of the given cells and 'all'.
+    '''
+    
+    return measure_intensities_frame_channels({None: current_image}, nucleus_mask, cytoplasm_mask, num_labels, features=features, cells=cells)[None]
+
+def intensities_to_df(time_indices, cells_per_frame, measurements):
+    '''
+    Convert the measurements of frames (list with the dicts of one key of measure_intensities_frame_channels,
+    for the cells in cells_per_frame) to a dataframe, with per frame a row for each 
+    of its cells, then 'all'
+    {'Frame': .., 'Cell': .., 'Intensity_nucleus': .., 'Intensity_cytoplasm': .., ..}
+    '''
+    
+    df_intensities = pd.DataFrame({
+        "Frame": np.repeat(np.asarray(time_indices, dtype=int), [len(cells)+1 for cells in cells_per_frame]).astype(int),
+        "Cell": [cell for cells in cells_per_frame for cell in [str(cell_lbl) for cell_lbl in cells] + ['all']],
+        })
+    columns = list(measurements[0].keys()) if len(measurements) > 0 else ["Intensity_nucleus", "Intensity_cytoplasm"]
+    for column in columns:
+        df_intensities[column] = np.concatenate([measurements_frame[column] for measurements_frame in measurements]) if len(measurements) > 0 else []
     
     return df_intensities
 
+# Function to measure intensities for both nucleus and cytoplasm for all time points, for multiple channels
+def measure_intensities_for_all_timepoints_channels(channel_stacks, nucleus_masks_tracked, cytoplasm_masks_tracked, features=False, df_tracks=None, background_levels=None):
+    '''
+    Measure the mean nuclear and cytoplasmic intensity of each cell in each 
+    frame in which it is present, plus an 'all' row per frame with the 
+    mean over all nuclei and all cytoplasm rings, for each channel in 
+    channel_stacks ({key: T,Y,X stack}). Optionally, background_levels 
+    ({key: level per frame}) are subtracted.
+    With features=True, also areas, integrated intensities, centroids
+    and percentiles (see measure_intensities_frame_channels).
+    
+    The present (frame, cell) pairs are taken from the track table df_tracks
+    (see TRseg.track_table, determined from the masks if not given), such 
+    that cells are not reported in frames where they are absent.
+    Each frame of the masks is indexed once, and all channels are reduced
+    over this index (labeled reductions, see measure_intensities_frame_channels).
+    Returns a dict {key: dataframe}.
+    '''
+    
+    num_frames = nucleus_masks_tracked.shape[0]
+    if df_tracks is None:
+        df_tracks = TRseg.track_table(nucleus_masks_tracked)
+    cells_per_frame = TRseg.cells_per_frame(df_tracks, num_frames)
+    num_labels = int(df_tracks['Cell'].max()) if len(df_tracks) > 0 else 0
+    
+    # Collect the measurements per frame, with the values of the present cells followed by the 'all' value
+    measurements = [measure_intensities_frame_channels({thekey: channel_stack[time_index] for thekey, channel_stack in channel_stacks.items()}, 
+                                                       nucleus_masks_tracked[time_index], cytoplasm_masks_tracked[time_index], num_labels, 
+                                                       features=features, cells=cells_per_frame[time_index],
+                                                       background_levels={thekey: levels[time_index] for thekey, levels in background_levels.items()} 
+                                                            if background_levels is not None else None)
+                        for time_index in range(num_frames)]
+    
+    return {thekey: intensities_to_df(range(num_frames), cells_per_frame, [measurements_frame[thekey] for measurements_frame in measurements]) 
+                for thekey in channel_stacks}
+
+# Function to measure intensities for both nucleus and cytoplasm for all time points
+def measure_intensities_for_all_timepoints(image_stack_intensity, nucleus_masks_tracked, cytoplasm_masks_tracked, features=False, df_tracks=None):
+    '''
+    Measurements of one channel in all frames (see measure_intensities_for_all_timepoints_channels), 
+    returns a dataframe.
+    '''
+    
+    return measure_intensities_for_all_timepoints_channels({None: image_stack_intensity}, nucleus_masks_tracked, cytoplasm_masks_tracked, 
+                                                           features=features, df_tracks=df_tracks)[None]
+
 
 
 # Function to save intensities to CSV
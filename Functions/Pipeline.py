@@ -0,0 +1,1051 @@
+################################################################################
+
+# Translocation reporter analysis pipeline
+#
+# The pipeline can be run from python:
+#
+#   import Functions.Pipeline as TRpipe
+#   result = TRpipe.run_pipeline({'input_folder': '/input/folder/path/', 
+#                                 'output_folder': '/output/folder/path/',
+#                                 'mapping_channels': {'nucleus': 0, 'ERK': 1, 'PKA': 2}})
+#
+# or from the command line with analyze_transl_rep.py. The settings are listed
+# in DEFAULT_SETTINGS.
+#
+# Expected tiff file input: time-lapse stacks with channels, of which the axis
+# order is taken from the OME/ImageJ metadata (see TRread.to_pipeline_axes);
+# without metadata, num_timepoints, num_channels, height, width is assumed.
+# Each series (position) of a multi-position file is a separate sample.
+
+################################################################################
+
+import os
+import json
+import time
+import traceback
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import Functions.Segmentation as TRseg # Segmentation & tracking functions
+import Functions.Intensity_measurements as TRmeas
+import Functions.Image_corrections as TRcorrect
+import Functions.Image_reading as TRread
+import Functions.Caching as TRcache
+import Functions.Results_store as TRstore
+import Functions.Run_report as TRreport
+import Functions.Tiling as TRtile
+import Functions.Sharding as TRshard
+# Functions.Plotting (matplotlib, seaborn) is only imported when plots are made, see plot_sample
+
+# Data type of the label masks (nucleus and cytoplasm); files with more 
+# than 65535 labels get uint32 masks (see TRseg.mask_dtype)
+MASK_DTYPE = np.uint16
+
+# All settings of the pipeline, with their default values. input_folder, 
+# output_folder and mapping_channels (e.g. {'nucleus': 0, 'PKA': 1}) have to be given.
+DEFAULT_SETTINGS = {
+    'input_folder': None,
+    'output_folder': None,
+    'mapping_channels': None,
+    'auto_background_correction': False,
+    'num_workers': 1,                 # files processed in parallel
+    'num_segmentation_workers': 1,    # frames segmented in parallel
+    'lazy_reading': False,            # read frames only when needed, keep masks on disk
+    'cache_dir': None,                # cache for the masks
+    'cache_size_gb': 10.0,
+    'watch': False,                   # keep watching the input folder for new files
+    'watch_interval': 10.0,
+    'watch_timeout': None,
+    'shard': False,                   # sharded batch: one of several workers on the same files (see shard_worker)
+    'manifest': None,                 # file with the input files to process (sharded batch, implies shard)
+    'shard_lock_timeout': 600.0,      # seconds after which the claim of a worker that stopped is taken over
+    'output_format': 'parquet',       # parquet|csv
+    'excel': False,                   # also export all results to ALL_results.xlsx
+    'static_stage': False,            # background region once per file instead of per frame
+    'plots': 'now',                   # now|later|off
+    'rasterize_labels': False,
+    'quantile_bands': False,
+    'stream': False,                  # process files frame by frame
+    'features': False,                # also measure areas, centroids and intensity percentiles per cell
+    'export_masks': False,            # export the tracked masks (see TRstore.export_masks)
+    'masks_from': None,               # output folder of a run with export_masks: measure with its masks, without segmenting
+    # Parameters for nucleus segmentation (TRseg.segment_nucleus) and the 
+    # cytoplasm rings (TRseg.create_cytoplasm_roi); the defaults of these functions
+    # are used for parameters that are not given here
+    'segmentation_parameters': {},
+    # Tracking: 'overlap' (TRseg.track_nuclei) or 'centroid' (TRseg.CentroidTracker, which 
+    # closes gaps and gives new nuclei new labels), with the parameters of the centroid tracker
+    'tracking_method': 'overlap',
+    'tracking_parameters': {},
+    # Tiled processing of very large frames (see Functions/Tiling.py): segmentation,
+    # cytoplasm rings and background detection in tiles of tile_size x tile_size pixels 
+    # (in parallel with num_segmentation_workers), with tile_overlap pixels of overlap
+    'tile_size': None,
+    'tile_overlap': 64,
+    'cytoplasm_parameters': {'dilation_radius': 5, 'margin_radius': 0},
+    # Parameters for automatic background correction (TRcorrect.determine_background_levels)
+    'background_parameters': {'ESTIMATED_OBJECT_RADIUS': 30},
+    }
+
+def read_config(config_path):
+    '''
+    Read settings from a json or toml file (toml needs python 3.11+), 
+    with the keys of DEFAULT_SETTINGS, e.g.
+        {"input_folder": "/input/folder/path/", "output_folder": "/output/folder/path/",
+         "mapping_channels": {"nucleus": 0, "ERK": 1, "PKA": 2}, "num_workers": 4}
+    '''
+    
+    if config_path.endswith('.toml'):
+        import tomllib
+        with open(config_path, 'rb') as f:
+            return tomllib.load(f)
+    
+    with open(config_path) as f:
+        return json.load(f)
+
+def make_settings(config):
+    '''
+    Complete the settings given in config (a dict, or the path of a config 
+    file, see read_config) with the default values (DEFAULT_SETTINGS).
+    '''
+    
+    if isinstance(config, str):
+        config = read_config(config)
+    
+    unknown_settings = set(config) - set(DEFAULT_SETTINGS)
+    if len(unknown_settings) > 0:
+        raise ValueError(f"Unknown setting(s): {', '.join(sorted(unknown_settings))}")
+    
+    settings = {**DEFAULT_SETTINGS, **config}
+    settings['mapping_channels'] = {thekey: int(channel) for thekey, channel in settings['mapping_channels'].items()} \
+                                        if settings['mapping_channels'] is not None else None
+    if settings['plots'] not in ['now', 'later', 'off']:
+        raise ValueError(f"Unknown plots option {settings['plots']}, should be now, later or off")
+    if settings['tracking_method'] not in ['overlap', 'centroid']:
+        raise ValueError(f"Unknown tracking method {settings['tracking_method']}, should be overlap or centroid")
+    
+    return settings
+
+######################################################################
+# Functions that constitute the pipeline
+# (More sophisticated functions are in other files)
+######################################################################
+
+
+# Per-frame steps, shared by the batch (process_file) and streaming (process_file_streaming) modes
+
+def segment_nucleus_frame(image, segmentation_parameters={}, tile_size=None, tile_overlap=64, num_workers=1, out=None):
+    '''
+    Segment the nuclei in one frame: the whole frame (TRseg.segment_nucleus), or 
+    in tiles of tile_size (TRtile.segment_nucleus_tiled, num_workers tiles in parallel).
+    The labels are written in out if given (OverflowError if they don't fit, see
+    TRseg.store_labels), otherwise they're returned.
+    '''
+    
+    if tile_size is not None:
+        return TRtile.segment_nucleus_tiled(image, tile_size=tile_size, tile_overlap=tile_overlap, num_workers=num_workers, 
+                                            out=out, **segmentation_parameters)
+    nucleus_mask = TRseg.segment_nucleus(image, **segmentation_parameters)
+    if out is None:
+        return nucleus_mask
+    TRseg.store_labels(out, Ellipsis, nucleus_mask)
+    
+    return out
+
+def create_cytoplasm_frame(nucleus_mask, cytoplasm_parameters={}, tile_size=None, tile_overlap=64, num_workers=1, out=None):
+    '''
+    The cytoplasm rings of the (tracked) nuclei in one frame: for the whole frame 
+    (TRseg.create_cytoplasm_roi), or in tiles (TRtile.create_cytoplasm_roi_tiled).
+    The rings are written in out if given, otherwise they're returned.
+    '''
+    
+    if tile_size is not None:
+        return TRtile.create_cytoplasm_roi_tiled(nucleus_mask, tile_size=tile_size, tile_overlap=tile_overlap, num_workers=num_workers, 
+                                                 out=out, **cytoplasm_parameters)
+    cytoplasm_mask = TRseg.create_cytoplasm_roi(nucleus_mask, **cytoplasm_parameters) # tracked in is tracked out :)
+    if out is None:
+        return cytoplasm_mask
+    out[...] = cytoplasm_mask
+    
+    return out
+
+def add_result_columns(df_current, thekey, file_name):
+    '''Add the cytoplasm/nucleus ratio, the key and the sample to the measurements of one key.'''
+    
+    # Calculate cyto/nucleus ratio
+    df_current['Ratio_cytoplasm_div_nucleus'] = df_current['Intensity_cytoplasm']/df_current['Intensity_nucleus']
+    # Add key to the df
+    df_current['Key'] = thekey
+    # Add sample filename to df
+    df_current['Sample'] = file_name
+    
+    return df_current
+
+
+def segment_and_track_nuclei(imgstack_nucleus, num_segmentation_workers=1, masks_on_disk=False, segmentation_parameters={}, run_report=None, 
+                             tracking_method='overlap', tracking_parameters={}, tile_size=None, tile_overlap=64, keep_preliminary=False):
+    # imgstack_nucleus = image_stack[:, nuclear_channel]
+    # Returns the tracked masks, and the preliminary (untracked) masks if keep_preliminary 
+    # (otherwise None, the nuclei are tracked in place)
+    
+    # segmentation and tracking are recorded as separate stages in the run report
+    if run_report is None:
+        run_report = TRreport.RunReport()
+    
+    # the mask stacks are created up front and filled frame by frame 
+    # (optionally on disk, such that they don't need to fit in memory)
+    # as uint16; only if there are more labels than fit, they're done again as uint32
+    def segment_into(nucleus_masks_preliminary):
+        if tile_size is not None:
+            for frm in range(len(nucleus_masks_preliminary)):
+                segment_nucleus_frame(imgstack_nucleus[frm], segmentation_parameters, tile_size=tile_size, tile_overlap=tile_overlap, 
+                                      num_workers=num_segmentation_workers, out=nucleus_masks_preliminary[frm])
+        else:
+            TRseg.segment_nuclei_stack(imgstack_nucleus, num_workers=num_segmentation_workers, out=nucleus_masks_preliminary, **segmentation_parameters)
+        return nucleus_masks_preliminary
+
+    # segment the nuclei (frames are independent, so this can be done in parallel)
+    # for very large frames, each frame is segmented in tiles instead, and the tiles are done in parallel
+    with run_report.stage('segmentation'):
+        try:
+            nucleus_masks_preliminary = segment_into(TRread.allocate_stack(imgstack_nucleus.shape, MASK_DTYPE, on_disk=masks_on_disk))
+        except OverflowError:
+            nucleus_masks_preliminary = segment_into(TRread.allocate_stack(imgstack_nucleus.shape, np.uint32, on_disk=masks_on_disk))
+
+    # For frames t>0, make the labeling consistent with frame t=0
+    # The updated labeling is stored in nucleus_masks_tracked.
+    # To create new labels for a frame, updated information is necessary,
+    # therefor, each frm+1 frame is constructed based nucleus_masks_tracked[frm]
+    # and nucleus_masks_preliminary[frm+1].
+    # With tracking_method='centroid', nuclei are linked by their centroids instead
+    # (see TRseg.CentroidTracker).
+    # Unless keep_preliminary, the tracked masks overwrite the preliminary masks
+    # (frame frm+1 is only needed until it's tracked), such that there's one mask stack.
+    with run_report.stage('tracking'):
+        nucleus_masks_tracked = TRread.allocate_stack(imgstack_nucleus.shape, nucleus_masks_preliminary.dtype, on_disk=masks_on_disk) \
+                                    if keep_preliminary else nucleus_masks_preliminary
+        tracker = TRseg.CentroidTracker(**tracking_parameters) if tracking_method == 'centroid' else None
+        for frm in range(len(nucleus_masks_preliminary)):
+            if tracker is not None:
+                mask_tracked, _ = tracker.link(nucleus_masks_preliminary[frm])
+            elif frm == 0:
+                mask_tracked = nucleus_masks_preliminary[0]
+            else:
+                mask_tracked, _ = TRseg.track_nuclei(nucleus_masks_tracked[frm-1], nucleus_masks_preliminary[frm])
+            try:
+                TRseg.store_labels(nucleus_masks_tracked, frm, mask_tracked)
+            except OverflowError:
+                # the centroid tracker gives new nuclei new labels, which can outgrow uint16
+                nucleus_masks_tracked = TRread.promote_stack(nucleus_masks_tracked, np.uint32)
+                nucleus_masks_tracked[frm] = mask_tracked
+    
+    return nucleus_masks_tracked, nucleus_masks_preliminary if keep_preliminary else None
+
+
+def create_cytoplasm_masks(nucleus_masks_tracked, dilation_radius=5, margin_radius=0, masks_on_disk=False, tile_size=None, tile_overlap=64, num_workers=1):
+    
+    cytoplasm_masks_tracked = TRread.allocate_stack(nucleus_masks_tracked.shape, nucleus_masks_tracked.dtype, on_disk=masks_on_disk)
+    for frm in range(len(nucleus_masks_tracked)):
+        create_cytoplasm_frame(nucleus_masks_tracked[frm], {'dilation_radius': dilation_radius, 'margin_radius': margin_radius}, 
+                               tile_size=tile_size, tile_overlap=tile_overlap, num_workers=num_workers, out=cytoplasm_masks_tracked[frm])
+
+    return cytoplasm_masks_tracked
+
+
+def calculate_intensity_values_to_dfs(MAPPING_CHANNELS, keys, image_stack, nucleus_masks_tracked, cytoplasm_masks_tracked, file_name, df_background=None, features=False, df_tracks=None):
+    '''
+    Measure the intensities of the channels of the given keys, all channels
+    at once (the masks are indexed once per frame, see 
+    TRmeas.measure_intensities_for_all_timepoints_channels). If df_background
+    (the background level of each key and frame, see TRcorrect.determine_background_levels)
+    is given, the background is subtracted. With features=True, also the areas, 
+    centroids and intensity percentiles per cell (see TRmeas.measure_intensities_frame_channels).
+    Cells are measured in the frames where they are present (see TRseg.track_table).
+    Returns a dict {key: dataframe}.
+    '''
+    
+    channel_stacks = {thekey: image_stack[:, MAPPING_CHANNELS[thekey]] for thekey in keys}
+    background_levels = {thekey: df_background.loc[df_background['Key']==thekey, 'Background'].values for thekey in keys} \
+                            if df_background is not None else None
+    
+    # Determine the intensity values for all timepoints
+    dfs_current = TRmeas.measure_intensities_for_all_timepoints_channels(channel_stacks, nucleus_masks_tracked, cytoplasm_masks_tracked, 
+                                                                         features=features, df_tracks=df_tracks, background_levels=background_levels)
+    
+    for thekey, df_current in dfs_current.items():
+        add_result_columns(df_current, thekey, file_name)
+    
+    return dfs_current
+
+def check_masks_shape(masks_stack, image_stack):
+    '''Raise an error if exported masks (see TRstore.read_masks) don't match the image stack.'''
+    
+    if (masks_stack.shape[0] != image_stack.shape[0]) or (tuple(masks_stack.shape[2:]) != tuple(image_stack.shape[2:])):
+        raise ValueError(f"The masks ({masks_stack.shape[0]} frames of {masks_stack.shape[2:]}) don't match the "
+                         f"image stack ({image_stack.shape[0]} frames of {image_stack.shape[2:]})")
+
+def process_file(file_path, settings, run_report=None, series=0, sample=None):
+    '''
+    Analyze a single tif file (or one series/position of a multi-position file,
+    see TRread.list_positions): segment and track the nuclei, create the 
+    cytoplasm rings, measure the intensities for each channel and write
+    the results per channel (see TRstore.write_results).
+    With settings['masks_from'], the masks exported by an earlier run 
+    (settings['export_masks'], see TRstore.export_masks) are measured instead, 
+    e.g. with other reporter channels or background settings.
+    settings is the dict returned by make_settings.
+    The time and memory used per stage are recorded in run_report (a 
+    TRreport.RunReport), if given.
+    Returns the sample name (by default the file name without extension).
+    '''
+    # file_path = file_paths[0]
+    
+    output_folder    = settings['output_folder']
+    MAPPING_CHANNELS = settings['mapping_channels']
+    file_name = sample if sample is not None else TRread.sample_name(file_path) # used further down
+    if run_report is None:
+        run_report = TRreport.RunReport(file_name)
+    
+    # Streaming mode, each frame is processed completely before the next one
+    if settings['stream']:
+        return process_file_streaming(file_path, settings, run_report, series=series, sample=file_name)
+    
+    # Read current file (with lazy_reading, frames are only read when needed)
+    print(f"Processing sample {file_name} of file: {file_path}")
+    with run_report.stage('read'):
+        image_stack = TRread.read_image_stack(file_path, lazy=settings['lazy_reading'], series=series)
+    nuclear_channel = MAPPING_CHANNELS['nucleus']
+
+    # With masks_from, the masks exported by an earlier run are used (see TRstore.export_masks), 
+    # frames are read from the file when needed; there's no segmentation, tracking or cache
+    masks_stack = None
+    if settings['masks_from'] is not None:
+        with run_report.stage('read_masks'):
+            masks_stack = TRstore.read_masks(settings['masks_from'], file_name)
+            check_masks_shape(masks_stack, image_stack)
+            nucleus_masks_tracked, cytoplasm_masks_tracked = masks_stack[:, 0], masks_stack[:, 1]
+
+    # Optionally, take the masks from the cache, if this file was analyzed before with the same settings
+    # (the key is based on the file content, nuclear channel and segmentation/cytoplasm parameters)
+    masks_from_cache = False
+    if (settings['cache_dir'] is not None) and (masks_stack is None):
+        with run_report.stage('cache_load'):
+            key = TRcache.cache_key(TRcache.file_content_hash(file_path), series, nuclear_channel, 
+                                    {**TRcache.function_parameters(TRseg.segment_nucleus, settings['segmentation_parameters']), 
+                                     **({'tile_size': settings['tile_size'], 'tile_overlap': settings['tile_overlap']} if settings['tile_size'] is not None else {})},
+                                    TRcache.function_parameters(TRseg.create_cytoplasm_roi, settings['cytoplasm_parameters']),
+                                    {'method': settings['tracking_method'], **TRcache.function_parameters(TRseg.CentroidTracker, settings['tracking_parameters'])})
+            mask_shape = (image_stack.shape[0],) + tuple(image_stack.shape[2:])
+            mask_dtype = TRcache.cached_mask_dtype(settings['cache_dir'], key) or MASK_DTYPE
+            nucleus_masks_tracked   = TRread.allocate_stack(mask_shape, mask_dtype, on_disk=settings['lazy_reading'])
+            cytoplasm_masks_tracked = TRread.allocate_stack(mask_shape, mask_dtype, on_disk=settings['lazy_reading'])
+            masks_from_cache = TRcache.load_masks(settings['cache_dir'], key, nucleus_masks_tracked, cytoplasm_masks_tracked)
+        if masks_from_cache:
+            print(f"Using cached masks for file: {file_path}")
+    
+    if (masks_stack is None) and not masks_from_cache:
+        
+        # Segment the nuclei and track them such that labels are consistent throughout segmentation
+        nucleus_masks_tracked, _ = segment_and_track_nuclei(image_stack[:, nuclear_channel], 
+                                                                num_segmentation_workers=settings['num_segmentation_workers'], masks_on_disk=settings['lazy_reading'],
+                                                                segmentation_parameters=settings['segmentation_parameters'], run_report=run_report,
+                                                                tracking_method=settings['tracking_method'], tracking_parameters=settings['tracking_parameters'],
+                                                                tile_size=settings['tile_size'], tile_overlap=settings['tile_overlap'])
+
+        # Create the cytoplasmic regions (regions of interest, ROI)
+        with run_report.stage('cytoplasm'):
+            cytoplasm_masks_tracked = create_cytoplasm_masks(nucleus_masks_tracked, masks_on_disk=settings['lazy_reading'], tile_size=settings['tile_size'], 
+                                                             tile_overlap=settings['tile_overlap'], num_workers=settings['num_segmentation_workers'], 
+                                                             **settings['cytoplasm_parameters'])
+        
+        if settings['cache_dir'] is not None:
+            with run_report.stage('cache_store'):
+                TRcache.store_masks(settings['cache_dir'], key, nucleus_masks_tracked, cytoplasm_masks_tracked, max_size_gb=settings['cache_size_gb'])
+
+    # Optionally, export the masks, such that they can be reused (masks_from)
+    if settings['export_masks'] and (masks_stack is None):
+        with run_report.stage('export_masks'):
+            TRstore.export_masks(output_folder, file_name, nucleus_masks_tracked, cytoplasm_masks_tracked)
+    
+    # Which cells are present in which frame, such that only these are measured and reported
+    with run_report.stage('track_table'):
+        df_tracks = TRseg.track_table(nucleus_masks_tracked)
+    run_report.set_counts(num_frames=image_stack.shape[0], num_cells=df_tracks['Cell'].nunique())
+
+    # Save the first N frames of the masks, such that the segmentation, tracking and rings 
+    # can be plotted in the plotting stage (see plot_sample)
+    if settings['plots'] != 'off':
+        with run_report.stage('save_label_frames'):
+            TRstore.save_label_frames(output_folder, file_name, nucleus_masks_tracked, cytoplasm_masks_tracked)
+
+    keys_to_plot = [key for key in list(MAPPING_CHANNELS.keys()) if not (key=='nucleus')]
+    
+    # Optional, background correction
+    # the background levels of all channels are determined at once, and saved such that they can be checked
+    if settings['auto_background_correction']:
+        with run_report.stage('background'):
+            df_background = TRcorrect.determine_background_levels({thekey: image_stack[:, MAPPING_CHANNELS[thekey]] for thekey in keys_to_plot}, 
+                                                                  static_stage=settings['static_stage'], tile_size=settings['tile_size'], 
+                                                                  num_workers=settings['num_segmentation_workers'], **settings['background_parameters'])
+            df_background['Sample'] = file_name
+            df_background.to_csv(os.path.join(output_folder, f"{file_name}_background_levels.csv"), index=False)
+
+    # Calculate the intensities (and ratios) for both, for all channels at once
+    with run_report.stage('measurement'):
+        dfs_current = calculate_intensity_values_to_dfs(MAPPING_CHANNELS, keys_to_plot, image_stack, nucleus_masks_tracked, cytoplasm_masks_tracked, file_name, 
+                                                        df_background=df_background if settings['auto_background_correction'] else None, 
+                                                        features=settings['features'], df_tracks=df_tracks)
+    
+    # export the dfs per channel
+    for thekey in keys_to_plot: # thekey = keys_to_plot[1]
+        with run_report.stage('export', key=thekey):
+            TRstore.write_results(output_folder, dfs_current.pop(thekey), settings['output_format'])
+    
+    if isinstance(image_stack, TRread.LazyImageStack):
+        image_stack.close()
+    if masks_stack is not None:
+        masks_stack.close()
+    
+    return file_name
+
+def process_file_streaming(file_path, settings, run_report=None, series=0, sample=None):
+    '''
+    Analyze a single tif file frame by frame: each frame is read, segmented,
+    tracked (with the previous tracked frame), its cytoplasm rings created and 
+    measured for all keys, and the rows are written right away (see 
+    TRstore.ResultsWriter). The memory use doesn't grow with the number of 
+    frames, and the first results appear right away.
+    
+    Differences with process_file: the cache isn't used, and frames are 
+    segmented one at a time. With settings['masks_from'], the frames of the
+    exported masks are read instead; with settings['export_masks'], the masks
+    are collected in temporary files on disk and exported at the end.
+    Returns the sample name (by default the file name without extension).
+    '''
+    
+    output_folder    = settings['output_folder']
+    MAPPING_CHANNELS = settings['mapping_channels']
+    file_name = sample if sample is not None else TRread.sample_name(file_path)
+    if run_report is None:
+        run_report = TRreport.RunReport(file_name)
+    if settings['cache_dir'] is not None:
+        print('Note: the cache is not used in streaming mode')
+    
+    # Frames are always read when needed
+    print(f"Processing sample {file_name} of file (streaming): {file_path}")
+    with run_report.stage('read'):
+        image_stack = TRread.read_image_stack(file_path, lazy=True, series=series)
+    num_frames = image_stack.shape[0]
+    nuclear_channel = MAPPING_CHANNELS['nucleus']
+    keys_to_plot = [key for key in list(MAPPING_CHANNELS.keys()) if not (key=='nucleus')]
+    
+    # For a static stage, the background box is determined first (one pass over the frames)
+    background_bbox_coords = None
+    if settings['auto_background_correction'] and settings['static_stage']:
+        with run_report.stage('background'):
+            background_bbox_coords = TRcorrect.static_background_bbox({thekey: image_stack[:, MAPPING_CHANNELS[thekey]] for thekey in keys_to_plot}, 
+                                                                      tile_size=settings['tile_size'], num_workers=settings['num_segmentation_workers'], 
+                                                                      **settings['background_parameters'])
+    
+    results_writers = {thekey: TRstore.ResultsWriter(output_folder, file_name, thekey, settings['output_format']) for thekey in keys_to_plot}
+    background_levels = []
+    label_frames_nucleus, label_frames_cytoplasm = [], []
+    cells_seen = np.empty(0, dtype=int)
+    nucleus_mask_previous = None
+    tracker = TRseg.CentroidTracker(**settings['tracking_parameters']) if settings['tracking_method'] == 'centroid' else None
+    
+    # With masks_from, the frames of the exported masks are used instead of segmenting (see process_file);
+    # with export_masks, the masks are collected on disk and exported at the end
+    masks_stack, nucleus_masks_export, cytoplasm_masks_export = None, None, None
+    if settings['masks_from'] is not None:
+        with run_report.stage('read_masks'):
+            masks_stack = TRstore.read_masks(settings['masks_from'], file_name)
+            check_masks_shape(masks_stack, image_stack)
+    elif settings['export_masks']:
+        mask_shape = (num_frames,) + tuple(image_stack.shape[2:])
+        nucleus_masks_export   = TRread.allocate_stack(mask_shape, MASK_DTYPE, on_disk=True)
+        cytoplasm_masks_export = TRread.allocate_stack(mask_shape, MASK_DTYPE, on_disk=True)
+    
+    for time_index in range(num_frames):
+        
+        if masks_stack is not None:
+            with run_report.stage('read_masks', accumulate=True):
+                nucleus_mask, cytoplasm_mask = masks_stack[time_index, 0], masks_stack[time_index, 1]
+        else:
+            # segment and track (only the previous tracked frame is needed)
+            with run_report.stage('segmentation', accumulate=True):
+                nucleus_mask = segment_nucleus_frame(image_stack[time_index, nuclear_channel], settings['segmentation_parameters'], tile_size=settings['tile_size'], 
+                                                     tile_overlap=settings['tile_overlap'], num_workers=settings['num_segmentation_workers'])
+            with run_report.stage('tracking', accumulate=True):
+                if tracker is not None:
+                    nucleus_mask, _ = tracker.link(nucleus_mask)
+                elif nucleus_mask_previous is not None:
+                    nucleus_mask, _ = TRseg.track_nuclei(nucleus_mask_previous, nucleus_mask)
+            nucleus_mask_previous = nucleus_mask
+            with run_report.stage('cytoplasm', accumulate=True):
+                cytoplasm_mask = create_cytoplasm_frame(nucleus_mask, settings['cytoplasm_parameters'], tile_size=settings['tile_size'], 
+                                                        tile_overlap=settings['tile_overlap'], num_workers=settings['num_segmentation_workers'])
+        
+        # the cells in this frame (see TRseg.track_table)
+        cells = TRseg.present_labels(nucleus_mask)
+        cells_seen = np.union1d(cells_seen, cells)
+        
+        if nucleus_masks_export is not None:
+            with run_report.stage('export_masks', accumulate=True):
+                try:
+                    TRseg.store_labels(nucleus_masks_export, time_index, nucleus_mask)
+                except OverflowError:
+                    # the cytoplasm has the labels of the nuclei, so both are promoted
+                    nucleus_masks_export   = TRread.promote_stack(nucleus_masks_export, np.uint32)
+                    cytoplasm_masks_export = TRread.promote_stack(cytoplasm_masks_export, np.uint32)
+                    nucleus_masks_export[time_index] = nucleus_mask
+                cytoplasm_masks_export[time_index] = cytoplasm_mask
+        
+        # keep the first N frames for the label plots
+        if (settings['plots'] != 'off') and (time_index < TRstore.LABEL_PLOT_FRAMES):
+            label_frames_nucleus.append(nucleus_mask)
+            label_frames_cytoplasm.append(cytoplasm_mask)
+        
+        channel_frames = {thekey: image_stack[time_index, MAPPING_CHANNELS[thekey]] for thekey in keys_to_plot}
+        background_levels_frame = None
+        if settings['auto_background_correction']:
+            with run_report.stage('background', accumulate=True):
+                background_levels_current = TRcorrect.background_levels_frame(channel_frames, time_index, background_bbox_coords=background_bbox_coords, 
+                                                                              tile_size=settings['tile_size'], num_workers=settings['num_segmentation_workers'], 
+                                                                              **settings['background_parameters'])
+            background_levels += background_levels_current
+            background_levels_frame = {row['Key']: row['Background'] for row in background_levels_current}
+        
+        # measure all keys at once, and write the rows of this frame
+        with run_report.stage('measurement', accumulate=True):
+            measurements = TRmeas.measure_intensities_frame_channels(channel_frames, nucleus_mask, cytoplasm_mask, int(cells[-1]) if len(cells) > 0 else 0, 
+                                                                     features=settings['features'], cells=cells, background_levels=background_levels_frame)
+        for thekey in keys_to_plot:
+            with run_report.stage('measurement', accumulate=True):
+                df_current = add_result_columns(TRmeas.intensities_to_df([time_index], [cells], [measurements[thekey]]), thekey, file_name)
+            with run_report.stage('export', key=thekey, accumulate=True):
+                results_writers[thekey].write(df_current)
+    
+    for thekey in keys_to_plot:
+        with run_report.stage('export', key=thekey, accumulate=True):
+            results_writers[thekey].close()
+    image_stack.close()
+    if masks_stack is not None:
+        masks_stack.close()
+    if nucleus_masks_export is not None:
+        with run_report.stage('export_masks', accumulate=True):
+            TRstore.export_masks(output_folder, file_name, nucleus_masks_export, cytoplasm_masks_export)
+    
+    if settings['auto_background_correction']:
+        df_background = pd.DataFrame(background_levels)
+        df_background['Sample'] = file_name
+        df_background.to_csv(os.path.join(output_folder, f"{file_name}_background_levels.csv"), index=False)
+    if settings['plots'] != 'off':
+        with run_report.stage('save_label_frames'):
+            TRstore.save_label_frames(output_folder, file_name, label_frames_nucleus, label_frames_cytoplasm)
+    run_report.set_counts(num_frames=num_frames, num_cells=len(cells_seen))
+    
+    return file_name
+
+def process_file_catch_errors(file_path, settings, series=0, sample=None):
+    '''
+    Wrapper around process_file, such that a failing file doesn't abort 
+    the whole batch. Returns the sample name (None if failed), the run 
+    report records (see TRreport.RunReport) and the error message 
+    (None if successful).
+    '''
+    
+    run_report = TRreport.RunReport(sample if sample is not None else TRread.sample_name(file_path))
+    try:
+        return process_file(file_path, settings, run_report, series=series, sample=sample), run_report.records, None
+    except Exception:
+        return None, run_report.records, traceback.format_exc()
+
+def list_file_positions(file_paths):
+    '''
+    The positions (series) in the files, as a list of (file_path, series, sample),
+    and a dict {file_path: error message} of files that can't be opened.
+    '''
+    
+    positions = []
+    unreadable_files = {}
+    for file_path in file_paths:
+        try:
+            positions += [(file_path, position['series'], position['sample']) for position in TRread.list_positions(file_path)]
+        except Exception:
+            unreadable_files[file_path] = traceback.format_exc()
+    
+    return positions, unreadable_files
+        
+def process_files(file_paths, settings):
+    '''
+    Process a list of files, in parallel if settings['num_workers'] > 1.
+    Each position (series) in a file is a separate sample, and is processed
+    separately (in parallel), reading directly from the file.
+    Failures are reported per sample, and don't stop the other samples.
+    Returns a dict {file_path: [sample names]} of the successful samples, 
+    a list of the files of which (some) samples failed, and the run report 
+    records of all samples.
+    '''
+    
+    positions, unreadable_files = list_file_positions(file_paths)
+    
+    results_per_position = {}
+    if settings['num_workers'] > 1:
+        with ProcessPoolExecutor(max_workers=settings['num_workers']) as executor:
+            futures = {executor.submit(process_file_catch_errors, file_path, settings, series, sample): (file_path, series, sample) 
+                            for file_path, series, sample in positions}
+            for future in as_completed(futures):
+                results_per_position[futures[future]] = future.result()
+                print(f"Finished sample: {futures[future][2]}")
+    else:
+        for file_path, series, sample in positions:
+            results_per_position[(file_path, series, sample)] = process_file_catch_errors(file_path, settings, series, sample)
+    
+    # report failures per sample
+    samples_per_file = {}
+    failed_files = []
+    run_report_records = []
+    for file_path, error_message in unreadable_files.items():
+        failed_files.append(file_path)
+        print('='*80)
+        print(f"Error reading file: {file_path}\n{error_message}")
+    for file_path, series, sample in positions:
+        sample_result, records, error_message = results_per_position[(file_path, series, sample)]
+        run_report_records += records
+        if error_message is None:
+            samples_per_file.setdefault(file_path, []).append(sample_result)
+        else:
+            if file_path not in failed_files:
+                failed_files.append(file_path)
+            print('='*80)
+            print(f"Error processing sample {sample} of file: {file_path}\n{error_message}")
+    failed_files = [file_path for file_path in file_paths if file_path in failed_files]
+    if len(failed_files) > 0:
+        print('='*80)
+        print(f"{len(failed_files)} of {len(file_paths)} file(s) failed:")
+        for file_path in failed_files:
+            print(f"  {file_path}")
+        print('='*80)
+    
+    return samples_per_file, failed_files, run_report_records
+
+def plot_sample(output_folder, sample, settings, run_report=None):
+    '''
+    Make the plots of a sample: the labels of the first frames (if the 
+    label frames were saved, see TRstore.save_label_frames), and the 
+    intensities from the stored results.
+    '''
+    
+    # imported here, such that matplotlib and seaborn are only loaded when plotting
+    import Functions.Plotting as TRplt
+    
+    if run_report is None:
+        run_report = TRreport.RunReport(sample)
+    
+    nucleus_masks, cytoplasm_masks = TRstore.load_label_frames(output_folder, sample)
+    if nucleus_masks is not None:
+        with run_report.stage('label_plots'):
+            TRplt.plot_labels_framesX(nucleus_masks, range_start=0, range_end=TRstore.LABEL_PLOT_FRAMES, text_xoffset=50, output_folder=output_folder, 
+                                      file_name=sample, suffix='_nuclei', rasterized=settings['rasterize_labels'])
+            TRplt.plot_labels_framesX(cytoplasm_masks, range_start=0, range_end=TRstore.LABEL_PLOT_FRAMES, text_xoffset=50, output_folder=output_folder, 
+                                      file_name=sample, suffix='_cytorings', rasterized=settings['rasterize_labels'])
+    
+    with run_report.stage('sample_plots'):
+        df_sample = TRstore.read_results(output_folder, [sample], settings['output_format'])
+        quantile_band = (0.1, 0.9) if settings['quantile_bands'] else None
+        TRplt.plot_intensity_nuc_cyto(df_sample, output_folder, sample, quantile_band=quantile_band)
+        TRplt.plot_intensity_ratio(df_sample, output_folder, sample, quantile_band=quantile_band)
+
+def plot_sample_catch_errors(output_folder, sample, settings):
+    '''
+    Wrapper around plot_sample, returns the run report records 
+    and the error message (None if successful).
+    '''
+    
+    run_report = TRreport.RunReport(sample)
+    try:
+        plot_sample(output_folder, sample, settings, run_report)
+        return run_report.records, None
+    except Exception:
+        return run_report.records, traceback.format_exc()
+
+def plot_samples(output_folder, samples, settings):
+    '''
+    The plotting stage: make the plots of the samples, in parallel if 
+    settings['num_workers'] > 1. A failing plot is reported, but doesn't
+    affect the results. Returns the run report records.
+    '''
+    
+    results_per_sample = {}
+    if (settings['num_workers'] > 1) and (len(samples) > 1):
+        with ProcessPoolExecutor(max_workers=settings['num_workers']) as executor:
+            futures = {executor.submit(plot_sample_catch_errors, output_folder, sample, settings): sample for sample in samples}
+            for future in as_completed(futures):
+                results_per_sample[futures[future]] = future.result()
+    else:
+        for sample in samples:
+            results_per_sample[sample] = plot_sample_catch_errors(output_folder, sample, settings)
+    
+    run_report_records = []
+    for sample in samples:
+        records, error_message = results_per_sample[sample]
+        run_report_records += records
+        if error_message is not None:
+            print('='*80)
+            print(f"Error plotting sample: {sample}\n{error_message}")
+    
+    return run_report_records
+
+def plot_output_folder(output_folder, settings):
+    '''
+    Make the plots of all samples with results in an output folder, e.g. 
+    after a run with --plots later (settings['output_folder'] is not used).
+    '''
+    
+    run_id = time.strftime('%Y%m%d-%H%M%S')
+    samples = TRstore.list_samples(output_folder, settings['output_format'])
+    print(f"Plotting {len(samples)} sample(s) in {output_folder}")
+    TRreport.write_run_report(output_folder, plot_samples(output_folder, samples, settings), run_id)
+
+def combine_results(output_folder, samples, settings, run_report=None):
+    '''
+    Create the combined outputs from the stored results of the samples: 
+    ALL_results.csv (csv output format only; for parquet the results store 
+    itself is the combined result) and optionally ALL_results.xlsx.
+    '''
+    
+    if run_report is None:
+        run_report = TRreport.RunReport()
+    if settings['output_format'] == 'csv':
+        with run_report.stage('combine_csv'):
+            TRstore.combine_csv(output_folder, samples)
+    if settings['excel']:
+        with run_report.stage('export_excel'):
+            TRstore.export_excel(output_folder, samples, settings['output_format'])
+
+def watch_folder(settings):
+    '''
+    Watch the input folder for new tif files (e.g. while the microscope is 
+    still acquiring), and process each file once it is completely written.
+    Results of new files are added to the results store (and appended to 
+    ALL_results.csv for csv output), and the plots of their sample are made. 
+    Which files were processed is recorded in watch_processed_files.txt in the 
+    output folder, such that after a restart only new files are processed (and
+    files of which the processing was interrupted, their results are removed
+    first; other results in the output folder are kept).
+    Stops after settings['watch_timeout'] seconds without new files (never if None),
+    or with ctrl+c; then ALL_results.xlsx is written (with settings['excel']).
+    The run report (run_report.csv) is updated after each batch of new files.
+    Returns the samples that were processed, and the files that failed.
+    '''
+    
+    input_folder  = settings['input_folder']
+    output_folder = settings['output_folder']
+    state_path   = os.path.join(output_folder, 'watch_processed_files.txt')
+    run_id = time.strftime('%Y%m%d-%H%M%S')
+    
+    # Files processed before, lines are "status<tab>file name<tab>samples..", with status started|ok|failed:
+    # started is recorded before a file is processed (with all its samples), ok or failed after it 
+    # is processed (with the samples that have results); the last line of a file counts
+    # (samples are separated by tabs; older state files have no samples, then the sample is the file name)
+    processed_files = {}
+    samples_per_processed_file = {}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            for line in f.read().splitlines():
+                status, processed_file, *samples = line.split('\t')
+                processed_files[processed_file] = status
+                samples_per_processed_file[processed_file] = samples if len(samples) > 0 else [TRread.sample_name(processed_file)]
+    
+    # If a previous run was interrupted while processing files, remove their (incomplete) results,
+    # these files are processed again. Other results in the output folder are not touched, and
+    # the samples of failed files that have results are kept (as in a batch run).
+    for processed_file, status in list(processed_files.items()):
+        if status == 'started':
+            print(f"Processing of {processed_file} was interrupted, it is processed again")
+            for sample in samples_per_processed_file[processed_file]:
+                TRstore.remove_results(output_folder, sample, settings['output_format'])
+            del processed_files[processed_file]
+    if len(processed_files) > 0:
+        print(f"Watching {input_folder}, {len(processed_files)} file(s) were already processed")
+    samples_processed = [sample for processed_file in processed_files for sample in samples_per_processed_file[processed_file]]
+    # ALL_results.csv has the recorded samples, the results of new files are appended to it
+    if settings['output_format'] == 'csv':
+        TRstore.combine_csv(output_folder, samples_processed)
+    
+    # A file is ready when its size didn't change since the previous check, 
+    # and it is a complete tif file
+    previous_file_sizes = {}
+    time_last_new_file = time.time()
+    try:
+        while True:
+            
+            files_ready = []
+            for file_path in sorted(glob(os.path.join(input_folder, "*.tif"))):
+                if os.path.basename(file_path) in processed_files:
+                    continue
+                file_size = os.path.getsize(file_path)
+                if (previous_file_sizes.get(file_path) == file_size) and TRread.is_complete_tiff(file_path):
+                    files_ready.append(file_path)
+                previous_file_sizes[file_path] = file_size
+            
+            if len(files_ready) > 0:
+                
+                # record the files as started, with their samples (see above)
+                positions, _ = list_file_positions(files_ready)
+                with open(state_path, 'a') as f:
+                    for file_path in files_ready:
+                        samples = [sample for position_file, _, sample in positions if position_file == file_path]
+                        f.write('\t'.join(['started', os.path.basename(file_path)] + samples) + '\n')
+                
+                samples_per_file, failed_files, run_report_records = process_files(files_ready, settings)
+                
+                # plot the new samples
+                if settings['plots'] == 'now':
+                    run_report_records += plot_samples(output_folder, [sample for file_path in files_ready 
+                                                                            for sample in samples_per_file.get(file_path, [])], settings)
+                
+                for file_path in files_ready:
+                    # record file as processed (with the samples that have results)
+                    status = 'failed' if file_path in failed_files else 'ok'
+                    samples = samples_per_file.get(file_path, [])
+                    # append the rows to ALL_results.csv (if the run is interrupted before the file 
+                    # is recorded, ALL_results.csv is combined again at the next start, without them)
+                    if settings['output_format'] == 'csv':
+                        run_report = TRreport.RunReport()
+                        with run_report.stage('combine_csv'):
+                            TRstore.combine_csv(output_folder, samples, append=True)
+                        run_report_records += run_report.records
+                    with open(state_path, 'a') as f:
+                        f.write('\t'.join([status, os.path.basename(file_path)] + samples) + '\n')
+                    processed_files[os.path.basename(file_path)] = status
+                    samples_per_processed_file[os.path.basename(file_path)] = samples
+                TRreport.write_run_report(output_folder, run_report_records, run_id)
+                
+                time_last_new_file = time.time()
+            
+            elif (settings['watch_timeout'] is not None) and (time.time() - time_last_new_file > settings['watch_timeout']):
+                print(f"No new files for {settings['watch_timeout']} seconds, stopping")
+                break
+            
+            time.sleep(settings['watch_interval'])
+    
+    except KeyboardInterrupt:
+        print('Stopped watching')
+    
+    # The excel file is only written at the end, since it can't be appended to
+    samples_processed = [sample for processed_file in processed_files for sample in samples_per_processed_file[processed_file]]
+    if (len(samples_processed) > 0) and settings['excel']:
+        run_report = TRreport.RunReport()
+        with run_report.stage('export_excel'):
+            TRstore.export_excel(output_folder, samples_processed, settings['output_format'])
+        TRreport.write_run_report(output_folder, run_report.records, run_id)
+    
+    return samples_processed, [processed_file for processed_file, status in processed_files.items() if status=='failed']
+
+def shard_status(output_folder):
+    '''
+    The state of a sharded batch (see shard_worker), from the completion
+    markers: the samples with results (in the order of the manifest), the
+    files that failed and the files that are not finished yet.
+    '''
+
+    file_paths, entries = TRshard.recorded_files(output_folder)
+    samples, failed_files, unfinished_files = [], [], []
+    for file_path, entry in zip(file_paths, entries):
+        kind, marker = TRshard.read_marker(output_folder, entry)
+        if kind is None:
+            unfinished_files.append(file_path)
+            continue
+        samples += marker['samples']
+        if kind == 'failed':
+            failed_files.append(file_path)
+
+    return {'samples': samples, 'failed_files': failed_files, 'unfinished_files': unfinished_files}
+
+def merge_shards(output_folder, settings):
+    '''
+    Create the combined results of a sharded batch (see combine_results), from
+    the results of the files that are finished, in the order of the manifest.
+    Can be run at any time (also while workers are still running, then only
+    the finished files are included); the worker that finishes the last file 
+    does this automatically.
+    settings['output_folder'] is not used.
+    Returns the state of the batch (see shard_status).
+    '''
+
+    status = shard_status(output_folder)
+    print(f"{len(status['samples'])} sample(s) with results, {len(status['failed_files'])} failed file(s), "
+          f"{len(status['unfinished_files'])} unfinished file(s)")
+    for file_path in status['failed_files']:
+        print(f"  failed: {file_path}")
+    for file_path in status['unfinished_files']:
+        print(f"  unfinished: {file_path}")
+
+    if len(status['samples']) > 0:
+        run_report = TRreport.RunReport()
+        combine_results(output_folder, status['samples'], settings, run_report)
+        TRreport.write_run_report(output_folder, run_report.records, time.strftime('%Y%m%d-%H%M%S'))
+    if settings['plots'] == 'later':
+        print(f"To make the plots: python analyze_transl_rep.py --plot-only {output_folder}")
+
+    return status
+
+def shard_worker(settings):
+    '''
+    Sharded batch: one of several workers (processes, on one or more machines
+    with a shared filesystem) that together process the files of the manifest
+    (settings['manifest'], or all tif files in the input folder) into the same
+    output folder. Each worker goes through the files in order, claims a file
+    that isn't claimed or finished yet (see TRshard.FileClaim), processes it
+    (like process_files, with num_workers positions in parallel) and marks it
+    as done (or failed). Files are never processed twice; after a crash,
+    restarted workers continue with the unfinished files, and files claimed
+    by a worker that stopped are taken over after settings['shard_lock_timeout']
+    seconds. Workers wait until all files are finished, and the first worker
+    that finds everything finished creates the combined results (see merge_shards),
+    once: workers that finish later don't create them again (unless a file was
+    processed again in the meantime, e.g. a failed file that is retried).
+    Failed files are not retried; remove their .failed marker in the shards
+    folder to retry them.
+    Returns the state of the batch (see shard_status).
+    '''
+
+    output_folder = settings['output_folder']
+    if settings['manifest'] is not None:
+        file_paths = TRshard.read_manifest(settings['manifest'])
+    else:
+        file_paths = sorted(glob(os.path.join(settings['input_folder'], "*.tif")))
+    entries = TRshard.record_manifest(output_folder, file_paths)
+    run_id = time.strftime('%Y%m%d-%H%M%S')
+    report_name = f"run_report_{TRshard.worker_name()}.csv"
+    print(f"Worker {TRshard.worker_name()}, {len(file_paths)} file(s) in the manifest")
+
+    while True:
+
+        num_claimed_by_others = 0
+        for file_path, entry in zip(file_paths, entries):
+            if TRshard.read_marker(output_folder, entry)[0] is not None:
+                continue
+            claim = TRshard.FileClaim(output_folder, entry, settings['shard_lock_timeout'])
+            if not claim.acquire():
+                num_claimed_by_others += 1
+                continue
+            try:
+                # finished by another worker between the check and the claim
+                if TRshard.read_marker(output_folder, entry)[0] is not None:
+                    continue
+
+                # remove results of an earlier attempt (e.g. of a worker that crashed)
+                try:
+                    for position in TRread.list_positions(file_path):
+                        TRstore.remove_results(output_folder, position['sample'], settings['output_format'])
+                except Exception:
+                    pass # process_files reports files that can't be read
+
+                samples_per_file, failed_files, run_report_records = process_files([file_path], settings)
+                samples = samples_per_file.get(file_path, [])
+                if settings['plots'] == 'now':
+                    run_report_records += plot_samples(output_folder, samples, settings)
+                TRreport.write_run_report(TRshard.shards_folder(output_folder), run_report_records, run_id, file_name=report_name)
+                TRshard.write_marker(output_folder, entry, 'failed' if file_path in failed_files else 'done', file_path, samples)
+                # e.g. a failed file that is retried: the results are combined again
+                TRshard.remove_marker(output_folder, TRshard.MERGE_ENTRY, 'done')
+            finally:
+                claim.release()
+
+        if num_claimed_by_others == 0:
+            break
+        # the other workers might stop, then their files are taken over
+        print(f"Waiting for {num_claimed_by_others} file(s) claimed by other workers")
+        time.sleep(min(settings['shard_lock_timeout']/4, 10))
+
+    # all files are finished: the first worker that gets here creates the combined
+    # results, and marks this (merge.done), such that later workers don't do it again
+    claim = TRshard.FileClaim(output_folder, TRshard.MERGE_ENTRY, settings['shard_lock_timeout'])
+    if claim.acquire():
+        try:
+            if TRshard.read_marker(output_folder, TRshard.MERGE_ENTRY)[0] is None:
+                status = merge_shards(output_folder, settings)
+                TRshard.write_marker(output_folder, TRshard.MERGE_ENTRY, 'done', TRshard.MANIFEST_FILE, status['samples'])
+                return status
+        finally:
+            claim.release()
+
+    return shard_status(output_folder)
+
+
+def run_pipeline(config):
+    '''
+    Run the pipeline on all tif files in the input folder (or watch the folder, 
+    with 'watch': True, or run as one of the workers of a sharded batch, with 
+    'shard': True or a 'manifest', see shard_worker). config is a dict with 
+    settings (see DEFAULT_SETTINGS), or the path of a config file.
+    Returns a dict with the samples that were processed ('samples', in the order 
+    of the files) and the files that failed ('failed_files'); for a sharded batch 
+    also the files that are not finished ('unfinished_files').
+    '''
+    
+    settings = make_settings(config)
+    # with a manifest, the input files are listed in the manifest
+    sharded = settings['shard'] or (settings['manifest'] is not None)
+    for required_setting in ['output_folder', 'mapping_channels'] + ([] if settings['manifest'] is not None else ['input_folder']):
+        if settings[required_setting] is None:
+            raise ValueError(f"Setting {required_setting} is required")
+    if 'nucleus' not in settings['mapping_channels']:
+        raise ValueError("mapping_channels should contain the nuclear channel ('nucleus')")
+    if sharded and settings['watch']:
+        raise ValueError("Watching a folder can't be combined with a sharded batch")
+    
+    input_folder  = settings['input_folder']
+    output_folder = settings['output_folder']
+    os.makedirs(output_folder, exist_ok=True)
+    TRstore.check_output_format(settings['output_format'])
+
+    # Watch mode, process new files as they appear in the input folder
+    if settings['watch']:
+        samples, failed_files = watch_folder(settings)
+        return {'samples': samples, 'failed_files': failed_files}
+
+    # Sharded batch, one of several workers that process the files of a manifest
+    if sharded:
+        return shard_worker(settings)
+
+    # loop over tif files in input directory (sorted, such that the order of the results is fixed)
+    # for each file, separately analyze and create a csv output file
+    # with num_workers > 1, files are processed in parallel in separate processes
+    # the time and peak memory of each stage are appended to run_report.csv in the output folder
+    run_id = time.strftime('%Y%m%d-%H%M%S')
+    file_paths = sorted(glob(os.path.join(input_folder, "*.tif")))
+    samples_per_file, failed_files, run_report_records = process_files(file_paths, settings)
+    
+    # the samples with results, in the order of the files (and positions in a file)
+    samples = [sample for file_path in file_paths for sample in samples_per_file.get(file_path, [])]
+    if len(samples) == 0:
+        TRreport.write_run_report(output_folder, run_report_records, run_id)
+        print('No results')
+        return {'samples': samples, 'failed_files': failed_files}
+
+    # Create the combined results (from the stored results, file by file)
+    run_report = TRreport.RunReport()
+    combine_results(output_folder, samples, settings, run_report)
+    run_report_records += run_report.records
+
+    # Optionally, load data
+    # df_data_all = TRstore.read_results(output_folder, samples, settings['output_format'])
+
+    # Plotting is a separate stage (in parallel with num_workers), which can 
+    # be skipped (plots off) or done later (plots later, see plot_output_folder)
+    if settings['plots'] == 'now':
+        run_report_records += plot_samples(output_folder, samples, settings)
+    elif settings['plots'] == 'later':
+        print(f"To make the plots: python analyze_transl_rep.py --plot-only {output_folder}")
+
+    TRreport.write_run_report(output_folder, run_report_records, run_id)
+    print(f"Run report (time and memory per stage): {os.path.join(output_folder, 'run_report.csv')}")
+    
+    return {'samples': samples, 'failed_files': failed_files}
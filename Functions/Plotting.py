@@ -1,14 +1,16 @@
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
-
-from skimage.measure import regionprops
+from matplotlib.collections import LineCollection
 
 import numpy as np
+import pandas as pd
 
 import seaborn as sns
 
 import os
 
+import Functions.Segmentation as TRseg
+
 # generate a jet colormap, but make the first color white
 my_jet_colors = np.concatenate([[[1, 1, 1, 1]], plt.cm.jet(np.linspace(0, 1, 256))])
 jet_custom = ListedColormap(my_jet_colors)
@@ -69,19 +71,17 @@ def plot_illustration_tracking(frame_t, frame_tplus1, output_folder=None, file_n
     _=ax[0].imshow(frame_t, cmap=jet_custom)
 
     
-    for region in regionprops(frame_t):
-        y0, x0 = region.centroid
+    for label, (y0, x0) in zip(*TRseg.label_centroids(frame_t)):
         # center aligned
-        _=ax[0].text(x0, y0, region.label, color='black',                      
+        _=ax[0].text(x0, y0, label, color='black',                      
                      bbox=dict(facecolor='white', alpha=0.3, edgecolor='none'), ha='center', va='center')  
         
     _=ax[1].set_title('Frame t+1')    
     _=ax[1].imshow(frame_tplus1, cmap=jet_custom)
     _=ax[1].contour(frame_t>0, bins=2, colors='black')    
     
-    for region in regionprops(frame_tplus1):
-        y0, x0 = region.centroid
-        _=ax[1].text(x0, y0, region.label, color='black', 
+    for label, (y0, x0) in zip(*TRseg.label_centroids(frame_tplus1)):
+        _=ax[1].text(x0, y0, label, color='black', 
                         bbox=dict(facecolor='white', alpha=0.3, edgecolor='none'), ha='center', va='center')
         
     # remove ticks and tick labels
@@ -95,12 +95,14 @@ def plot_illustration_tracking(frame_t, frame_tplus1, output_folder=None, file_n
         plt.savefig(output_folder + '/EXAMPLE-tracking_' + file_name + '.pdf', dpi=300, bbox_inches='tight')
         plt.close(fig)  
 
-def plot_labels_framesX(labeled_masks, range_start=0, range_end=10, text_xoffset=20, output_folder=None, file_name=None, suffix=''):
+def plot_labels_framesX(labeled_masks, range_start=0, range_end=10, text_xoffset=20, output_folder=None, file_name=None, suffix='', rasterized=False):
     # labeled_masks=nucleus_masks_tracked; range_start=1; range_end=3; text_xoffset=50
     '''
     Use jet-color coded imshow and text labels to 
     create a multipanel plot to show the labels
     of first 10 frames frames (0..9)
+    With rasterized=True, the plot is saved as png and the text labels have 
+    no boxes, which is much faster for frames with hundreds of cells.
     '''
     
     # correct weird parameter inputs
@@ -126,10 +128,9 @@ def plot_labels_framesX(labeled_masks, range_start=0, range_end=10, text_xoffset
         _=axf[idx].tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
         _=axf[idx].grid(False)  
         
-        for region in regionprops(labeled_masks[frm]):
-            y0, x0 = region.centroid
-            _=axf[idx].text(x0+text_xoffset, y0, region.label, color='black', 
-                            bbox=dict(facecolor='white', alpha=0.3, edgecolor='none'))  
+        text_box = None if rasterized else dict(facecolor='white', alpha=0.3, edgecolor='none')
+        for label, (y0, x0) in zip(*TRseg.label_centroids(labeled_masks[frm])):
+            _=axf[idx].text(x0+text_xoffset, y0, label, color='black', bbox=text_box)  
     
     # remove left-over panels
     for panel_idx in range(range_end, panel_rows*panel_cols):
@@ -140,46 +141,118 @@ def plot_labels_framesX(labeled_masks, range_start=0, range_end=10, text_xoffset
     if (output_folder is None) or (file_name is None):
         plt.show()
         plt.close(fig)
+    elif rasterized:
+        plt.savefig(os.path.join(output_folder, file_name+suffix+'.png'), dpi=150, bbox_inches='tight')
+        plt.close(fig)
     else:
-        plt.savefig(output_folder+file_name+suffix+'.pdf', dpi=300, bbox_inches='tight')
+        plt.savefig(os.path.join(output_folder, file_name+suffix+'.pdf'), dpi=300, bbox_inches='tight')
         plt.close(fig)
     
 ################################################################################
 # 
 
-def plot_intensity_nuc_cyto(df_data, output_folder, file_name):
+# Traces of individual cells are drawn as one LineCollection per facet and series,
+# instead of one line per cell. Above this number of cells, the traces are 
+# rasterized in the pdf, such that the file stays small.
+RASTERIZE_TRACES_ABOVE = 200
+
+def traces_per_cell(df_data, column, cells):
+    '''
+    The values of column for the given cells as an array (cells, frames, 2)
+    with frame and value, that can be given to LineCollection (NaN where a 
+    cell is not present, such that its line is interrupted).
+    '''
+    
+    # cells only have rows in the frames where they are present, and frames can be without cells
+    df_wide = df_data.loc[df_data['Cell'] != 'all'].pivot(index='Frame', columns='Cell', values=column).reindex(
+                                                        index=np.sort(df_data['Frame'].unique()), columns=cells)
+    frames = df_wide.index.values.astype(float)
+    
+    traces = np.empty((len(cells), len(frames), 2))
+    traces[:, :, 0] = frames
+    traces[:, :, 1] = df_wide.values.T
+    
+    return traces
+
+def plot_traces(ax, df_data, column, cells, colors, linestyle='-', quantile_band=None, label_average=None):
+    '''
+    Plot the traces of all cells (one LineCollection), optionally a band between 
+    the per-frame quantiles of the cells (e.g. quantile_band=(0.1, 0.9)), 
+    and the average of all cells (the 'all' rows) in black.
+    '''
+    
+    traces = traces_per_cell(df_data, column, cells)
+    line_collection = LineCollection(traces, colors=colors, linestyles=linestyle, linewidths=1, alpha=0.8,
+                                     rasterized=len(cells) > RASTERIZE_TRACES_ABOVE)
+    ax.add_collection(line_collection)
+    
+    if quantile_band is not None:
+        band_low, band_high = np.nanquantile(traces[:, :, 1], quantile_band, axis=0)
+        ax.fill_between(traces[0, :, 0], band_low, band_high, color='grey', alpha=0.3, linewidth=0)
+    
+    df_average = df_data.loc[df_data['Cell'] == 'all'].sort_values('Frame')
+    ax.plot(df_average['Frame'], df_average[column], color='black', linestyle=linestyle, linewidth=2, label=label_average)
+    
+    ax.autoscale_view()
+
+def plot_traces_per_key(df_data, columns, output_path, ylabel, linestyles=['-'], labels_average=[None], quantile_band=None):
+    '''
+    Plot the traces of the columns (e.g. nucleus and cytoplasm intensity), 
+    one panel per key (2 panels per row), and save the plot as output_path.
+    '''
+    
+    keys = list(pd.unique(df_data['Key']))
+    # colors per cell, the same in all panels
+    cells = sorted(set(df_data.loc[df_data['Cell'] != 'all', 'Cell']), key=lambda cell: int(cell) if str(cell).isdigit() else cell)
+    colors = sns.color_palette('husl', max(len(cells), 1))
     
     sns.set_theme(style="whitegrid")
-    g = sns.FacetGrid(df_data, col="Key", col_wrap=2, height=4, sharey=False)
-    # Plot individual cells with hue='Cell'
-    _=g.map(sns.lineplot, "Frame", "Intensity_nucleus", data=df_data.loc[df_data['Cell'] != 'all'], hue='Cell', legend=False)
-    _=g.map(sns.lineplot, "Frame", "Intensity_cytoplasm", linestyle='--', data=df_data.loc[df_data['Cell'] != 'all'], hue='Cell', legend=False)
-    # Plot the average (black lines)
-    _=g.map(sns.lineplot, "Frame", "Intensity_nucleus", data=df_data.loc[df_data['Cell'] == 'all'], color='black', units='Cell', estimator=None, linewidth=2, label='Average Nucleus')
-    _=g.map(sns.lineplot, "Frame", "Intensity_cytoplasm", data=df_data.loc[df_data['Cell'] == 'all'], color='black', units='Cell', estimator=None, linewidth=2, linestyle='--', label='Average Cytoplasm')
-    # Cosmetics
-    g.set_axis_labels("Time", "Signal intensity")
-    g.add_legend()
-    # Save
-    # plt.tight_layout()
-    g.figure.savefig(os.path.join(output_folder, f"PLOT_{file_name}_Intensity_plot_nuc-cyto-separate.pdf"), dpi=300, bbox_inches='tight')
-    plt.close(g.figure)
-    
-    print('Saved plot to', os.path.join(output_folder, f"PLOT_{file_name}_Intensity_plot_nuc-cyto-separate.pdf"))
+    num_cols = min(len(keys), 2)
+    num_rows = int(np.ceil(len(keys) / 2))
+    fig, ax = plt.subplots(num_rows, num_cols, figsize=(4*num_cols, 4*num_rows), squeeze=False)
+    axf = ax.flatten()
+    
+    for idx, thekey in enumerate(keys):
+        df_key = df_data.loc[df_data['Key'] == thekey]
+        for column, linestyle, label_average in zip(columns, linestyles, labels_average):
+            plot_traces(axf[idx], df_key, column, cells, colors, linestyle=linestyle, quantile_band=quantile_band, label_average=label_average)
+        axf[idx].set_title(f"Key = {thekey}")
+        axf[idx].set_xlabel("Time")
+        axf[idx].set_ylabel(ylabel)
+    
+    # remove left-over panels
+    for panel_idx in range(len(keys), len(axf)):
+        axf[panel_idx].axis('off')
+    if any(label is not None for label in labels_average):
+        axf[0].legend(loc='best', fontsize=8)
+    
+    plt.tight_layout()
+    fig.savefig(output_path, dpi=300, bbox_inches='tight')
+    plt.close(fig)
     plt.style.use("default") # revert style to default for other plots
 
-def plot_intensity_ratio(df_data, output_folder, file_name):
-    
-    sns.set_theme(style="whitegrid"); 
-    g = sns.FacetGrid(df_data, col="Key", col_wrap=2, height=4, sharey=False)
-    g.map(sns.lineplot, "Frame", "Ratio_cytoplasm_div_nucleus", data=df_data.loc[df_data['Cell']=='all'], color='black', units='Cell', estimator=None, linewidth=2)
-    g.map(sns.lineplot, "Frame", "Ratio_cytoplasm_div_nucleus", data=df_data.loc[df_data['Cell']!='all'], hue='Cell')
-    g.set_axis_labels("Time", "Signal ratio cytoplasm/nucleus")
-    g.add_legend()
-    # Save
-    # plt.tight_layout()
-    g.figure.savefig(os.path.join(output_folder, f"PLOT_{file_name}_Intensity_plot_cyto-nuc-ratio.pdf"), dpi=300, bbox_inches='tight')
-    plt.close(g.figure)    
-    
-    print('Plot saved to', os.path.join(output_folder, f"PLOT_{file_name}_Intensity_plot_cyto-nuc-ratio.pdf"))
-    plt.style.use("default") # revert style to default for other plots
+def plot_intensity_nuc_cyto(df_data, output_folder, file_name, quantile_band=None):
+    '''
+    Plot the nucleus (solid) and cytoplasm (dashed) intensities of all cells, 
+    with the averages in black, one panel per key. 
+    Optionally with bands between per-frame quantiles, e.g. quantile_band=(0.1, 0.9).
+    '''
+    
+    output_path = os.path.join(output_folder, f"PLOT_{file_name}_Intensity_plot_nuc-cyto-separate.pdf")
+    plot_traces_per_key(df_data, ["Intensity_nucleus", "Intensity_cytoplasm"], output_path, "Signal intensity", 
+                        linestyles=['-', '--'], labels_average=['Average Nucleus', 'Average Cytoplasm'], quantile_band=quantile_band)
+    
+    print('Saved plot to', output_path)
+
+def plot_intensity_ratio(df_data, output_folder, file_name, quantile_band=None):
+    '''
+    Plot the cytoplasm/nucleus ratio of all cells, with the average in black,
+    one panel per key.
+    Optionally with a band between per-frame quantiles, e.g. quantile_band=(0.1, 0.9).
+    '''
+    
+    output_path = os.path.join(output_folder, f"PLOT_{file_name}_Intensity_plot_cyto-nuc-ratio.pdf")
+    plot_traces_per_key(df_data, ["Ratio_cytoplasm_div_nucleus"], output_path, "Signal ratio cytoplasm/nucleus", 
+                        quantile_band=quantile_band)
+    
+    print('Plot saved to', output_path)
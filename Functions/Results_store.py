@@ -0,0 +1,301 @@
+import os
+import glob
+import shutil
+import importlib.util
+
+import numpy as np
+import pandas as pd
+import tifffile as tiff
+
+import Functions.Image_reading as TRread
+
+# Results are stored per sample (input file) and key (channel), as they are produced:
+#   parquet: output_folder/results_store/<sample>/<key>.parquet (compact dtypes)
+#   csv:     output_folder/<sample>_<key>_results.csv (as before)
+RESULTS_STORE_FOLDER = 'results_store'
+
+# In the compact format, the 'all' rows (average over all cells) get cell ID 0
+# (label 0 is the background, so it's never a cell)
+CELL_ID_ALL = 0
+
+# Maximum number of rows in an excel sheet (excluding header)
+EXCEL_MAX_ROWS = 1048575
+
+# The label plots show the first frames; these frames are saved in this folder 
+# (in the output folder), such that the plots can be made after the analysis
+PLOT_DATA_FOLDER = 'plot_data'
+LABEL_PLOT_FRAMES = 12
+
+# The tracked masks can be exported to this folder (in the output folder), one
+# OME-TIFF per sample in compressed tiles, such that they can be reused without
+# segmenting again (see export_masks and read_masks)
+MASKS_FOLDER = 'masks'
+MASKS_TILE_SIZE = 256
+
+def check_output_format(output_format):
+    '''Raise an error if the output format is unknown or can't be written.'''
+
+    if output_format not in ['parquet', 'csv']:
+        raise ValueError(f"Unknown output format {output_format}, should be parquet or csv")
+    if (output_format == 'parquet') and (importlib.util.find_spec('pyarrow') is None):
+        raise ImportError("Writing parquet files requires pyarrow (pip install pyarrow), or use --output-format csv")
+
+def compact_results(df_results):
+    '''
+    Convert a results dataframe to compact dtypes: integer cell IDs
+    (with CELL_ID_ALL for the 'all' rows), categorical Key and Sample,
+    float32 intensities and int32 pixel counts.
+    '''
+
+    df_compact = df_results.copy()
+    df_compact['Frame'] = df_compact['Frame'].astype(np.int32)
+    df_compact['Cell'] = df_compact['Cell'].replace('all', str(CELL_ID_ALL)).astype(np.int32)
+    for column in df_compact.columns:
+        if column in ['Key', 'Sample']:
+            df_compact[column] = df_compact[column].astype('category')
+        elif df_compact[column].dtype == np.float64:
+            df_compact[column] = df_compact[column].astype(np.float32)
+        elif df_compact[column].dtype == np.int64:
+            df_compact[column] = df_compact[column].astype(np.int32)
+
+    return df_compact
+
+def expand_results(df_compact):
+    '''
+    Convert compact results back to the format used in the csv files and plots,
+    with Cell as text and 'all' for the average over all cells.
+    '''
+
+    df_results = df_compact.copy()
+    df_results['Cell'] = df_results['Cell'].astype(str).replace(str(CELL_ID_ALL), 'all')
+
+    return df_results
+
+def write_results(output_folder, df_results, output_format='parquet'):
+    '''
+    Write the results of one sample and key (channel).
+    '''
+
+    sample = df_results['Sample'].iloc[0]
+    thekey = df_results['Key'].iloc[0]
+
+    if output_format == 'parquet':
+        sample_folder = os.path.join(output_folder, RESULTS_STORE_FOLDER, sample)
+        os.makedirs(sample_folder, exist_ok=True)
+        compact_results(df_results).to_parquet(os.path.join(sample_folder, f"{thekey}.parquet"), index=False)
+    else:
+        df_results.to_csv(os.path.join(output_folder, f"{sample}_{thekey}_results.csv"), index=False)
+
+class ResultsWriter:
+    '''
+    Write the results of one sample and key (channel) in parts, e.g. frame by 
+    frame (streaming mode), to the same files as write_results.
+    csv rows are appended right away; for parquet, rows are collected up to 
+    row_group_size rows per row group, and the file is complete after close().
+    '''
+    
+    def __init__(self, output_folder, sample, thekey, output_format='parquet', row_group_size=65536):
+        
+        self.output_format = output_format
+        self.row_group_size = row_group_size
+        self.parquet_writer = None
+        self.df_buffer = []
+        self.rows_in_buffer = 0
+        
+        if output_format == 'parquet':
+            sample_folder = os.path.join(output_folder, RESULTS_STORE_FOLDER, sample)
+            os.makedirs(sample_folder, exist_ok=True)
+            self.path = os.path.join(sample_folder, f"{thekey}.parquet")
+        else:
+            self.path = os.path.join(output_folder, f"{sample}_{thekey}_results.csv")
+        if os.path.exists(self.path):
+            os.remove(self.path)
+    
+    def write(self, df_results):
+        
+        if self.output_format == 'csv':
+            df_results.to_csv(self.path, mode='a', header=not os.path.exists(self.path), index=False)
+            return
+        
+        self.df_buffer.append(df_results)
+        self.rows_in_buffer += len(df_results)
+        if self.rows_in_buffer >= self.row_group_size:
+            self.flush()
+    
+    def flush(self):
+        '''Write the collected rows (parquet) as a row group.'''
+        
+        if len(self.df_buffer) == 0:
+            return
+        
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        table = pa.Table.from_pandas(compact_results(pd.concat(self.df_buffer, ignore_index=True)), preserve_index=False)
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.path, table.schema)
+        self.parquet_writer.write_table(table.cast(self.parquet_writer.schema))
+        self.df_buffer = []
+        self.rows_in_buffer = 0
+    
+    def close(self):
+        
+        if self.output_format == 'parquet':
+            self.flush()
+            if self.parquet_writer is not None:
+                self.parquet_writer.close()
+
+def result_files(output_folder, sample, output_format='parquet'):
+    '''Files with results of a sample (one per key).'''
+
+    if output_format == 'parquet':
+        return sorted(glob.glob(os.path.join(output_folder, RESULTS_STORE_FOLDER, glob.escape(sample), '*.parquet')))
+
+    # the pattern also matches samples of which the name starts with <sample>_ (e.g. exp 
+    # and exp_2), so the sample is checked in the file (every csv file has at least one row)
+    return sorted(path for path in glob.glob(os.path.join(output_folder, f"{glob.escape(sample)}_*_results.csv"))
+                    if csv_sample(path) == sample)
+
+def csv_sample(path):
+    '''The sample of a csv results file (None if it can't be read, e.g. partially written).'''
+
+    try:
+        return pd.read_csv(path, usecols=['Sample'], dtype={'Sample': str}, nrows=1)['Sample'].iloc[0]
+    except (ValueError, IndexError, pd.errors.EmptyDataError):
+        return None
+
+def read_results(output_folder, samples, output_format='parquet', compact=False):
+    '''
+    Read the results of the given samples (in that order) into one dataframe.
+    By default in the expanded format (see expand_results), with compact=True
+    in the compact format.
+    '''
+
+    df_list = []
+    for sample in samples:
+        for path in result_files(output_folder, sample, output_format):
+            if output_format == 'parquet':
+                df_list.append(pd.read_parquet(path))
+            else:
+                df_list.append(compact_results(pd.read_csv(path, dtype={'Cell': str, 'Sample': str})))
+    df_compact = pd.concat(df_list, ignore_index=True)
+    # categories might differ between files
+    df_compact['Key'] = df_compact['Key'].astype(str).astype('category')
+    df_compact['Sample'] = df_compact['Sample'].astype(str).astype('category')
+
+    return df_compact if compact else expand_results(df_compact)
+
+def remove_results(output_folder, sample, output_format='parquet'):
+    '''Remove the results of a sample (e.g. incomplete results of an interrupted run).'''
+
+    if output_format == 'parquet':
+        shutil.rmtree(os.path.join(output_folder, RESULTS_STORE_FOLDER, sample), ignore_errors=True)
+    else:
+        for path in result_files(output_folder, sample, output_format):
+            os.remove(path)
+
+def list_samples(output_folder, output_format='parquet'):
+    '''Samples of which results are stored.'''
+
+    if output_format == 'parquet':
+        return sorted(os.path.basename(os.path.dirname(path)) for path in
+                        glob.glob(os.path.join(output_folder, RESULTS_STORE_FOLDER, '*', '*.parquet')))
+
+    return sorted(set(csv_sample(path) for path in glob.glob(os.path.join(output_folder, '*_results.csv'))
+                        if os.path.basename(path) != 'ALL_results.csv') - {None})
+
+def combine_csv(output_folder, samples, append=False):
+    '''
+    Combine the csv files of the samples (in that order) in ALL_results.csv,
+    file by file, such that not all results need to be in memory.
+    With append=True, the samples are added to an existing ALL_results.csv
+    (e.g. new files in watch mode).
+    '''
+
+    path_all = os.path.join(output_folder, 'ALL_results.csv')
+    if os.path.exists(path_all) and not append:
+        os.remove(path_all)
+    for sample in samples:
+        for path in result_files(output_folder, sample, 'csv'):
+            pd.read_csv(path, dtype={'Cell': str, 'Sample': str}).to_csv(path_all, mode='a', header=not os.path.exists(path_all), index=False)
+
+def export_excel(output_folder, samples, output_format='parquet'):
+    '''
+    Export the results of the samples to ALL_results.xlsx. If there are more
+    rows than fit in an excel sheet, the results are split over multiple sheets.
+    '''
+
+    df_data_all = read_results(output_folder, samples, output_format)
+    with pd.ExcelWriter(os.path.join(output_folder, 'ALL_results.xlsx')) as writer:
+        for sheet_idx, row_start in enumerate(range(0, max(len(df_data_all), 1), EXCEL_MAX_ROWS)):
+            df_data_all.iloc[row_start:row_start+EXCEL_MAX_ROWS].to_excel(writer, sheet_name=f"results_{sheet_idx+1}", index=False)
+
+def save_label_frames(output_folder, file_name, nucleus_masks, cytoplasm_masks, range_end=LABEL_PLOT_FRAMES):
+    '''
+    Save the first frames of the nucleus and cytoplasm masks (compressed), 
+    for the label plots (see load_label_frames and plot_labels_framesX).
+    '''
+    
+    # frame by frame, such that the masks can also be lazy stacks (see read_masks)
+    frames = range(min(range_end, len(nucleus_masks)))
+    os.makedirs(os.path.join(output_folder, PLOT_DATA_FOLDER), exist_ok=True)
+    np.savez_compressed(os.path.join(output_folder, PLOT_DATA_FOLDER, f"{file_name}_label_frames.npz"),
+                        nucleus=np.asarray([nucleus_masks[frm] for frm in frames]), cytoplasm=np.asarray([cytoplasm_masks[frm] for frm in frames]))
+
+def load_label_frames(output_folder, file_name):
+    '''
+    Load the frames saved by save_label_frames, returns the nucleus and 
+    cytoplasm masks, or None, None if they were not saved.
+    '''
+    
+    path = os.path.join(output_folder, PLOT_DATA_FOLDER, f"{file_name}_label_frames.npz")
+    if not os.path.exists(path):
+        return None, None
+    with np.load(path) as label_frames:
+        return label_frames['nucleus'], label_frames['cytoplasm']
+
+def masks_path(output_folder, sample):
+    return os.path.join(output_folder, MASKS_FOLDER, f"{sample}_masks.ome.tif")
+
+def export_masks(output_folder, sample, nucleus_masks_tracked, cytoplasm_masks_tracked):
+    '''
+    Export the tracked nucleus and cytoplasm masks of a sample to an OME-TIFF
+    (T,C,Y,X, with channel 0 the nuclei and 1 the cytoplasm rings), in zlib-compressed
+    tiles of MASKS_TILE_SIZE x MASKS_TILE_SIZE pixels. The masks are written tile by
+    tile, such that they don't need to be in memory, and single frames (or tiles)
+    can be read without reading the whole file (see read_masks). The file can also
+    be opened in e.g. Fiji or napari.
+    '''
+
+    os.makedirs(os.path.join(output_folder, MASKS_FOLDER), exist_ok=True)
+    path = masks_path(output_folder, sample)
+    frame_shape = tuple(nucleus_masks_tracked.shape[1:])
+
+    def tiles():
+        for frm in range(len(nucleus_masks_tracked)):
+            for masks in (nucleus_masks_tracked, cytoplasm_masks_tracked):
+                frame = np.asarray(masks[frm])
+                for row in range(0, frame_shape[0], MASKS_TILE_SIZE):
+                    for col in range(0, frame_shape[1], MASKS_TILE_SIZE):
+                        yield frame[row:row+MASKS_TILE_SIZE, col:col+MASKS_TILE_SIZE] # tiles at the edges are padded by tifffile
+
+    # write to a temporary file first, such that there's never a partial file
+    temp_path = f"{path}.tmp"
+    with tiff.TiffWriter(temp_path, bigtiff=True, ome=True) as tif:
+        tif.write(tiles(), shape=(len(nucleus_masks_tracked), 2) + frame_shape, dtype=np.promote_types(nucleus_masks_tracked.dtype, cytoplasm_masks_tracked.dtype),
+                  tile=(MASKS_TILE_SIZE, MASKS_TILE_SIZE), compression='zlib', metadata={'axes': 'TCYX', 'Channel': {'Name': ['nucleus', 'cytoplasm']}})
+    os.replace(temp_path, path)
+
+def read_masks(output_folder, sample):
+    '''
+    Open the masks exported by export_masks, as a TRread.LazyImageStack: 
+    masks[:, 0] are the nucleus masks and masks[:, 1] the cytoplasm masks 
+    (T,Y,X stacks of which frames are read when needed), masks[t, 0] is
+    one frame. Close it with masks.close().
+    '''
+
+    path = masks_path(output_folder, sample)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No exported masks of sample {sample}: {path}")
+
+    return TRread.LazyImageStack(path)
@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource # not available on Windows
+except ImportError:
+    resource = None
+
+def peak_rss_mb():
+    '''
+    Peak resident memory (MB) of the current process so far,
+    or NaN if it can't be determined on this platform.
+    '''
+
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on mac
+        return peak_rss / 1024**2 if sys.platform == 'darwin' else peak_rss / 1024
+
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024**2 # windows
+    except (ImportError, AttributeError):
+        return np.nan
+
+class RunReport:
+    '''
+    Records the wall time, CPU time and peak memory of the stages of the
+    analysis of one sample (or of the overall steps, with sample=None).
+    The overhead is a few system calls per stage, such that it can always be on.
+
+    Usage:
+        run_report = RunReport(sample)
+        with run_report.stage('segmentation'):
+            ...
+        run_report.set_counts(num_frames=.., num_cells=..)
+    '''
+
+    def __init__(self, sample=None):
+
+        self.sample = sample
+        self.num_frames = None
+        self.num_cells = None
+        self._records = []
+
+    def set_counts(self, num_frames=None, num_cells=None):
+        '''Set the number of frames and cells of the sample.'''
+
+        if num_frames is not None:
+            self.num_frames = int(num_frames)
+        if num_cells is not None:
+            self.num_cells = int(num_cells)
+
+    @contextmanager
+    def stage(self, stage_name, key=None, accumulate=False):
+        '''
+        Context manager that records the resources used by the code inside.
+        key can be given for stages that are done per channel.
+        With accumulate=True, the time is added to an earlier record of the 
+        same stage and key (e.g. for stages that are done frame by frame).
+        '''
+
+        wall_time_start = time.perf_counter()
+        cpu_time_start = time.process_time() # all threads of this process
+        try:
+            yield
+        finally:
+            record = {'sample': self.sample, 'stage': stage_name, 'key': key,
+                      'wall_time_s': time.perf_counter() - wall_time_start,
+                      'cpu_time_s': time.process_time() - cpu_time_start,
+                      'peak_rss_mb': peak_rss_mb(), 'pid': os.getpid()}
+            previous_records = [previous_record for previous_record in self._records 
+                                    if (previous_record['stage'] == stage_name) and (previous_record['key'] == key)] if accumulate else []
+            if len(previous_records) > 0:
+                previous_records[-1]['wall_time_s'] += record['wall_time_s']
+                previous_records[-1]['cpu_time_s'] += record['cpu_time_s']
+                previous_records[-1]['peak_rss_mb'] = record['peak_rss_mb']
+            else:
+                self._records.append(record)
+
+    @property
+    def records(self):
+        '''The recorded stages, with the frame and cell counts of the sample.'''
+
+        return [{**record, 'num_frames': self.num_frames, 'num_cells': self.num_cells} for record in self._records]
+
+def write_run_report(output_folder, records, run_id, file_name='run_report.csv'):
+    '''
+    Append the records (of one or more RunReports) to run_report.csv (or 
+    file_name) in the output folder; run_id identifies the run (e.g. its start time).
+    '''
+
+    if len(records) == 0:
+        return
+
+    report_path = os.path.join(output_folder, file_name)
+    df_report = pd.DataFrame(records)
+    df_report.insert(0, 'run_id', run_id)
+    # counts are missing for overall steps, keep them integers
+    df_report[['num_frames', 'num_cells']] = df_report[['num_frames', 'num_cells']].astype('Int64')
+    df_report.to_csv(report_path, mode='a', header=not os.path.exists(report_path), index=False)
@@ -1,23 +1,48 @@
 
+import pandas as pd
 
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
-import tifffile as tiff
+# import matplotlib.pyplot as plt # for the debugging plots below
 from skimage.filters import threshold_otsu
-from skimage.morphology import remove_small_objects, remove_small_holes, binary_opening, disk, binary_dilation, dilation
-import os
-from glob import glob
-import csv
+from skimage.morphology import remove_small_objects, remove_small_holes, binary_opening, disk
+from scipy import ndimage
 from skimage.measure import label
+from concurrent.futures import ThreadPoolExecutor
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 
 
+# Label masks are stored as uint16 (2 bytes per pixel, up to 65535 labels), 
+# or as uint32 if there are more labels (see mask_dtype)
+def mask_dtype(max_label):
+    '''The smallest dtype for labels up to max_label: uint16, or uint32 for more than 65535 labels.'''
+    
+    return np.dtype(np.uint16) if max_label <= np.iinfo(np.uint16).max else np.dtype(np.uint32)
+
+def compact_labels(mask):
+    '''A labeled mask in the smallest dtype for its labels (see mask_dtype).'''
+    
+    return mask.astype(mask_dtype(int(mask.max()) if mask.size > 0 else 0), copy=False)
+
+def store_labels(out, index, mask):
+    '''
+    out[index] = mask, where out is a label stack (e.g. uint16): raises an 
+    OverflowError if the labels don't fit in the dtype of out (instead of 
+    wrapping around), such that the caller can use a larger dtype.
+    '''
+    
+    if (mask.size > 0) and (mask.max() > np.iinfo(out.dtype).max):
+        raise OverflowError(f"Labels up to {mask.max()} don't fit in a {out.dtype} mask")
+    out[index] = mask
+
 def segment_nucleus(image, min_size_objects=30,  area_threshold_holes=50, footprint_opening = 2):
     # image = imgstack_nucleus[1]; min_size_objects=15;  area_threshold_holes=50; footprint_opening = 2
     '''
     Segment an image with nuclei based on simple Otsu thresholding.
     Make small improvements to the image by removing small objects and holes, and opening.
-    Returns labeled mask.
+    Returns labeled mask (uint16, or uint32 if there are more than 65535 nuclei).
     '''
     
     # Perform thresholding
@@ -25,6 +50,14 @@ def segment_nucleus(image, min_size_objects=30,  area_threshold_holes=50, footpr
     binary_mask = image > thresh
         # plt.imshow(label(binary_mask), cmap='jet'); plt.show(); plt.close()
     
+    return clean_and_label(binary_mask, min_size_objects=min_size_objects, area_threshold_holes=area_threshold_holes, footprint_opening=footprint_opening)
+
+def clean_and_label(binary_mask, min_size_objects=30,  area_threshold_holes=50, footprint_opening = 2):
+    '''
+    The steps of segment_nucleus after thresholding: remove small objects 
+    and holes, open, and label. Also used for tiles (see TRtile.segment_nucleus_tiled).
+    '''
+    
     # Remove small objects and holes
     clean_mask = remove_small_objects(binary_mask, min_size=min_size_objects)
     clean_mask = remove_small_holes(clean_mask, area_threshold=area_threshold_holes)
@@ -33,40 +66,148 @@ def segment_nucleus(image, min_size_objects=30,  area_threshold_holes=50, footpr
     opened_mask = binary_opening(clean_mask, footprint=disk(footprint_opening))
     
     # Label the mask to assign unique labels to each nucleus
-    labeled_mask = label(opened_mask)
+    # (label gives int32/int64, the mask is kept as uint16 if the labels fit)
+    labeled_mask = compact_labels(label(opened_mask))
         # plt.imshow(labeled_mask, cmap='jet'); plt.show(); plt.close()
     
     return labeled_mask
 
+def segment_nuclei_stack(imgstack_nucleus, num_workers=1, out=None, **segment_kwargs):
+    '''
+    Segment all frames of a nuclear image stack with segment_nucleus.
+    Frames are independent, so with num_workers > 1 they are segmented 
+    concurrently in a thread pool (the heavy lifting in skimage/scipy
+    releases the GIL). Returns a list of labeled masks, in frame order,
+    or, if a T,Y,X array is given as out, stores the masks in there and
+    returns out (this avoids keeping a list of masks and copying it); 
+    an OverflowError is raised if the labels don't fit in out (see store_labels).
+    Additional keyword arguments are passed on to segment_nucleus.
+    '''
+    
+    def segment_frame(time_index):
+        mask = segment_nucleus(imgstack_nucleus[time_index], **segment_kwargs)
+        if out is not None:
+            store_labels(out, time_index, mask)
+            return None
+        return mask
+    
+    num_frames = imgstack_nucleus.shape[0]
+    if num_workers > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            masks = list(executor.map(segment_frame, range(num_frames)))
+    else:
+        masks = [segment_frame(time_index) for time_index in range(num_frames)]
+    
+    return masks if out is None else out
+
 def create_cytoplasm_roi(nucleus_mask, dilation_radius=5, margin_radius = 0):
     '''
-    Create cytoplasm ring by dilating nuclear mask
-    and removing the original nuclei again.
+    Create cytoplasm ring around each nucleus, containing the pixels that
+    lie within dilation_radius of the nucleus (the same pixels as dilating 
+    the nucleus with a disk of that radius), excluding the nucleus itself.
     
-    If desired, the part that's removed can also be dilated, such that 
-    a margin is introduced between the original nuclei and the cytoplasm ring.
+    If desired, a margin can be introduced between the original nuclei and 
+    the cytoplasm ring, then the ring consists of the pixels at a distance of 
+    more than margin_radius and at most dilation_radius+margin_radius.
     
-    Note that if two nuclei are very close, the dilated mask pixels close to 
-    both nuclei will have the value of the highest label. This is arbitrary
-    and might introduce small artifacts. This is not expected to have
-    big effects on measurements.
+    The ring is calculated with a single Euclidean distance transform, which 
+    also gives the nearest nucleus of each pixel, so the calculation time 
+    doesn't depend on the radius. If two nuclei are very close, pixels between 
+    them are assigned to the nearest nucleus.
     '''
     # nucleus_mask = segmented_masks[0]; dilation_radius=5; margin_radius = 0
     
     # plt.imshow(nucleus_mask); plt.show(); plt.close()
+    
+    # without nuclei, there's no cytoplasm
+    if not np.any(nucleus_mask):
+        return np.zeros_like(nucleus_mask)
 
-    # Dilate the binary nucleus mask
-    dilated_mask = dilation(nucleus_mask, footprint=disk(dilation_radius+margin_radius))
-        # plt.imshow(dilated_mask); plt.show(); plt.close()
+    # distance of each pixel to the nearest nucleus pixel, and the location of that pixel
+    distance_to_nucleus, nearest_indices = ndimage.distance_transform_edt(nucleus_mask == 0, return_indices=True)
+        # plt.imshow(distance_to_nucleus); plt.show(); plt.close()
 
-    # now remove the areas of the original nuclei, if desired including a margin
-    dilated_nucleus_mask = dilation(nucleus_mask, footprint=disk(margin_radius))
-    dilated_mask[dilated_nucleus_mask > 0] = 0
-        # plt.imshow(dilated_mask); plt.show(); plt.close()
+    # the ring consists of the pixels within the given distance, excluding the nuclei (and margin)
+    ring = (distance_to_nucleus > margin_radius) & (distance_to_nucleus <= dilation_radius + margin_radius)
+    
+    # the pixels of the ring get the label of their nearest nucleus
+    cytoplasm_mask = np.zeros_like(nucleus_mask)
+    cytoplasm_mask[ring] = nucleus_mask[nearest_indices[0][ring], nearest_indices[1][ring]]
+        # plt.imshow(cytoplasm_mask); plt.show(); plt.close()
 
-    return dilated_mask
+    return cytoplasm_mask
 
 
+def overlap_matrix(mask_t, mask_tplus1):
+    '''
+    Compute the label overlap (contingency) matrix between two labeled masks
+    in one vectorized pass.
+    
+    Only pixel pairs where both masks are labeled are considered. The matrix is 
+    returned in sparse (coordinate) form, i.e. as three arrays: labels in mask_t, 
+    labels in mask_tplus1 and the number of overlapping pixels of each pair.
+    '''
+    
+    both_labeled = (mask_t > 0) & (mask_tplus1 > 0)
+    labels_t = mask_t[both_labeled].astype(np.int64)
+    labels_tplus1 = mask_tplus1[both_labeled].astype(np.int64)
+    
+    # encode each (label_t, label_tplus1) pair as one integer, and count the pairs
+    num_labels_tplus1 = int(mask_tplus1.max()) + 1 if mask_tplus1.size > 0 else 1
+    pair_codes, pair_counts = np.unique(labels_t * num_labels_tplus1 + labels_tplus1, return_counts=True)
+    
+    return pair_codes // num_labels_tplus1, pair_codes % num_labels_tplus1, pair_counts
+
+def assign_overlapping_labels(labels_t, labels_tplus1, overlaps):
+    '''
+    Given the sparse overlap matrix (see overlap_matrix), determine a one-to-one
+    assignment between labels at t and t+1 that maximizes the total overlap.
+    
+    The overlap graph is split in connected components (groups of labels that
+    touch each other), and the optimal assignment is solved per component.
+    These are typically very small, so this scales to thousands of nuclei.
+    Returns a dict {label_tplus1: label_t}, ordered by label_t.
+    '''
+    
+    if len(overlaps) == 0:
+        return {}
+    
+    # renumber labels to compact indices, to build the bipartite graph
+    unique_t, idx_t = np.unique(labels_t, return_inverse=True)
+    unique_tplus1, idx_tplus1 = np.unique(labels_tplus1, return_inverse=True)
+    num_t = len(unique_t)
+    
+    # nodes 0..num_t-1 are labels at t, nodes num_t.. are labels at t+1
+    graph = coo_matrix((overlaps, (idx_t, idx_tplus1 + num_t)), shape=(num_t + len(unique_tplus1),)*2)
+    _, component_per_node = connected_components(graph, directed=False)
+    component_per_pair = component_per_node[idx_t]
+    
+    the_mapping_reverse = {}
+    # sort the pairs by component, and go over components
+    order = np.argsort(component_per_pair, kind='stable')
+    boundaries = np.flatnonzero(np.diff(component_per_pair[order])) + 1
+    for pair_indices in np.split(order, boundaries):
+        
+        # simple case, one parent overlaps with one child only
+        if len(pair_indices) == 1:
+            the_mapping_reverse[unique_t[idx_t[pair_indices[0]]]] = unique_tplus1[idx_tplus1[pair_indices[0]]]
+            continue
+        
+        # otherwise, solve the assignment problem for this component
+        comp_t, comp_idx_t = np.unique(idx_t[pair_indices], return_inverse=True)
+        comp_tplus1, comp_idx_tplus1 = np.unique(idx_tplus1[pair_indices], return_inverse=True)
+        comp_overlap = np.zeros((len(comp_t), len(comp_tplus1)), dtype=overlaps.dtype)
+        comp_overlap[comp_idx_t, comp_idx_tplus1] = overlaps[pair_indices]
+        rows, cols = linear_sum_assignment(comp_overlap, maximize=True)
+        for row, col in zip(rows, cols):
+            if comp_overlap[row, col] > 0:
+                the_mapping_reverse[unique_t[comp_t[row]]] = unique_tplus1[comp_tplus1[col]]
+    
+    # convert to {label_tplus1: label_t}, in the order of label_t
+    the_mapping = {the_mapping_reverse[lbl]: lbl for lbl in sorted(the_mapping_reverse)}
+    
+    return the_mapping
+
 def track_nuclei(mask_t, mask_tplus1):
     # mask_t = nucleus_masks_preliminary[0]; mask_tplus1 = nucleus_masks_preliminary[1]
     # problem case:
@@ -79,54 +220,158 @@ def track_nuclei(mask_t, mask_tplus1):
     and one at timepoint t+1, the goal of this function is to make the labeling consistent 
     between the masks of the two timepoints.
 
-    The function will take as input two labeled masks, mask_t and mask_tplus1, go over 
-    each of the labels within mask_t, select the corresponding pixels in mask_tplus1, 
-    and determine which label is most often found in those pixels of mask_tplus1.
+    The function calculates the overlap matrix ij between labels i from mask_t and 
+    labels j from mask_tplus1 (in one pass over the image), and then determines the 
+    one-to-one assignment between i and j that maximizes the total overlap. 
+    Regions in mask_tplus1 then get the label of their matching region in mask_t.
+    This way, two labels at t can never map onto the same label at t+1, and 
+    conflicts are resolved deterministically.
     
-    Note 1: this strategy might lead to lineages ending in 0, leaving that object untracked
+    Note: this strategy might lead to lineages ending in 0, leaving that object untracked
     in all subsequent frames.
     
-    Note 2: a more sophisticated approach would be to calculate an overlap matrix ij between
-    labels i from mask_t and labels j from mask_tplus1, but this would be more computationally
-    expensive, and the result would be the same. (The advantage of that would be to more 
-    easily identify problem cases with multiple overlaps.)
+    Returns the corrected mask_tplus1, and the mapping {label_tplus1: label_t}.
     '''
     
-    # obtain non-zero labels from mask_t
-    mask_t_labels = np.unique(mask_t)
-    mask_t_labels = mask_t_labels[mask_t_labels>0]
+    # determine overlaps between labels, and the optimal assignment
+    labels_t, labels_tplus1, overlaps = overlap_matrix(mask_t, mask_tplus1)
+    the_mapping = assign_overlapping_labels(labels_t, labels_tplus1, overlaps)
+    
+    # create the corrected mask using a lookup table, unmatched regions become 0
+    label_lookup = np.zeros(int(mask_tplus1.max()) + 1 if mask_tplus1.size > 0 else 1, dtype=mask_t.dtype)
+    for label_tplus1, lbl in the_mapping.items():
+        label_lookup[label_tplus1] = lbl
+    mask_tplus1_corrected = label_lookup[mask_tplus1]
+    
+    return mask_tplus1_corrected, the_mapping
+
+def label_centroids(mask):
+    '''
+    The labels present in a mask (sorted) and their centroids (array of 
+    rows, cols), from labeled sums over the labeled pixels. Also used to 
+    place the labels in the plots (instead of regionprops).
+    '''
+    
+    mask_flat = np.asarray(mask).ravel()
+    pixel_index = np.flatnonzero(mask_flat)
+    labels_px = mask_flat[pixel_index]
+    rows, cols = np.divmod(pixel_index, mask.shape[1])
+    label_counts = np.bincount(labels_px)
+    labels = np.flatnonzero(label_counts)
+    centroids = np.stack([np.bincount(labels_px, weights=rows)[labels], np.bincount(labels_px, weights=cols)[labels]], axis=1) / label_counts[labels, None]
+    
+    return labels, centroids
+
+class CentroidTracker:
+    '''
+    Links the nuclei of consecutive frames by their centroids, as an 
+    alternative to track_nuclei (label propagation by overlap).
+    
+    Each frame, the detections (labels of a segmented mask) are matched to 
+    the tracks that were seen in the last max_gap+1 frames: candidate pairs 
+    within max_distance pixels are found with a KD-tree (instead of all 
+    track-detection distances), and the one-to-one assignment with the 
+    smallest distances is solved per group of nearby candidates (see 
+    assign_overlapping_labels). Tracks that are missing for up to max_gap 
+    frames (e.g. a nucleus that drops out of the segmentation) therefore
+    keep their label, and detections without a match start a new track
+    with a new label. Linking is linear in the number of nuclei per frame.
+    
+    Usage (frame by frame, also in streaming mode):
+        tracker = CentroidTracker(max_distance=20, max_gap=2)
+        for mask in nucleus_masks_preliminary:
+            mask_tracked, the_mapping = tracker.link(mask)
+    '''
     
-    # create a new label mask in which to store each of the corrected labeled regions
-    mask_tplus1_corrected = np.zeros_like(mask_tplus1)
+    def __init__(self, max_distance=20, max_gap=2):
+        
+        self.max_distance = max_distance
+        self.max_gap = max_gap
+        self.time_index = -1
+        # the tracks that can still be linked: label, last centroid and the frame it was last seen
+        self.track_labels = np.empty(0, dtype=np.int64)
+        self.track_centroids = np.empty((0, 2))
+        self.track_last_seen = np.empty(0, dtype=np.int64)
+        self.next_label = 1
     
-    # now for each label check with which label in t+1 they overlap most
-    the_mapping = {}
-    for lbl in mask_t_labels:
-        # lbl=2
+    def link(self, mask):
+        '''
+        Link the nuclei in mask (the segmentation of the next frame) to the tracks.
+        Returns the mask with track labels, and the mapping {label: track label}.
+        '''
+        
+        self.time_index += 1
+        labels, centroids = label_centroids(mask)
+        
+        # tracks that were lost more than max_gap frames ago can't be linked anymore
+        active = self.track_last_seen >= self.time_index - self.max_gap - 1
+        self.track_labels, self.track_centroids, self.track_last_seen = \
+            self.track_labels[active], self.track_centroids[active], self.track_last_seen[active]
+        
+        # candidate pairs within max_distance, weighted such that closer pairs are preferred
+        the_mapping = {}
+        if (len(labels) > 0) and (len(self.track_labels) > 0):
+            candidates = cKDTree(self.track_centroids).sparse_distance_matrix(cKDTree(centroids), self.max_distance, output_type='ndarray')
+            the_mapping = assign_overlapping_labels(candidates['i'], candidates['j'], self.max_distance + 1 - candidates['v'])
+            # assign_overlapping_labels gives {detection index: track index}
+            the_mapping = {labels[detection_idx]: self.track_labels[track_idx] for detection_idx, track_idx in the_mapping.items()}
+        
+        # new tracks for the detections without a match
+        for lbl in labels:
+            if lbl not in the_mapping:
+                the_mapping[lbl] = self.next_label
+                self.next_label += 1
         
-        overlapping_labels = mask_tplus1[mask_t == lbl]
-            # test case
-            # overlapping_labels = np.array([0, 10, 10, 10, 2, 10, 10, 10, 3, 3, 0 , 0, 0, 0, 0, 0, 0])        
-            
-        # get the label that's most frequent non-zero value (mode)            
-        # first, determine the frequency of the labels in the corresponding area in the previous frame
-        label_frequency = np.bincount(overlapping_labels)
-        # if non-zero values found, take the most frequent value (mode)
-        if len(label_frequency)>1:
-            mode_label = label_frequency[1:].argmax()+1 # remove 0; hence also +1
-        # if no non-zero labels are found, make it zero (will be ignored later)
-        else:
-            mode_label = 0
-                
-        # now assing that at the correct position in the updated mask
-        # we have determined mode_label to be the matching label in the t+1 frame
-        # this matches lbl in the frame t. 
-        # so we need to set all positions of the mode_label to the label
-        # consistent with the frame t, ie lbl.
-        if (not mode_label==0):
-            mask_tplus1_corrected[mask_tplus1==mode_label] = lbl
-            
-            # save how labels are updated
-            the_mapping[mode_label] = lbl # currently for debugging, could be used also
-    
-    return mask_tplus1_corrected, the_mapping
\ No newline at end of file
+        # update the tracks with the linked detections
+        track_index = {track_lbl: track_idx for track_idx, track_lbl in enumerate(self.track_labels)}
+        new_tracks = []
+        for detection_idx, lbl in enumerate(labels):
+            track_lbl = the_mapping[lbl]
+            if track_lbl in track_index:
+                self.track_centroids[track_index[track_lbl]] = centroids[detection_idx]
+                self.track_last_seen[track_index[track_lbl]] = self.time_index
+            else:
+                new_tracks.append((track_lbl, centroids[detection_idx]))
+        if len(new_tracks) > 0:
+            self.track_labels = np.append(self.track_labels, [track_lbl for track_lbl, _ in new_tracks])
+            self.track_centroids = np.concatenate([self.track_centroids, [centroid for _, centroid in new_tracks]])
+            self.track_last_seen = np.append(self.track_last_seen, np.full(len(new_tracks), self.time_index))
+        
+        # relabel the mask using a lookup table (track labels can outgrow the dtype of mask)
+        label_lookup = np.zeros(int(labels[-1]) + 1 if len(labels) > 0 else 1, dtype=np.promote_types(mask.dtype, mask_dtype(self.next_label-1)))
+        label_lookup[list(the_mapping.keys())] = list(the_mapping.values())
+        
+        return label_lookup[mask], the_mapping
+
+def present_labels(mask):
+    '''The labels (> 0) that are present in a mask, sorted.'''
+    
+    return np.flatnonzero(np.bincount(np.asarray(mask).ravel())[1:]) + 1
+
+def track_table(nucleus_masks_tracked):
+    '''
+    Compact track index: which cell (label) is present in which frame.
+    After tracking, most labels are only present in part of the frames 
+    (lineages can end in 0, and labels of frame 0 are kept), so this
+    lists only the present (Frame, Cell) pairs, with the nucleus Area 
+    (pixels), ordered by frame and cell. One labeled count per frame.
+    '''
+    
+    frames, cells, areas = [], [], []
+    for time_index in range(len(nucleus_masks_tracked)):
+        label_counts = np.bincount(np.asarray(nucleus_masks_tracked[time_index]).ravel())
+        cells_current = np.flatnonzero(label_counts[1:]) + 1
+        frames.append(np.full(len(cells_current), time_index))
+        cells.append(cells_current)
+        areas.append(label_counts[cells_current])
+    
+    return pd.DataFrame({'Frame': np.concatenate(frames).astype(np.int32) if frames else np.empty(0, np.int32),
+                         'Cell': np.concatenate(cells).astype(np.int32) if cells else np.empty(0, np.int32),
+                         'Area': np.concatenate(areas).astype(np.int32) if areas else np.empty(0, np.int32)})
+
+def cells_per_frame(df_tracks, num_frames):
+    '''The cells present in each frame (list of sorted label arrays), from a track table (see track_table).'''
+    
+    frame_starts = np.searchsorted(df_tracks['Frame'].values, np.arange(1, num_frames))
+    
+    return np.split(df_tracks['Cell'].values, frame_starts)
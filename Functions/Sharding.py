@@ -0,0 +1,289 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import threading
+
+# Sharded batch execution: several workers (processes, possibly on different
+# machines with a shared filesystem) process the files of one manifest into the
+# same output folder. Each worker claims a file by creating a lock file (atomic,
+# see FileClaim), processes it, and writes a completion marker; finished files
+# are skipped by all workers, also after a restart. The bookkeeping is in the
+# shards folder of the output folder:
+#   manifest.txt                 the files, in the order of the combined results
+#   <entry>.lock                 claimed by a worker (refreshed while it works)
+#   <entry>.done, <entry>.failed completion markers (json, with the samples)
+#   run_report_<worker>.csv      run report per worker
+#   merge.lock, merge.done       claim and marker of the combined results, such
+#                                that only one worker creates them
+SHARDS_FOLDER = 'shards'
+MANIFEST_FILE = 'manifest.txt'
+MERGE_ENTRY = 'merge'
+
+def shards_folder(output_folder):
+    return os.path.join(output_folder, SHARDS_FOLDER)
+
+def worker_name():
+    '''Name of this worker: host name and process id.'''
+
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def read_manifest(manifest_path):
+    '''
+    Read a manifest: one input file per line (empty lines and lines starting
+    with # are skipped). Relative paths are relative to the manifest's folder.
+    '''
+
+    with open(manifest_path) as f:
+        lines = [line.strip() for line in f.read().splitlines()]
+
+    return [os.path.join(os.path.dirname(os.path.abspath(manifest_path)), line)
+                for line in lines if (line != '') and not line.startswith('#')]
+
+def write_json_atomic(path, data):
+    '''Write data to a json file, such that readers never see a partial file.'''
+
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+def link_exclusive(source_path, path):
+    '''
+    Put the complete file source_path at path, only if path doesn't exist yet
+    (FileExistsError otherwise). With a hard link (os.link) this is atomic, and
+    other workers see the whole file or none. On filesystems without hard links
+    (e.g. some SMB/CIFS mounts), path is created with O_CREAT|O_EXCL (also 
+    atomic) and the contents are copied, such that others can briefly see a 
+    partial file; readers of these files allow for that.
+    '''
+
+    try:
+        os.link(source_path, path)
+    except FileExistsError:
+        raise
+    except OSError:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        with os.fdopen(fd, 'wb') as f, open(source_path, 'rb') as source:
+            shutil.copyfileobj(source, f)
+
+def record_manifest(output_folder, file_paths):
+    '''
+    Record the files of the run in the shards folder (the first worker does
+    this), or check that they are the same files as those of the workers that
+    started before (by file name, such that the shared filesystem can be mounted
+    at different paths on different machines). Returns the entry names of the
+    files (see entry_name).
+    '''
+
+    os.makedirs(shards_folder(output_folder), exist_ok=True)
+    manifest_path = os.path.join(shards_folder(output_folder), MANIFEST_FILE)
+    file_names = [os.path.basename(file_path) for file_path in file_paths]
+
+    # link_exclusive fails if the manifest exists, such that only one worker records it
+    temp_path = f"{manifest_path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(''.join(file_path + '\n' for file_path in file_paths))
+    try:
+        link_exclusive(temp_path, manifest_path)
+    except FileExistsError:
+        # (without hard links, the manifest might still be being written, see link_exclusive)
+        for _ in range(10):
+            recorded_names = [os.path.basename(file_path) for file_path in read_manifest(manifest_path)]
+            if recorded_names == file_names:
+                break
+            time.sleep(0.5)
+        else:
+            raise ValueError(f"The files to process differ from those in {manifest_path}, which was recorded by "
+                             "an earlier worker; use a different output folder for a different set of files")
+    finally:
+        os.remove(temp_path)
+
+    return [entry_name(index, file_path) for index, file_path in enumerate(file_paths)]
+
+def recorded_files(output_folder):
+    '''The files recorded by record_manifest, and their entry names.'''
+
+    file_paths = read_manifest(os.path.join(shards_folder(output_folder), MANIFEST_FILE))
+
+    return file_paths, [entry_name(index, file_path) for index, file_path in enumerate(file_paths)]
+
+def entry_name(index, file_path):
+    '''Name of the bookkeeping files of a manifest entry (unique, also if file names repeat).'''
+
+    return f"{index:05d}_{os.path.basename(file_path)}"
+
+def marker_path(output_folder, entry, kind):
+    '''Path of the lock file (kind 'lock') or completion marker ('done', 'failed') of an entry.'''
+
+    return os.path.join(shards_folder(output_folder), f"{entry}.{kind}")
+
+def write_marker(output_folder, entry, kind, file_path, samples):
+    '''Write the completion marker of an entry, with the samples that have results.'''
+
+    write_json_atomic(marker_path(output_folder, entry, kind),
+                      {'file': os.path.basename(file_path), 'samples': samples, 'worker': worker_name(),
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S')})
+
+def remove_marker(output_folder, entry, kind):
+    '''Remove a completion marker, if it exists.'''
+
+    try:
+        os.remove(marker_path(output_folder, entry, kind))
+    except FileNotFoundError:
+        pass
+
+def read_marker(output_folder, entry):
+    '''
+    The completion marker of an entry, as (kind, marker dict), with kind
+    'done' or 'failed', or (None, None) if the entry isn't finished.
+    '''
+
+    for kind in ['done', 'failed']:
+        try:
+            with open(marker_path(output_folder, entry, kind)) as f:
+                return kind, json.load(f)
+        except FileNotFoundError:
+            pass
+
+    return None, None
+
+def filesystem_time(output_folder):
+    '''
+    The current time of the (shared) filesystem, such that the modification
+    times of lock files written by other machines can be compared with it,
+    also if the clocks of the machines differ.
+    '''
+
+    clock_path = os.path.join(shards_folder(output_folder), f".clock_{worker_name()}")
+    with open(clock_path, 'w'):
+        pass
+    mtime = os.path.getmtime(clock_path)
+    os.remove(clock_path)
+
+    return mtime
+
+class FileClaim:
+    '''
+    Claim of one manifest entry by this worker, with a lock file in the shards
+    folder. The lock file is created with O_CREAT|O_EXCL, which is atomic (also
+    on NFS v3+ and SMB), such that only one worker gets the claim. While the
+    claim is held, a background thread refreshes the modification time of the
+    lock file every lock_timeout/4 seconds. The lock of a worker that crashed
+    is taken over when it wasn't refreshed for lock_timeout seconds, or right
+    away if the worker ran on this machine and its process is gone.
+
+    Usage:
+        claim = FileClaim(output_folder, entry, lock_timeout)
+        if claim.acquire():
+            try:
+                ...
+            finally:
+                claim.release()
+    '''
+
+    def __init__(self, output_folder, entry, lock_timeout=600):
+
+        self.output_folder = output_folder
+        self.entry = entry
+        self.lock_timeout = lock_timeout
+        self.lock_path = marker_path(output_folder, entry, 'lock')
+        self.token = uuid.uuid4().hex
+        self.stop_heartbeat = threading.Event()
+        self.heartbeat = None
+
+    def acquire(self):
+        '''Try to claim the entry, returns whether it was claimed.'''
+
+        # at most twice: if the first attempt finds a stale lock, it's removed
+        for _ in range(2):
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.remove_stale_lock():
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'worker': worker_name(), 'host': socket.gethostname(), 'pid': os.getpid(), 'token': self.token}, f)
+            self.heartbeat = threading.Thread(target=self.refresh_lock, daemon=True)
+            self.heartbeat.start()
+            return True
+
+        return False
+
+    def refresh_lock(self):
+        while not self.stop_heartbeat.wait(self.lock_timeout/4):
+            try:
+                os.utime(self.lock_path)
+            except FileNotFoundError:
+                pass
+
+    def is_stale(self, lock_info, lock_mtime):
+        '''Whether a lock (its contents and modification time) belongs to a worker that is gone.'''
+
+        if filesystem_time(self.output_folder) - lock_mtime > self.lock_timeout:
+            return True
+        # a worker on this machine of which the process is gone (not on windows, where
+        # os.kill would stop the process)
+        if (os.name != 'nt') and (lock_info.get('host') == socket.gethostname()) and (lock_info.get('pid') != os.getpid()):
+            try:
+                os.kill(lock_info['pid'], 0)
+            except ProcessLookupError:
+                return True
+            except (PermissionError, KeyError, TypeError):
+                pass
+
+        return False
+
+    def remove_stale_lock(self):
+        '''
+        Remove the lock file if it is stale, returns whether it was removed.
+        The lock is first renamed (atomic, so at most one worker can do this),
+        and put back if it turns out to be a new lock of another worker.
+        '''
+
+        try:
+            lock_mtime = os.path.getmtime(self.lock_path)
+            with open(self.lock_path) as f:
+                lock_info = json.load(f)
+        except (FileNotFoundError, ValueError):
+            # removed in the meantime, or still being written
+            return False
+        if not self.is_stale(lock_info, lock_mtime):
+            return False
+
+        stale_path = f"{self.lock_path}.stale-{self.token}"
+        try:
+            os.rename(self.lock_path, stale_path)
+        except FileNotFoundError:
+            return False
+        try:
+            with open(stale_path) as f:
+                renamed_info = json.load(f)
+        except ValueError:
+            renamed_info = {}
+        if renamed_info.get('token') != lock_info.get('token'):
+            # another worker claimed the entry in between
+            try:
+                link_exclusive(stale_path, self.lock_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        print(f"Taking over {self.entry} from worker {lock_info.get('worker')}, which stopped")
+
+        return True
+
+    def release(self):
+
+        self.stop_heartbeat.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+            self.heartbeat = None
+        try:
+            os.remove(self.lock_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,64 @@
+import numpy as np
+
+def make_synthetic_stack(num_frames=10, num_cells=25, image_size=256, num_channels=3,
+                         nucleus_radius=6, cytoplasm_radius=12, step_size=1.0,
+                         ratio_start=0.5, ratio_end=2.0, noise_level=10, background=100, seed=0):
+    '''
+    Create a synthetic translocation reporter stack (T,C,Y,X, uint16), with
+    known nuclei, motion and cytoplasm/nucleus ratios.
+
+    Channel 0 is the nuclear channel (bright nuclei only). The other channels
+    are reporter channels, in which the cytoplasm/nucleus intensity ratio
+    changes linearly from ratio_start to ratio_end over time (reporter
+    channel c is shifted by c frames, such that channels differ).
+    Cells are placed on a jittered grid (such that they don't overlap) and move
+    as a random walk with step_size pixels per frame.
+
+    Returns the stack and a dict with the ground truth: 'centers' (T, cells, 2),
+    'ratios' (T, reporter channels) and 'nucleus_intensity' (reporter channels).
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    # place cells on a grid, with some jitter
+    grid_size = int(np.ceil(np.sqrt(num_cells)))
+    spacing = image_size / grid_size
+    grid_y, grid_x = np.divmod(np.arange(num_cells), grid_size)
+    centers_start = np.stack([(grid_y + 0.5) * spacing, (grid_x + 0.5) * spacing], axis=1)
+    centers_start += rng.uniform(-0.1, 0.1, size=centers_start.shape) * spacing
+
+    # random walk, kept away from the image border
+    steps = rng.normal(0, step_size, size=(num_frames, num_cells, 2))
+    steps[0] = 0
+    centers = np.clip(centers_start + np.cumsum(steps, axis=0), cytoplasm_radius, image_size - cytoplasm_radius - 1)
+
+    # cytoplasm/nucleus ratio per frame and reporter channel
+    num_reporters = num_channels - 1
+    time_fraction = (np.arange(num_frames)[:, None] + np.arange(num_reporters)[None, :]) / max(num_frames + num_reporters - 2, 1)
+    ratios = ratio_start + (ratio_end - ratio_start) * np.clip(time_fraction, 0, 1)
+    nucleus_intensity = 300 + 100 * np.arange(num_reporters)
+
+    stack = np.zeros((num_frames, num_channels, image_size, image_size), dtype=np.uint16)
+    # only the area around each cell has to be drawn
+    box = np.arange(-cytoplasm_radius, cytoplasm_radius + 1)
+    for frm in range(num_frames):
+
+        nucleus = np.zeros((image_size, image_size), dtype=bool)
+        cytoplasm = np.zeros((image_size, image_size), dtype=bool)
+        for center_y, center_x in centers[frm]:
+            rows = np.round(center_y).astype(int) + box
+            cols = np.round(center_x).astype(int) + box
+            distance_squared = (rows[:, None] - center_y)**2 + (cols[None, :] - center_x)**2
+            nucleus[np.ix_(rows, cols)] |= distance_squared <= nucleus_radius**2
+            cytoplasm[np.ix_(rows, cols)] |= (distance_squared > nucleus_radius**2) & (distance_squared <= cytoplasm_radius**2)
+        cytoplasm &= ~nucleus
+
+        noise = rng.normal(background, noise_level, size=(num_channels, image_size, image_size))
+        stack[frm, 0] = np.clip(noise[0] + 1000 * nucleus, 0, 65535)
+        for reporter_idx in range(num_reporters):
+            signal = nucleus_intensity[reporter_idx] * (nucleus + ratios[frm, reporter_idx] * cytoplasm)
+            stack[frm, reporter_idx + 1] = np.clip(noise[reporter_idx + 1] + signal, 0, 65535)
+
+    ground_truth = {'centers': centers, 'ratios': ratios, 'nucleus_intensity': nucleus_intensity}
+
+    return stack, ground_truth
@@ -0,0 +1,225 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage.filters import threshold_otsu
+
+import Functions.Segmentation as TRseg
+
+# Tiled processing of very large frames (e.g. stitched tile scans), such that
+# the intermediate arrays of segmentation, cytoplasm rings and background
+# detection are only as large as a tile (plus overlap), and tiles can be
+# processed in parallel. The nucleus labels of the tiles are stitched into
+# one mask with one label per nucleus, on which tracking and measurement run as usual.
+# The overlap should be larger than the nuclei (and the cytoplasm rings),
+# then the results are the same as for full frames, away from edge effects.
+
+def tile_slices(shape, tile_size, tile_overlap):
+    '''
+    Divide a frame of the given shape in tiles of tile_size x tile_size pixels.
+    Returns a list of (core, padded, core_in_padded): the slices of the tile
+    in the frame, of the tile extended by tile_overlap pixels on each side
+    (within the frame), and of the tile within the extended tile.
+    '''
+
+    tiles = []
+    for row_start in range(0, shape[0], tile_size):
+        for col_start in range(0, shape[1], tile_size):
+            row_end, col_end = min(row_start + tile_size, shape[0]), min(col_start + tile_size, shape[1])
+            padded_row_start, padded_col_start = max(row_start - tile_overlap, 0), max(col_start - tile_overlap, 0)
+            padded_row_end, padded_col_end = min(row_end + tile_overlap, shape[0]), min(col_end + tile_overlap, shape[1])
+            tiles.append(((slice(row_start, row_end), slice(col_start, col_end)),
+                          (slice(padded_row_start, padded_row_end), slice(padded_col_start, padded_col_end)),
+                          (slice(row_start - padded_row_start, row_end - padded_row_start), slice(col_start - padded_col_start, col_end - padded_col_start))))
+
+    return tiles
+
+def map_tiles(function, tiles, num_workers=1):
+    '''Apply function to each tile, in a thread pool if num_workers > 1 (skimage/scipy release the GIL).'''
+
+    if num_workers > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            return list(executor.map(function, tiles))
+
+    return [function(tile) for tile in tiles]
+
+def threshold_otsu_tiled(image, tiles):
+    '''
+    Otsu threshold of the whole image, from the histograms of the tiles
+    (integer images, the same as threshold_otsu(image)), or of the whole
+    image otherwise.
+    '''
+
+    if not np.issubdtype(image.dtype, np.integer):
+        return threshold_otsu(np.asarray(image))
+
+    # histogram of the integer values, added up over the tiles
+    value_min = min(int(image[core].min()) for core, _, _ in tiles)
+    counts = np.zeros(0, dtype=np.int64)
+    for core, _, _ in tiles:
+        counts_tile = np.bincount((image[core].ravel() - value_min).astype(np.intp, copy=False))
+        if len(counts_tile) > len(counts):
+            counts = np.pad(counts, (0, len(counts_tile) - len(counts)))
+        counts[:len(counts_tile)] += counts_tile
+
+    return threshold_otsu(hist=(counts, np.arange(len(counts)) + value_min))
+
+def segment_nucleus_tiled(image, tile_size=2048, tile_overlap=64, num_workers=1, out=None, **segment_kwargs):
+    '''
+    Tiled version of TRseg.segment_nucleus: the Otsu threshold is determined on
+    the whole image (from the histograms of the tiles), each tile (plus overlap)
+    is cleaned up and labeled separately, and the labels are stitched such that
+    nuclei that cross tile borders get one label (see stitch_tile_labels).
+    The labels are numbered like segment_nucleus (in order of their first pixel).
+    The labeled mask is written in out (e.g. a frame of a mask stack) if given,
+    otherwise it's returned as uint16 (or uint32, see TRseg.compact_labels).
+    Additional keyword arguments are passed on to TRseg.clean_and_label.
+    '''
+
+    tiles = tile_slices(image.shape, tile_size, tile_overlap)
+    thresh = threshold_otsu_tiled(image, tiles)
+    return_compact = out is None
+    if out is None:
+        out = np.zeros(image.shape, dtype=np.uint32)
+
+    def segment_tile(tile):
+        core, padded, core_in_padded = tile
+        labels_tile = TRseg.clean_and_label(np.asarray(image[padded]) > thresh, **segment_kwargs)[core_in_padded]
+        out[core] = labels_tile
+        return int(labels_tile.max()) if labels_tile.size > 0 else 0
+
+    num_labels_per_tile = map_tiles(segment_tile, tiles, num_workers)
+    # before stitching, the labels of all tiles are numbered consecutively
+    if sum(num_labels_per_tile) > np.iinfo(out.dtype).max:
+        raise OverflowError(f"{sum(num_labels_per_tile)} labels in the tiles don't fit in a {out.dtype} mask")
+    stitch_tile_labels(out, tiles, num_labels_per_tile, num_workers)
+
+    return TRseg.compact_labels(out) if return_compact else out
+
+def stitch_tile_labels(labels, tiles, num_labels_per_tile, num_workers=1):
+    '''
+    Make the labels of the tiles (each numbered from 1, in place in labels)
+    unique over the whole frame, and merge labels that touch across the borders
+    between tiles (8-connectivity, like skimage.measure.label).
+    The final labels are numbered 1..N in order of their first pixel (row by row).
+    '''
+
+    # unique labels per tile, by adding an offset
+    label_offsets = np.concatenate([[0], np.cumsum(num_labels_per_tile)[:-1]])
+    num_labels = int(np.sum(num_labels_per_tile))
+    def offset_tile(tile_and_offset):
+        (core, _, _), label_offset = tile_and_offset
+        labels_tile = labels[core]
+        labels_tile[labels_tile > 0] += labels_tile.dtype.type(label_offset)
+    map_tiles(offset_tile, list(zip(tiles, label_offsets)), num_workers)
+
+    # pairs of labels that touch across the borders between tiles (also diagonally)
+    pairs = []
+    row_borders = sorted({core[0].start for core, _, _ in tiles} - {0})
+    col_borders = sorted({core[1].start for core, _, _ in tiles} - {0})
+    borders = [(labels[row-1, :], labels[row, :]) for row in row_borders] + [(labels[:, col-1], labels[:, col]) for col in col_borders]
+    for labels_before, labels_after in borders:
+        for labels_a, labels_b in [(labels_before, labels_after), (labels_before[:-1], labels_after[1:]), (labels_before[1:], labels_after[:-1])]:
+            touching = (labels_a > 0) & (labels_b > 0)
+            pairs.append(np.stack([labels_a[touching], labels_b[touching]]))
+    pairs = np.concatenate(pairs, axis=1) if len(pairs) > 0 else np.zeros((2, 0), dtype=np.int64)
+    graph = coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])), shape=(num_labels+1, num_labels+1))
+    _, component_per_label = connected_components(graph, directed=False)
+
+    # the first pixel (flat index in the frame) of each label
+    no_pixel = np.iinfo(np.int64).max
+    first_pixel = np.full(num_labels+1, no_pixel, dtype=np.int64)
+    for core, _, _ in tiles:
+        labels_tile, first_index_tile = np.unique(labels[core], return_index=True)
+        rows, cols = np.divmod(first_index_tile, core[1].stop - core[1].start)
+        np.minimum.at(first_pixel, labels_tile, (rows + core[0].start) * labels.shape[1] + cols + core[1].start)
+
+    # number the merged labels in order of their first pixel
+    first_pixel_component = np.full(component_per_label.max()+1, no_pixel, dtype=np.int64)
+    np.minimum.at(first_pixel_component, component_per_label[1:], first_pixel[1:])
+    components_present = np.flatnonzero(first_pixel_component < no_pixel)
+    components_ordered = components_present[np.argsort(first_pixel_component[components_present], kind='stable')]
+    label_per_component = np.zeros(len(first_pixel_component), dtype=labels.dtype)
+    label_per_component[components_ordered] = np.arange(1, len(components_ordered)+1)
+    label_lookup = label_per_component[component_per_label]
+    label_lookup[0] = 0
+
+    def relabel_tile(tile):
+        core, _, _ = tile
+        labels[core] = label_lookup[labels[core]]
+    map_tiles(relabel_tile, tiles, num_workers)
+
+    return labels
+
+def create_cytoplasm_roi_tiled(nucleus_mask, tile_size=2048, tile_overlap=64, num_workers=1, out=None, **cytoplasm_kwargs):
+    '''
+    Tiled version of TRseg.create_cytoplasm_roi: the rings are created per tile
+    (plus overlap), which gives the same rings as for the whole frame if the
+    overlap is larger than the ring (dilation_radius + margin_radius).
+    The mask is written in out if given.
+    '''
+
+    ring_width = cytoplasm_kwargs.get('dilation_radius', 5) + cytoplasm_kwargs.get('margin_radius', 0)
+    if tile_overlap <= ring_width:
+        raise ValueError(f"The tile overlap ({tile_overlap}) should be larger than the cytoplasm ring ({ring_width} pixels)")
+    if out is None:
+        out = np.zeros_like(nucleus_mask)
+
+    def ring_tile(tile):
+        core, padded, core_in_padded = tile
+        out[core] = TRseg.create_cytoplasm_roi(np.asarray(nucleus_mask[padded]), **cytoplasm_kwargs)[core_in_padded]
+    map_tiles(ring_tile, tile_slices(nucleus_mask.shape, tile_size, tile_overlap), num_workers)
+
+    return out
+
+def get_background_bbox_tiled(img_int, ESTIMATED_OBJECT_RADIUS=30, tile_size=2048, num_workers=1):
+    '''
+    Tiled version of TRcorrect.get_background_bbox: the box in the region with
+    the lowest (maximum-filtered) intensity, as far as possible from brighter
+    pixels. The maximum filter is done per tile (plus overlap), and the
+    distance transform only for the tiles that contain the lowest value.
+    Distances are only determined up to the overlap (a few times the box size),
+    so in a large dark region a different (equally valid) box can be chosen
+    than for the whole frame.
+    Returns the box as (min_row, min_col, max_row, max_col).
+    '''
+
+    background_mask_size_odd = ESTIMATED_OBJECT_RADIUS + 1 if ESTIMATED_OBJECT_RADIUS % 2 == 0 else ESTIMATED_OBJECT_RADIUS
+    background_mask_halfsize = background_mask_size_odd//2
+    # overlap for the maximum filter, and for the distances
+    tile_overlap = 4 * background_mask_size_odd
+    tiles = tile_slices(img_int.shape, tile_size, tile_overlap)
+
+    def max_filter_tile(tile):
+        core, padded, core_in_padded = tile
+        return ndimage.maximum_filter(np.asarray(img_int[padded]), size=background_mask_size_odd)
+
+    # the lowest value after the maximum filter (over the whole image)
+    min_per_tile = map_tiles(lambda tile: max_filter_tile(tile)[tile[2]].min(), tiles, num_workers)
+    lowest_value = min(min_per_tile)
+
+    def distance_tile(tile):
+        # the largest distance to brighter pixels, away from the image border; returns (distance, flat index)
+        core, padded, core_in_padded = tile
+        low_mask = max_filter_tile(tile) == lowest_value
+        # the padded tile is surrounded by brighter pixels (distances are at most the overlap)
+        mask_distance = ndimage.distance_transform_edt(np.pad(low_mask, 1))[1:-1, 1:-1][core_in_padded]
+        rows = np.arange(core[0].start, core[0].stop)
+        cols = np.arange(core[1].start, core[1].stop)
+        mask_distance[(rows < background_mask_halfsize) | (rows >= img_int.shape[0] - background_mask_halfsize), :] = -1
+        mask_distance[:, (cols < background_mask_halfsize) | (cols >= img_int.shape[1] - background_mask_halfsize)] = -1
+        max_idx = np.argmax(mask_distance)
+        max_row, max_col = np.unravel_index(max_idx, mask_distance.shape)
+        return mask_distance.flat[max_idx], (max_row + core[0].start) * img_int.shape[1] + max_col + core[1].start
+
+    tiles_lowest = [tile for tile, min_tile in zip(tiles, min_per_tile) if min_tile == lowest_value]
+    distances = map_tiles(distance_tile, tiles_lowest, num_workers)
+    # without low pixels away from the border, the first pixel away from the border (like get_background_bbox)
+    distances.append((0, background_mask_halfsize * img_int.shape[1] + background_mask_halfsize))
+    # the largest distance, and the first pixel with that distance (like np.argmax)
+    _, max_flat_index = min(distances, key=lambda distance_and_index: (-distance_and_index[0], distance_and_index[1]))
+    max_loc = np.unravel_index(max_flat_index, img_int.shape)
+
+    return (int(max_loc[0]-background_mask_halfsize), int(max_loc[1]-background_mask_halfsize),
+            int(max_loc[0]+background_mask_halfsize), int(max_loc[1]+background_mask_halfsize))
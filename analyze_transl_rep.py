@@ -1,9 +1,13 @@
 ################################################################################
 
 # Translocation Reporters analysis script
+# (command line interface of the pipeline in Functions/Pipeline.py, which 
+# can also be used directly from python, see TRpipe.run_pipeline)
 
-# Expected tiff file input such that:
-# image_stack.shape = num_timepoints, num_channels, height, width 
+# Expected tiff file input: time-lapse stacks with channels, of which the axis
+# order is taken from the OME/ImageJ metadata (see TRread.to_pipeline_axes);
+# without metadata, num_timepoints, num_channels, height, width is assumed.
+# Each series (position) of a multi-position file is a separate sample.
 
 ################################################################################
 # import libraries
@@ -11,224 +15,191 @@
 
 import os
 import sys
-from glob import glob
-
-import numpy as np
-import tifffile as tiff
-import pandas as pd
 
 ################################################################################
 # Import functions from other files in this repo
 ################################################################################
 
-# sys.path.append('/Users/m.wehrens/Documents/git_repos/_UVA/_SMALL_PROJECTS/2025_analyze_translocation_reporters_Julian/')
-# sys.path.append("/Volumes/sils-mc/13776452/Python_scripts")
-sys.path.append('C:/Users/spalaci/KTRs')
+# The Functions folder is next to this script (when the script is run with 
+# exec(open("analyze_transl_rep.py").read()), __file__ is not defined, then
+# the working directory should be the folder of the script, see README)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd())
 
-import Functions.Segmentation as TRseg # Segmentation & tracking functions
-    # import importlib; importlib.reload(TRseg)
-import Functions.Intensity_measurements as TRmeas
-    # import importlib; importlib.reload(TRmeas)
-import Functions.Image_corrections as TRcorrect
-    # import importlib; importlib.reload(TRcorrect)
-import Functions.Plotting as TRplt
-    # import importlib; importlib.reload(TRplt)
+import Functions.Pipeline as TRpipe
+    # import importlib; importlib.reload(TRpipe)
 
 ################################################################################
-# Settings
+# Command line arguments
 ################################################################################
 
-# Enter/exit interactive mode
-# plt.ion(); plt.ioff()
-# plt.style.use("default")
-
-# Read in settings from command
-if (len(sys.argv) > 1):
-    
-    # automatically load settings when called from command line
-    # note that you can also manually set these parameters and 
-    # execute parts of the script manually
-    
-    input_folder  = sys.argv[1]
-    output_folder = sys.argv[2]
-    AUTO_BACKGROUND_CORRECTION = bool(int(sys.argv[3]))
+# Optional flags with a value, the setting they set (see TRpipe.DEFAULT_SETTINGS) and their type
+OPTIONAL_FLAGS = {'--workers': ('num_workers', int), '--segmentation-workers': ('num_segmentation_workers', int),
+                  '--cache-dir': ('cache_dir', str), '--cache-size-gb': ('cache_size_gb', float),
+                  '--watch-interval': ('watch_interval', float), '--watch-timeout': ('watch_timeout', float),
+                  '--output-format': ('output_format', str), '--plots': ('plots', str),
+                  '--tracking': ('tracking_method', str), '--tile-size': ('tile_size', int), '--tile-overlap': ('tile_overlap', int),
+                  '--manifest': ('manifest', str), '--lock-timeout': ('shard_lock_timeout', float),
+                  '--masks-from': ('masks_from', str)}
+# Optional switches, and the setting they turn on
+OPTIONAL_SWITCHES = {'--lazy': 'lazy_reading', '--watch': 'watch', '--excel': 'excel', '--static-stage': 'static_stage',
+                     '--rasterize-labels': 'rasterize_labels', '--quantile-bands': 'quantile_bands', '--stream': 'stream',
+                     '--features': 'features', '--shard': 'shard', '--export-masks': 'export_masks'}
+
+def parse_arguments(argv):
+    '''
+    Read the settings from the command line arguments, returns a dict with 
+    the settings that are given (the others get their default value in 
+    TRpipe.make_settings).
+    
+    With --config FILE, the settings are first read from a json or toml file
+    (see TRpipe.read_config); arguments on the command line override these.
+    Optional flags are taken out first, these are
+    --workers N, the number of files processed in parallel, 
+    --segmentation-workers N, the number of frames segmented in parallel, and
+    --lazy, to read frames only when needed and keep masks on disk (for large stacks),
+    --cache-dir PATH, to cache the nucleus/cytoplasm masks in PATH, such that reruns
+        of the same file with the same segmentation settings skip segmentation, and
+    --cache-size-gb X, the maximum size of the cache (least recently used entries are removed),
+    --watch, to keep watching the input folder and process new files as they appear,
+    --watch-interval S, the number of seconds between checks for new files, and
+    --watch-timeout S, to stop watching after S seconds without new files,
+    --output-format parquet|csv, the format of the results (default parquet),
+    --static-stage, to determine the background region once per file instead of per frame, and
+    --excel, to also export all results to ALL_results.xlsx,
+    --plots now|later|off, to make the plots after the analysis (default), only save 
+        what is needed to make them later (see TRpipe.plot_output_folder), or not at all, and
+    --rasterize-labels, to save the label plots as png without text boxes (faster for many cells), and
+    --quantile-bands, to show the 10-90% range of the cells per frame in the intensity plots,
+    --stream, to process each file frame by frame (see TRpipe.process_file_streaming),
+    --features, to also measure the area, centroid, integrated intensity and 
+        intensity percentiles of each cell (see TRmeas.measure_intensities_frame_channels),
+    --tracking overlap|centroid, how nuclei are tracked (see TRseg.track_nuclei and TRseg.CentroidTracker),
+    --tile-size N and --tile-overlap N, to process very large frames in tiles of N x N 
+        pixels (see Functions/Tiling.py),
+    --shard, to run as one of several workers (processes or machines) that process
+        the files of the input folder together (see TRpipe.shard_worker), and
+    --manifest FILE, to process the files listed in FILE instead (implies --shard), and
+    --lock-timeout S, after which the files of a worker that stopped are taken over,
+    --export-masks, to export the tracked masks (see TRstore.export_masks), and
+    --masks-from FOLDER, to measure with the masks exported to output folder FOLDER,
+        without segmenting.
+    The remaining arguments are positional: input folder, output folder, 
+    auto background correction (0|1) and the channel mapping (e.g. nucleus 0 PKA 1).
+    '''
+    
+    argv = list(argv)
+    
+    config = {}
+    if '--config' in argv:
+        idx = argv.index('--config')
+        config = TRpipe.read_config(argv[idx+1])
+        del argv[idx:idx+2]
+    
+    # optional flags with a value
+    for flag, (setting, flag_type) in OPTIONAL_FLAGS.items():
+        if flag in argv:
+            idx = argv.index(flag)
+            config[setting] = flag_type(argv[idx+1])
+            del argv[idx:idx+2]
+    # optional switches
+    for switch, setting in OPTIONAL_SWITCHES.items():
+        if switch in argv:
+            config[setting] = True
+            argv.remove(switch)
+    
+    # positional arguments (optional when a config file is used)
+    if len(argv) > 1:
+        config['input_folder'] = argv[1]
+    if len(argv) > 2:
+        config['output_folder'] = argv[2]
+    if len(argv) > 3:
+        config['auto_background_correction'] = bool(int(argv[3]))
     
     # loop over remaining arguments, which map the channels
     # e.g. nucleus 0 PKA 1 indicates nuclear channel is 0 and PKA chanenl is 1
-    MAPPING_CHANNELS = {}
-    for idx in range(4, len(sys.argv)-1, 2):
-        # print(sys.argv[idx], sys.argv[idx+1])
-        MAPPING_CHANNELS[sys.argv[idx]] = int(sys.argv[idx+1])
-    
-    print('Starting script')
-
-else:
-
-    print('='*80)
-    print('Please call this script as follows: \n')
-    print('python analyze_transl_rep.py /input/folder/path/ /output/folder/path/ 0|1 nucleus 0 name1 1 name2 2\n')
-    print('Where respectively folders can be customized, 0 or 1 is chosen to indicate auto background correction, ')
-    print("and 'nucleus 0 ..' indicates in which channel nucleus and custom named channels to analyze can be found.\n")
-    print('Exiting')
-    print('='*80)
-    sys.exit()
-    
-if False:
-    
-    # debugging
-    
-    # Input and output folders
-    # input_folder = "/Users/m.wehrens/Data_UVA/2024_10_Sebastian-KTR/202503_DATA_julian/Forskolin/"
-    # input_folder = "/Users/m.wehrens/Data_UVA/2024_10_Sebastian-KTR/202503_DATA_julian/testdata/"
-    input_folder = "/Users/m.wehrens/Data_UVA/2024_10_Sebastian-KTR/202510_seb-static_DATA/example-data/"
-    output_folder = "/Users/m.wehrens/Data_UVA/2024_10_Sebastian-KTR/202510_seb-static_ANALYSIS/"
-    
-    # SETTINGS
-    # MAPPING_CHANNELS = {'nucleus':0, 'ERK':1, 'PKA':2}
-    MAPPING_CHANNELS = {'nucleus':2, 'ERK':0, 'PKA':1}
-    nuclear_channel = MAPPING_CHANNELS['nucleus']
-    AUTO_BACKGROUND_CORRECTION = False # only use this if there are areas in the picture with no signal
-
-
-
-os.makedirs(output_folder, exist_ok=True)
-nuclear_channel = MAPPING_CHANNELS['nucleus']
-
-######################################################################
-# Functions that constitute the loop below
-# (More sophisticated functions are in other files)
-######################################################################
-
-
-def segment_and_track_nuclei(imgstack_nucleus, output_folder, file_name):
-    # imgstack_nucleus = image_stack[:, nuclear_channel]
-    # Note that some parameters below are defined implicitly by global values
-
-    # segment the nuclei
-    nucleus_masks_preliminary = [TRseg.segment_nucleus(imgstack_nucleus[time_index]) for time_index in range(imgstack_nucleus.shape[0])]
-
-    # For frames t>0, make the labeling consistent with frame t=0
-    # The updated labeling is stored in nucleus_masks_tracked.
-    # To create new labels for a frame, updated information is necessary,
-    # therefor, each frm+1 frame is constructed based nucleus_masks_tracked[frm]
-    # and nucleus_masks_preliminary[frm+1].
-    nucleus_masks_tracked = [nucleus_masks_preliminary[0]]
-    for frm in range(len(nucleus_masks_preliminary)-1):
-        label_maskplus1, _ = TRseg.track_nuclei(nucleus_masks_tracked[frm], nucleus_masks_preliminary[frm+1])
-        nucleus_masks_tracked.extend([label_maskplus1])
-    # Plot the nuclear segmentation and tracking of the first N frames
-    TRplt.plot_labels_framesX(nucleus_masks_tracked, range_start=0, range_end=12, text_xoffset=50, output_folder=output_folder, file_name=file_name, suffix='_nuclei')
-    
-    return np.array(nucleus_masks_tracked), np.array(nucleus_masks_preliminary)
-
-
-def create_cytoplasm_masks(nucleus_masks_tracked, output_folder, file_name, dilation_radius=5, margin_radius=0):
-    
-    cytoplasm_masks_tracked = [TRseg.create_cytoplasm_roi(mask, dilation_radius=dilation_radius, margin_radius=margin_radius) for mask in nucleus_masks_tracked] # tracked in is tracked out :)
-    TRplt.plot_labels_framesX(cytoplasm_masks_tracked, range_start=0, range_end=12, text_xoffset=50, output_folder=output_folder, file_name=file_name, suffix='_cytorings')
-
-    return np.array(cytoplasm_masks_tracked)
-
-
-def calculate_intensity_values_to_df(MAPPING_CHANNELS, thekey, image_stack, nucleus_masks_tracked, cytoplasm_masks_tracked):
-        
-    image_stack_intensity = image_stack[:, MAPPING_CHANNELS[thekey]]
-    
-    # Optional, background correction
-    if AUTO_BACKGROUND_CORRECTION:
-        image_stack_intensity_corrected = np.array([TRcorrect.correct_background(img) for img in image_stack_intensity])
-            # plt.imshow(image_stack_intensity[0]); plt.title('Not corrected'); plt.show(); plt.close()
-            # plt.imshow(image_stack_intensity_corrected[0]); plt.title('Corrected'); plt.show(); plt.close()
-    else:
-        image_stack_intensity_corrected = image_stack_intensity
-    
-    # Determine the intensity alues for all timepoints
-    df_current = \
-        TRmeas.measure_intensities_for_all_timepoints(image_stack_intensity_corrected, nucleus_masks_tracked, cytoplasm_masks_tracked)
+    if len(argv) > 5:
+        mapping_channels = {}
+        for idx in range(4, len(argv)-1, 2):
+            # print(argv[idx], argv[idx+1])
+            mapping_channels[argv[idx]] = int(argv[idx+1])
+        config['mapping_channels'] = mapping_channels
     
-    # Calculate cyto/nucleus ratio
-    df_current['Ratio_cytoplasm_div_nucleus'] = df_current['Intensity_cytoplasm']/df_current['Intensity_nucleus']
-    # Add key to the df
-    df_current['Key'] = thekey
-    # Add sample filename to df
-    df_current['Sample'] = file_name
-        
-    return df_current
-        
-def check_dimensions_img(img):
-    ''' 
-    Check if there are three or four dimensions.
-    If there are three, assume these are channels, x, y, and add a 
-    time dimension at the front.
-    ''' 
-    
-    # If 4 dims everything OK
-    if len(img.shape) == 4:
-        return img
-    if len(img.shape) == 3:
-        img_expanded = np.expand_dims(img, axis=0)
-        print('Warning: image has 3 dimensions instead of expected 4, assuming time dimensions is missing, and adding it.')
-        return img_expanded
-    
-    raise ValueError('Image has unexpected number of dimensions, expected 3 or 4, got {0}'.format(len(img.shape)))
-        
-        
-######################################################################
-# Main loop
-################################################################################
-
-
-# loop over tif files in input directory
-# for each file, separately analyze and create a csv output file
-df_list=[]
-for file_path in glob(os.path.join(input_folder, "*.tif")):
-    # file_path = glob(os.path.join(input_folder, "*.tif"))[0]
-    
-    # Read current file        
-    print(f"Processing file: {file_path}")
-    image_stack = check_dimensions_img(tiff.imread(file_path))
-    file_name = os.path.splitext(os.path.basename(file_path))[0] # used further down
-
-    # Segment the nuclei and track them such that labels are consistent throughout segmentation
-    nucleus_masks_tracked, nucleus_masks_preliminary = segment_and_track_nuclei(image_stack[:, nuclear_channel], output_folder, file_name)
-
-    # Create the cytoplasmic regions (regions of interest, ROI), and plot the rings of the first N frames
-    cytoplasm_masks_tracked = create_cytoplasm_masks(nucleus_masks_tracked, output_folder, file_name, dilation_radius=5, margin_radius=0)
-
-    # Now go over the channels and calculate the intensities (and ratios) for both
-    keys_to_plot = [key for key in list(MAPPING_CHANNELS.keys()) if not (key=='nucleus')]
-    for thekey in keys_to_plot: # thekey = keys_to_plot[1]
-    
-        df_current = calculate_intensity_values_to_df(MAPPING_CHANNELS, thekey, image_stack, nucleus_masks_tracked, cytoplasm_masks_tracked)
-                
-        # export current df
-        df_current.to_csv(os.path.join(output_folder, f"{file_name}_{thekey}_results.csv"), index=False)
-        df_current.to_excel(os.path.join(output_folder, f"{file_name}_{thekey}_results.xlsx"), index=False)
-        # save current df to list
-        df_list.append(df_current)
-
-
-# concatenate all dfs
-df_data_all = pd.concat(df_list, ignore_index=True)
-# df_data_all = pd.concat(df_list[:2], ignore_index=True)
-# Save those too
-df_data_all.to_csv(os.path.join(output_folder, f"ALL_results.csv"), index=False)
-df_data_all.to_excel(os.path.join(output_folder, f"ALL_results.xlsx"), index=False)
+    return config
 
 ################################################################################
-# Now create a plot of the signals
+# Main
 ################################################################################
 
-# Optionally, load data
-# df_data_all = pd.read_csv(os.path.join(output_folder, f"ALL_results.csv"), index=False)
-
-for CURRENT_SAMPLE in np.unique(df_data_all['Sample']):
+if __name__ == '__main__':
+    
+    # Separate command to clear the cache
+    # python analyze_transl_rep.py --clear-cache --cache-dir /path/to/cache/
+    if ('--clear-cache' in sys.argv) and ('--cache-dir' in sys.argv):
+        cache_dir = sys.argv[sys.argv.index('--cache-dir')+1]
+        print(f"Removed {TRpipe.TRcache.clear_cache(cache_dir)} entries from cache {cache_dir}")
+        sys.exit()
+    
+    # Separate command to make the plots of an earlier run (e.g. with --plots later)
+    # python analyze_transl_rep.py --plot-only /output/folder/path/ [--workers N] [--rasterize-labels] [--output-format csv]
+    if '--plot-only' in sys.argv:
+        argv = list(sys.argv)
+        idx = argv.index('--plot-only')
+        output_folder = argv[idx+1]
+        del argv[idx:idx+2]
+        # only the optional flags remain (the positional arguments are not used for plotting)
+        settings = TRpipe.make_settings(parse_arguments(argv))
+        TRpipe.TRstore.check_output_format(settings['output_format'])
+        TRpipe.plot_output_folder(output_folder, settings)
+        sys.exit()
+    
+    # Separate command to combine the results of a sharded batch (the worker that finishes the last file also does this)
+    # python analyze_transl_rep.py --merge-shards /output/folder/path/ [--output-format csv] [--excel]
+    if '--merge-shards' in sys.argv:
+        argv = list(sys.argv)
+        idx = argv.index('--merge-shards')
+        output_folder = argv[idx+1]
+        del argv[idx:idx+2]
+        settings = TRpipe.make_settings(parse_arguments(argv))
+        TRpipe.TRstore.check_output_format(settings['output_format'])
+        status = TRpipe.merge_shards(output_folder, settings)
+        sys.exit(1 if len(status['samples']) == 0 else 0)
+    
+    # Read in settings from command
+    config = parse_arguments(sys.argv) if (len(sys.argv) > 1) else {}
+    if not all(setting in config for setting in ['input_folder', 'output_folder', 'mapping_channels']):
+
+        print('='*80)
+        print('Please call this script as follows: \n')
+        print('python analyze_transl_rep.py /input/folder/path/ /output/folder/path/ 0|1 nucleus 0 name1 1 name2 2 [--workers N] [--segmentation-workers N] [--lazy] [--cache-dir PATH] [--cache-size-gb X] [--watch] [--output-format parquet|csv] [--excel] [--static-stage] [--plots now|later|off] [--rasterize-labels] [--quantile-bands] [--stream] [--features] [--tracking overlap|centroid] [--tile-size N] [--tile-overlap N] [--shard] [--manifest FILE] [--lock-timeout S] [--export-masks] [--masks-from FOLDER]')
+        print('or: python analyze_transl_rep.py --config config.json [other options]\n')
+        print('Where respectively folders can be customized, 0 or 1 is chosen to indicate auto background correction, ')
+        print("and 'nucleus 0 ..' indicates in which channel nucleus and custom named channels to analyze can be found.")
+        print('Optionally, --workers N processes N files in parallel, --segmentation-workers N segments N frames in parallel,')
+        print('--lazy reads frames only when needed (for stacks larger than memory), and --cache-dir PATH caches the masks')
+        print('such that reruns skip segmentation (clear with: python analyze_transl_rep.py --clear-cache --cache-dir PATH).')
+        print('With --watch, the input folder is watched and new files are processed as they appear.')
+        print('Results are stored as parquet files (or csv with --output-format csv), --excel also exports them to excel.')
+        print('With --static-stage, the background region is determined once per file instead of per frame.')
+        print('Plots are made after the analysis; --plots later skips them (make them with: python analyze_transl_rep.py --plot-only /output/folder/path/),')
+        print('--plots off skips them entirely, and --rasterize-labels saves the label plots as png (faster for many cells).')
+        print('With --quantile-bands, the intensity plots show the 10-90% range of the cells per frame.')
+        print('With --stream, each file is processed frame by frame, with constant memory use.')
+        print('With --features, also the area, centroid, integrated intensity and intensity percentiles of each cell are measured.')
+        print('With --tracking centroid, nuclei are linked by their centroids, which closes gaps of a few frames and gives new nuclei new labels.')
+        print('With --tile-size N, very large frames are segmented in tiles of N x N pixels (in parallel with --segmentation-workers).')
+        print('With --shard, several workers (e.g. on different machines) process the files together, each file once; --manifest FILE lists the files.')
+        print('The worker that finishes the last file combines the results, once (or: python analyze_transl_rep.py --merge-shards /output/folder/path/).')
+        print('With --export-masks, the tracked masks are saved in the masks folder of the output (compressed OME-TIFF, e.g. for Fiji or napari);')
+        print('--masks-from FOLDER measures with the masks exported to output folder FOLDER instead of segmenting.')
+        print('With --config FILE, the settings are read from a json (or toml) file, see DEFAULT_SETTINGS in Functions/Pipeline.py;')
+        print('options on the command line override the file.\n')
+        print('Exiting')
+        print('='*80)
+        sys.exit()
     
-    TRplt.plot_intensity_nuc_cyto(df_data_all.loc[df_data_all['Sample']==CURRENT_SAMPLE, ], output_folder, CURRENT_SAMPLE)
-    TRplt.plot_intensity_ratio(df_data_all.loc[df_data_all['Sample']==CURRENT_SAMPLE, ], output_folder, CURRENT_SAMPLE)
-
-
-################################################################################
-
-
-
+    print('Starting script')
+    result = TRpipe.run_pipeline(config)
+    
+    if len(result['samples']) == 0:
+        print('No results, exiting')
+        sys.exit(1)
@@ -0,0 +1,150 @@
+################################################################################
+
+# Benchmark of the pipeline stages on synthetic data
+
+# Each stage of the pipeline is timed separately, for a series of data sizes,
+# such that it can be seen which stage limits the analysis of larger data.
+# Run from the repository folder, e.g.:
+#
+#   python benchmarks/benchmark_pipeline.py --vary image_size --values 256 512 1024
+#   python benchmarks/benchmark_pipeline.py --vary num_cells --values 25 100 400 --output bench.csv
+#
+# The scaling exponent per stage is the slope of log(time) vs log(size),
+# e.g. ~1 means linear, ~2 quadratic in the varied parameter.
+
+################################################################################
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import matplotlib
+matplotlib.use('Agg') # plots are only saved
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Functions.Segmentation as TRseg
+import Functions.Intensity_measurements as TRmeas
+import Functions.Image_corrections as TRcorrect
+import Functions.Plotting as TRplt
+import Functions.Synthetic_data as TRsynth
+
+def time_stage(timings, stage, function, *args, **kwargs):
+    '''Run function, and add its duration (seconds) to timings[stage].'''
+
+    time_start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings[stage] = timings.get(stage, 0) + time.perf_counter() - time_start
+
+    return result
+
+def benchmark_stages(stack, output_folder, plots=True):
+    '''
+    Run each stage of the pipeline on a synthetic stack, returns a dict
+    {stage: seconds}.
+    '''
+
+    timings = {}
+    imgstack_nucleus = stack[:, 0]
+    num_frames = stack.shape[0]
+
+    # segmentation
+    nucleus_masks_preliminary = np.array([time_stage(timings, 'segment_nucleus', TRseg.segment_nucleus, imgstack_nucleus[frm])
+                                                for frm in range(num_frames)])
+
+    # tracking
+    nucleus_masks_tracked = np.empty_like(nucleus_masks_preliminary)
+    nucleus_masks_tracked[0] = nucleus_masks_preliminary[0]
+    for frm in range(num_frames-1):
+        nucleus_masks_tracked[frm+1], _ = time_stage(timings, 'track_nuclei', TRseg.track_nuclei, nucleus_masks_tracked[frm], nucleus_masks_preliminary[frm+1])
+
+    # cytoplasm rings
+    cytoplasm_masks_tracked = np.array([time_stage(timings, 'create_cytoplasm_roi', TRseg.create_cytoplasm_roi, mask) for mask in nucleus_masks_tracked])
+
+    # background correction, per frame and per channel (original), and for all channels at once
+    for channel in range(1, stack.shape[1]):
+        for frm in range(num_frames):
+            time_stage(timings, 'correct_background', TRcorrect.correct_background, stack[frm, channel])
+    time_stage(timings, 'determine_background_levels', TRcorrect.determine_background_levels,
+               {channel: stack[:, channel] for channel in range(1, stack.shape[1])})
+
+    # measurement
+    df_list = []
+    for channel in range(1, stack.shape[1]):
+        df_current = time_stage(timings, 'measure_intensities', TRmeas.measure_intensities_for_all_timepoints,
+                                stack[:, channel], nucleus_masks_tracked, cytoplasm_masks_tracked)
+        df_current['Ratio_cytoplasm_div_nucleus'] = df_current['Intensity_cytoplasm']/df_current['Intensity_nucleus']
+        df_current['Key'] = f"reporter{channel}"
+        df_current['Sample'] = 'synthetic'
+        df_list.append(df_current)
+    df_data = pd.concat(df_list, ignore_index=True)
+
+    # plotting
+    if plots:
+        time_stage(timings, 'plot_labels_framesX', TRplt.plot_labels_framesX, nucleus_masks_tracked, range_start=0, range_end=12,
+                   text_xoffset=50, output_folder=output_folder+'/', file_name='synthetic', suffix='_nuclei')
+        time_stage(timings, 'plot_intensity_nuc_cyto', TRplt.plot_intensity_nuc_cyto, df_data, output_folder, 'synthetic')
+        time_stage(timings, 'plot_intensity_ratio', TRplt.plot_intensity_ratio, df_data, output_folder, 'synthetic')
+
+    return timings
+
+def scaling_exponents(df_timings, vary):
+    '''Slope of log(time) vs log(varied parameter), per stage.'''
+
+    exponents = {}
+    for stage, df_stage in df_timings.groupby('stage'):
+        if (df_stage[vary].nunique() > 1) and (df_stage['seconds'] > 0).all():
+            exponents[stage] = np.polyfit(np.log(df_stage[vary]), np.log(df_stage['seconds']), 1)[0]
+
+    return pd.Series(exponents, name='scaling_exponent')
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data.')
+    parser.add_argument('--vary', default='image_size', choices=['image_size', 'num_cells', 'num_frames', 'num_channels'],
+                        help='parameter that is varied')
+    parser.add_argument('--values', type=int, nargs='+', default=[256, 512, 1024], help='values of the varied parameter')
+    parser.add_argument('--image-size', type=int, default=512)
+    parser.add_argument('--num-cells', type=int, default=100)
+    parser.add_argument('--num-frames', type=int, default=10)
+    parser.add_argument('--num-channels', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=1, help='repeats per value (the fastest is reported)')
+    parser.add_argument('--no-plots', action='store_true', help='skip the plotting stages')
+    parser.add_argument('--output', default=None, help='csv file to save the timings to')
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as output_folder:
+        for value in args.values:
+
+            data_parameters = {'image_size': args.image_size, 'num_cells': args.num_cells,
+                               'num_frames': args.num_frames, 'num_channels': args.num_channels}
+            data_parameters[args.vary] = value
+            stack, _ = TRsynth.make_synthetic_stack(**data_parameters)
+
+            # the fastest of the repeats, per stage
+            timings = {}
+            for _ in range(args.repeats):
+                for stage, seconds in benchmark_stages(stack, output_folder, plots=not args.no_plots).items():
+                    timings[stage] = min(timings.get(stage, np.inf), seconds)
+
+            for stage, seconds in timings.items():
+                rows.append({**data_parameters, 'stage': stage, 'seconds': seconds})
+            print(f"{args.vary}={value}: " + ', '.join(f"{stage} {seconds:.3f}s" for stage, seconds in timings.items()))
+
+    df_timings = pd.DataFrame(rows)
+    if args.output is not None:
+        df_timings.to_csv(args.output, index=False)
+
+    # overview, time per stage per value, and how it scales
+    df_overview = df_timings.pivot_table(index='stage', columns=args.vary, values='seconds', sort=False)
+    df_overview = df_overview.join(scaling_exponents(df_timings, args.vary))
+    print('='*80)
+    print(f"Seconds per stage, for {args.vary} = {args.values}")
+    print(df_overview.round(3).to_string())
+    print('='*80)
@@ -0,0 +1,52 @@
+# Lazy reading (TRread.LazyImageStack) should give the same frames as reading
+# the whole stack, for tif files with and without metadata, compressed or not.
+# Run with: python -m pytest tests/
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import tifffile as tiff
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Functions.Image_reading as TRread
+
+# (shape, tifffile.imwrite arguments), e.g. without metadata a T x 3 x Y x X stack
+# is stored as 3 planar samples per page, and T x Y x X x 3 as interleaved (rgb) samples
+TIF_LAYOUTS = {
+    'no_metadata_planar_samples':      ((4, 3, 32, 40), dict(metadata=None)),
+    'no_metadata_rgb_separate':        ((4, 3, 32, 40), dict(metadata=None, photometric='rgb', planarconfig='separate')),
+    'no_metadata_rgb_interleaved':     ((4, 32, 40, 3), dict(metadata=None, photometric='rgb')),
+    'no_metadata_pages':               ((4, 2, 32, 40), dict(metadata=None, photometric='minisblack')),
+    'no_metadata_3d':                  ((3, 32, 40), dict(metadata=None)),
+    'imagej':                          ((4, 3, 32, 40), dict(imagej=True, metadata={'axes': 'TCYX'})),
+    'ome':                             ((4, 3, 32, 40), dict(ome=True, metadata={'axes': 'TCYX'})),
+    'ome_channels_first':              ((3, 4, 32, 40), dict(ome=True, metadata={'axes': 'CTYX'})),
+    'ome_rgb_interleaved':             ((4, 1, 32, 40, 3), dict(ome=True, photometric='rgb', metadata={'axes': 'TCYXS'})),
+    'ome_rgb_separate':                ((4, 3, 32, 40), dict(ome=True, photometric='rgb', planarconfig='separate', metadata={'axes': 'TSYX'})),
+    'ome_tiled':                       ((2, 3, 64, 64), dict(ome=True, tile=(32, 32), metadata={'axes': 'TCYX'})),
+}
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+@pytest.mark.parametrize('layout', list(TIF_LAYOUTS))
+def test_lazy_reading_same_as_direct(tmp_path, layout, compression):
+
+    shape, imwrite_arguments = TIF_LAYOUTS[layout]
+    file_path = str(tmp_path / 'stack.tif')
+    tiff.imwrite(file_path, np.random.default_rng(0).integers(0, 4000, shape, dtype=np.uint16),
+                 compression=compression, **imwrite_arguments)
+
+    image_stack = TRread.read_image_stack(file_path)
+    lazy_stack = TRread.read_image_stack(file_path, lazy=True)
+    # compressed files can't be memory-mapped, so these are read page by page
+    if compression is not None:
+        assert lazy_stack.memmap is None
+
+    assert lazy_stack.shape == image_stack.shape
+    for time_index in range(image_stack.shape[0]):
+        for channel in range(image_stack.shape[1]):
+            np.testing.assert_array_equal(lazy_stack[time_index, channel], image_stack[time_index, channel])
+    np.testing.assert_array_equal(np.stack(list(lazy_stack[:, 1 % image_stack.shape[1]])), image_stack[:, 1 % image_stack.shape[1]])
+    lazy_stack.close()
@@ -0,0 +1,115 @@
+# Sharded batches (TRpipe.shard_worker): several worker processes on the same
+# files should process each file once, combine the results once, and take over
+# the files of a worker that was killed.
+# Run with: python -m pytest tests/
+
+import os
+import sys
+import glob
+import time
+import signal
+import subprocess
+
+import pandas as pd
+import pytest
+import tifffile as tiff
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_FOLDER)
+
+import Functions.Sharding as TRshard
+from Functions.Synthetic_data import make_synthetic_stack
+
+def write_stacks(input_folder, num_files, num_frames=3, image_size=64):
+
+    os.makedirs(input_folder)
+    for idx in range(num_files):
+        image_stack, _ = make_synthetic_stack(num_frames=num_frames, num_cells=9, image_size=image_size, num_channels=2, seed=idx)
+        tiff.imwrite(os.path.join(input_folder, f"f{idx}.tif"), image_stack, ome=True, metadata={'axes': 'TCYX'})
+
+def start_worker(input_folder, output_folder):
+
+    return subprocess.Popen([sys.executable, '-W', 'ignore', os.path.join(REPO_FOLDER, 'analyze_transl_rep.py'),
+                             str(input_folder), str(output_folder), '0', 'nucleus', '0', 'ERK', '1',
+                             '--output-format', 'csv', '--plots', 'off', '--shard'],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+def check_finished(output_folder, num_files):
+    '''Each entry is done once, and the combined results have each sample once.'''
+
+    shards_folder = TRshard.shards_folder(str(output_folder))
+    _, entries = TRshard.recorded_files(str(output_folder))
+    assert len(entries) == num_files
+    for entry in entries:
+        assert os.path.exists(TRshard.marker_path(str(output_folder), entry, 'done'))
+    assert sorted(glob.glob(os.path.join(shards_folder, '*.done'))) == \
+                sorted([TRshard.marker_path(str(output_folder), entry, 'done') for entry in entries] + [os.path.join(shards_folder, 'merge.done')])
+    assert glob.glob(os.path.join(shards_folder, '*.lock')) + glob.glob(os.path.join(shards_folder, '*.failed')) == []
+
+    df_all = pd.read_csv(os.path.join(output_folder, 'ALL_results.csv'), dtype={'Sample': str, 'Cell': str})
+    assert sorted(df_all['Sample'].unique()) == [f"f{idx}" for idx in range(num_files)]
+    for idx in range(num_files):
+        df_sample = pd.read_csv(os.path.join(output_folder, f"f{idx}_ERK_results.csv"))
+        assert (df_all['Sample'] == f"f{idx}").sum() == len(df_sample)
+    assert not df_all.duplicated(['Sample', 'Key', 'Frame', 'Cell']).any()
+
+def test_several_workers(tmp_path):
+
+    write_stacks(tmp_path / 'in', num_files=5)
+    workers = [start_worker(tmp_path / 'in', tmp_path / 'out') for _ in range(3)]
+    outputs = [worker.communicate(timeout=300)[0] for worker in workers]
+    assert [worker.returncode for worker in workers] == [0, 0, 0], outputs
+
+    check_finished(tmp_path / 'out', 5)
+    # one worker combined the results
+    assert sum('sample(s) with results' in output for output in outputs) == 1
+
+@pytest.mark.skipif(os.name == 'nt', reason='the lock of a killed worker is taken over after the lock timeout on windows')
+def test_killed_worker_is_taken_over(tmp_path):
+
+    write_stacks(tmp_path / 'in', num_files=3, num_frames=20, image_size=256)
+    shards_folder = TRshard.shards_folder(str(tmp_path / 'out'))
+
+    # kill a worker while it processes a file, such that its lock file remains
+    worker = start_worker(tmp_path / 'in', tmp_path / 'out')
+    time_start = time.time()
+    while glob.glob(os.path.join(shards_folder, '0*.lock')) == []:
+        assert (worker.poll() is None) and (time.time() - time_start < 120), 'the worker finished before it could be killed'
+        time.sleep(0.005)
+    worker.send_signal(signal.SIGKILL)
+    worker.wait()
+    assert len(glob.glob(os.path.join(shards_folder, '0*.lock'))) == 1
+
+    # a new worker takes over the file (the process of the lock is gone, so right away)
+    worker = start_worker(tmp_path / 'in', tmp_path / 'out')
+    output = worker.communicate(timeout=300)[0]
+    assert worker.returncode == 0, output
+    assert 'Taking over' in output
+
+    check_finished(tmp_path / 'out', 3)
+
+def test_without_hard_links(tmp_path, monkeypatch):
+
+    # e.g. SMB/CIFS mounts without hard links: files are created with O_EXCL instead
+    def link_not_supported(source_path, path):
+        raise PermissionError('hard links are not supported')
+    monkeypatch.setattr(TRshard.os, 'link', link_not_supported)
+
+    file_paths = [str(tmp_path / f"f{idx}.tif") for idx in range(3)]
+    entries = TRshard.record_manifest(str(tmp_path), file_paths)
+    assert TRshard.record_manifest(str(tmp_path), file_paths) == entries
+    with pytest.raises(ValueError):
+        TRshard.record_manifest(str(tmp_path), file_paths[:2])
+    with pytest.raises(FileExistsError):
+        TRshard.link_exclusive(str(tmp_path / 'shards' / 'manifest.txt'), str(tmp_path / 'shards' / 'manifest.txt'))
+
+    # a stale lock (of a worker that stopped long ago) is taken over
+    claim = TRshard.FileClaim(str(tmp_path), entries[0], lock_timeout=600)
+    assert claim.acquire()
+    claim.stop_heartbeat.set()
+    old_time = time.time() - 3600
+    os.utime(claim.lock_path, (old_time, old_time))
+    other_claim = TRshard.FileClaim(str(tmp_path), entries[0], lock_timeout=600)
+    assert other_claim.acquire()
+    other_claim.release()
+    assert not os.path.exists(claim.lock_path)
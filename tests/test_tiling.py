@@ -0,0 +1,57 @@
+# Tiled segmentation (TRtile.segment_nucleus_tiled) should give the same labeled
+# mask as segmenting the whole frame, also for nuclei that cross tile borders
+# (stitched into one label), and the tiled cytoplasm rings the same rings.
+# Run with: python -m pytest tests/
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Functions.Segmentation as TRseg
+import Functions.Tiling as TRtile
+from Functions.Synthetic_data import make_synthetic_stack
+
+@pytest.fixture(scope='module')
+def frame():
+
+    image_stack, _ = make_synthetic_stack(num_frames=1, num_cells=40, image_size=200, num_channels=1, seed=3)
+    return image_stack[0, 0]
+
+@pytest.mark.parametrize('tile_size', [37, 64, 100, 512])
+@pytest.mark.parametrize('num_workers', [1, 3])
+def test_tiled_segmentation_same_as_full_frame(frame, tile_size, num_workers):
+
+    mask_full = TRseg.segment_nucleus(frame)
+    mask_tiled = TRtile.segment_nucleus_tiled(frame, tile_size=tile_size, tile_overlap=32, num_workers=num_workers)
+
+    assert mask_tiled.dtype == mask_full.dtype
+    np.testing.assert_array_equal(mask_tiled, mask_full)
+
+    # some nuclei cross the tile borders (and were stitched)
+    tile_borders = range(tile_size, frame.shape[0], tile_size)
+    if tile_size < frame.shape[0]:
+        assert any(np.any((mask_full[border-1] > 0) & (mask_full[border-1] == mask_full[border])) for border in tile_borders)
+
+def test_tiled_segmentation_in_out(frame):
+
+    mask_full = TRseg.segment_nucleus(frame)
+    out = np.zeros((2,) + frame.shape, dtype=np.uint16)
+    TRtile.segment_nucleus_tiled(frame, tile_size=50, tile_overlap=32, out=out[1])
+
+    np.testing.assert_array_equal(out[1], mask_full)
+    assert not np.any(out[0])
+
+@pytest.mark.parametrize('cytoplasm_parameters', [{}, {'dilation_radius': 8, 'margin_radius': 2}])
+def test_tiled_cytoplasm_same_as_full_frame(frame, cytoplasm_parameters):
+
+    nucleus_mask = TRseg.segment_nucleus(frame)
+    cytoplasm_full = TRseg.create_cytoplasm_roi(nucleus_mask, **cytoplasm_parameters)
+    cytoplasm_tiled = TRtile.create_cytoplasm_roi_tiled(nucleus_mask, tile_size=45, tile_overlap=16, num_workers=2, **cytoplasm_parameters)
+
+    np.testing.assert_array_equal(cytoplasm_tiled, cytoplasm_full)
+    with pytest.raises(ValueError):
+        TRtile.create_cytoplasm_roi_tiled(nucleus_mask, tile_size=45, tile_overlap=4, **cytoplasm_parameters)
@@ -0,0 +1,81 @@
+# Tracking by overlap (TRseg.track_nuclei) should keep the labels of nuclei
+# stable from frame to frame, with a one-to-one assignment of labels also when
+# the segmentation numbers the nuclei differently or regions overlap several nuclei.
+# Run with: python -m pytest tests/
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Functions.Segmentation as TRseg
+import Functions.Pipeline as TRpipe
+from Functions.Synthetic_data import make_synthetic_stack
+
+def test_labels_stable_when_numbering_swaps():
+
+    # nucleus 1 at the top left and 2 at the bottom right; at t+1 nucleus 1 moved
+    # down, such that the segmentation numbers the nuclei the other way around
+    mask_t = np.zeros((60, 60), dtype=np.uint16)
+    mask_t[5:15, 5:15] = 1
+    mask_t[20:30, 40:50] = 2
+    mask_tplus1 = np.zeros_like(mask_t)
+    mask_tplus1[10:20, 7:17] = 2
+    mask_tplus1[18:28, 40:50] = 1
+
+    mask_tracked, the_mapping = TRseg.track_nuclei(mask_t, mask_tplus1)
+
+    assert the_mapping == {2: 1, 1: 2}
+    assert np.all(mask_tracked[10:20, 7:17] == 1)
+    assert np.all(mask_tracked[18:28, 40:50] == 2)
+    assert mask_tracked.dtype == mask_t.dtype
+
+def test_one_to_one_when_regions_overlap_several_nuclei():
+
+    # region a overlaps nucleus 1 most; region b overlaps nucleus 1 (60 pixels)
+    # more than nucleus 2 (40 pixels), but nucleus 1 is already taken by a
+    mask_t = np.zeros((40, 60), dtype=np.uint16)
+    mask_t[0:10, 0:16] = 1
+    mask_t[0:10, 16:26] = 2
+    mask_tplus1 = np.zeros_like(mask_t)
+    mask_tplus1[0:10, 0:10] = 1    # a: 100 pixels of nucleus 1
+    mask_tplus1[0:10, 10:20] = 2   # b: 60 pixels of nucleus 1, 40 of nucleus 2
+
+    mask_tracked, the_mapping = TRseg.track_nuclei(mask_t, mask_tplus1)
+
+    assert the_mapping == {1: 1, 2: 2}
+    assert sorted(the_mapping.values()) == sorted(set(the_mapping.values()))
+
+def test_unmatched_regions_get_no_label():
+
+    mask_t = np.zeros((40, 40), dtype=np.uint16)
+    mask_t[0:10, 0:10] = 1
+    mask_t[20:30, 20:30] = 2
+    mask_tplus1 = np.zeros_like(mask_t)
+    mask_tplus1[2:12, 2:12] = 1     # nucleus 1
+    mask_tplus1[25:35, 0:10] = 2    # a new region, nucleus 2 is gone
+
+    mask_tracked, the_mapping = TRseg.track_nuclei(mask_t, mask_tplus1)
+
+    assert the_mapping == {1: 1}
+    assert np.all(mask_tracked[2:12, 2:12] == 1)
+    assert np.all(mask_tracked[25:35, 0:10] == 0)
+
+def test_tracked_stack_follows_the_nuclei():
+
+    # moving nuclei (synthetic data): each label stays on the same nucleus in all frames
+    image_stack, truth = make_synthetic_stack(num_frames=8, num_cells=16, image_size=160, num_channels=2, step_size=2.0, seed=1)
+    nucleus_masks_tracked, _ = TRpipe.segment_and_track_nuclei(image_stack[:, 0])
+
+    labels_first, centroids_first = TRseg.label_centroids(nucleus_masks_tracked[0])
+    # the nucleus (in the ground truth) of each label in the first frame
+    cell_of_label = {label: np.argmin(np.linalg.norm(truth['centers'][0] - centroid, axis=1))
+                        for label, centroid in zip(labels_first, centroids_first)}
+    assert len(set(cell_of_label.values())) == len(labels_first) == 16
+    for frm in range(1, len(nucleus_masks_tracked)):
+        labels, centroids = TRseg.label_centroids(nucleus_masks_tracked[frm])
+        assert list(labels) == list(labels_first)
+        for label, centroid in zip(labels, centroids):
+            assert np.linalg.norm(truth['centers'][frm][cell_of_label[label]] - centroid) < 2
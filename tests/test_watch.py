@@ -0,0 +1,85 @@
+# Restarting watch mode (TRpipe.watch_folder) should only remove the results
+# of files of which the processing was interrupted, and keep all other results
+# in the output folder.
+# Run with: python -m pytest tests/
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import tifffile as tiff
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Functions.Pipeline as TRpipe
+import Functions.Results_store as TRstore
+from Functions.Synthetic_data import make_synthetic_stack
+
+def make_config(input_folder, output_folder, **settings):
+
+    return {'input_folder': str(input_folder), 'output_folder': str(output_folder),
+            'mapping_channels': {'nucleus': 0, 'ERK': 1}, 'output_format': 'csv', 'plots': 'off', **settings}
+
+def write_stack(file_path, seed=0):
+
+    image_stack, _ = make_synthetic_stack(num_frames=3, num_cells=4, image_size=64, num_channels=2, seed=seed)
+    tiff.imwrite(file_path, image_stack, ome=True, metadata={'axes': 'TCYX'})
+
+def run_watch(input_folder, output_folder):
+
+    return TRpipe.run_pipeline(make_config(input_folder, output_folder, watch=True, watch_interval=0.1, watch_timeout=0.5))
+
+def test_watch_keeps_results_it_did_not_write(tmp_path):
+
+    # results of a batch run in the output folder, then watch an empty folder
+    os.makedirs(tmp_path / 'batch')
+    os.makedirs(tmp_path / 'watched')
+    for idx in range(2):
+        write_stack(tmp_path / 'batch' / f"f{idx}.tif", seed=idx)
+    TRpipe.run_pipeline(make_config(tmp_path / 'batch', tmp_path / 'out'))
+    assert TRstore.list_samples(str(tmp_path / 'out'), 'csv') == ['f0', 'f1']
+
+    run_watch(tmp_path / 'watched', tmp_path / 'out')
+    assert TRstore.list_samples(str(tmp_path / 'out'), 'csv') == ['f0', 'f1']
+
+def test_watch_restart(tmp_path):
+
+    input_folder, output_folder = tmp_path / 'in', tmp_path / 'out'
+    os.makedirs(input_folder)
+    write_stack(input_folder / 'f0.tif')
+    # a multi-position file of which the second position fails (Z isn't supported)
+    with tiff.TiffWriter(input_folder / 'multi.tif', ome=True) as tif:
+        tif.write(make_synthetic_stack(num_frames=3, num_cells=4, image_size=64, num_channels=2)[0], metadata={'axes': 'TCYX', 'Name': 'good'})
+        tif.write(np.zeros((3, 2, 2, 64, 64), dtype=np.uint16), metadata={'axes': 'TZCYX', 'Name': 'bad'})
+    result = run_watch(input_folder, output_folder)
+    assert result['samples'] == ['f0', 'multi_good']
+    assert result['failed_files'] == ['multi.tif']
+
+    # a run that was interrupted while processing f1 (f1 has results, but wasn't recorded as done)
+    write_stack(input_folder / 'f1.tif', seed=1)
+    TRpipe.run_pipeline(make_config(input_folder, tmp_path / 'other'))
+    for file_name in os.listdir(tmp_path / 'other'):
+        if file_name.startswith('f1_'):
+            os.replace(tmp_path / 'other' / file_name, output_folder / file_name)
+    with open(output_folder / 'watch_processed_files.txt', 'a') as f:
+        f.write('started\tf1.tif\tf1\n')
+    # and a file that was being processed when it was removed from the input folder
+    write_stack(tmp_path / 'gone.tif')
+    TRpipe.run_pipeline(make_config(tmp_path, tmp_path / 'other'))
+    for file_name in os.listdir(tmp_path / 'other'):
+        if file_name.startswith('gone_'):
+            os.replace(tmp_path / 'other' / file_name, output_folder / file_name)
+    with open(output_folder / 'watch_processed_files.txt', 'a') as f:
+        f.write('started\tgone.tif\tgone\n')
+    rows_f1 = len(TRstore.read_results(str(output_folder), ['f1'], 'csv'))
+
+    # the restart removes the results of gone, processes f1 again, and keeps the position of multi that worked
+    result = run_watch(input_folder, output_folder)
+    assert sorted(result['samples']) == ['f0', 'f1', 'multi_good']
+    assert TRstore.list_samples(str(output_folder), 'csv') == ['f0', 'f1', 'multi_good']
+    assert len(TRstore.read_results(str(output_folder), ['f1'], 'csv')) == rows_f1
+    df_all = TRstore.read_results(str(output_folder), ['f0', 'f1', 'multi_good'], 'csv')
+    df_combined = pd.read_csv(output_folder / 'ALL_results.csv', dtype={'Sample': str})
+    assert len(df_combined) == len(df_all)
+    assert sorted(df_combined['Sample'].unique()) == ['f0', 'f1', 'multi_good']